@@ -6,11 +6,38 @@ Users can provide their own Gemini API key and refine generated UIs
 import os
 import json
 import re
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, send_file, abort, Response, stream_with_context, has_request_context
 from flask_cors import CORS
 import google.generativeai as genai
-from datetime import datetime
+import google.ai.generativelanguage as glm
+from datetime import datetime, timedelta
+import contextvars
+import difflib
+import gzip
+import hashlib
+import heapq
+import html
+import io
+import itertools
+import math
+import random
 import secrets
+import select
+import socket
+import sqlite3
+import threading
+import time
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from html.parser import HTMLParser
+try:
+    import fcntl
+except ImportError:
+    # No file locks (Windows): every process runs its own background jobs
+    fcntl = None
+from types import SimpleNamespace
 
 app = Flask(__name__)
 CORS(app)
@@ -25,8 +52,42 @@ if not os.path.exists(UPLOAD_FOLDER):
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Store current code in memory (in production, use Redis or similar)
-current_sessions = {}
+# Where sessions and their versions are stored: 'memory' (process-local) or
+# 'sqlite' (persistent and shared between worker processes)
+SESSION_STORE = os.environ.get('SESSION_STORE', 'memory')
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', 'sessions.db')
+
+# Sessions idle for longer than this are evicted along with their cached model context
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', 2 * 60 * 60))
+
+# Example prompts behind the example buttons; also pre-generated by the Prewarmer
+EXAMPLE_PROMPTS = {
+    'finance': 'Create a finance dashboard with a dark blue sidebar on the left containing menu items for Dashboard, Transactions, Analytics, and Settings. The main area should have three colorful charts: a line chart showing revenue trends, a bar chart for monthly expenses, and a pie chart for portfolio distribution. Add a top header with the company name and user profile section.',
+    'blog': 'Design a clean blog homepage with a large hero section featuring a background image and the blog title. Below that, create a grid of blog post cards with featured images, titles, excerpts, and read more buttons. Include a sticky navigation bar with Home, Articles, About, and Contact links.',
+    'ecommerce': 'Build an e-commerce product page with a large product image gallery on the left and product details on the right including title, price, description, size selector, quantity input, and an add to cart button. Include customer reviews section below with star ratings.',
+    'portfolio': 'Create a modern portfolio website with a hero section containing name and title, an about section with skills, a projects grid showcasing work with hover effects, and a contact form at the bottom. Use a gradient background and smooth animations.',
+    'landing': 'Design a SaaS landing page with a navigation bar, hero section with headline and CTA buttons, features section with icons and descriptions in a grid, pricing cards with different tiers, testimonials carousel, and a footer with links and newsletter signup.',
+}
+
+# Suggestion chips offered for refinements: (label, instruction)
+SUGGESTED_REFINEMENTS = [
+    ('🎨 More vibrant colors', 'Make the colors more vibrant'),
+    ('📐 Better spacing', 'Add more spacing between elements'),
+    ('📱 Mobile responsive', 'Make it mobile responsive'),
+    ('✨ Add animations', 'Add animations'),
+    ('🔧 Fix layout', 'Fix the layout'),
+]
+
+# Speculative refinements: the likeliest suggestion chips are pre-run while the
+# user reviews a new version (opt-in on the server and in the page)
+SPECULATION_ENABLED = os.environ.get('SPECULATION_ENABLED', '0') == '1'
+SPECULATION_TOP_N = int(os.environ.get('SPECULATION_TOP_N', 2))
+SPECULATION_MAX_PER_SESSION = int(os.environ.get('SPECULATION_MAX_PER_SESSION', 6))
+SPECULATION_CACHE_SIZE = 100
+SPECULATION_WORKERS = 4
+
+# Initial state of the "generate sections in parallel" checkbox
+PARALLEL_SECTIONS_ENABLED = os.environ.get('PARALLEL_SECTIONS_ENABLED', '0') == '1'
 
 # HTML template for the main page
 HTML_TEMPLATE = """
@@ -357,6 +418,24 @@ HTML_TEMPLATE = """
             transform: translateX(5px);
         }
         
+        .gallery .api-input {
+            padding: 0.5rem 0.75rem;
+            font-family: inherit;
+            font-size: 0.9rem;
+            margin-bottom: 0.5rem;
+        }
+        
+        .gallery-results {
+            max-height: 220px;
+            overflow-y: auto;
+        }
+        
+        .gallery-results .example-btn small {
+            display: block;
+            color: #999;
+            font-size: 0.75rem;
+        }
+        
         .generate-btn {
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
             color: white;
@@ -516,6 +595,55 @@ HTML_TEMPLATE = """
             transform: scale(1.05);
         }
         
+        .element-picker {
+            display: flex;
+            align-items: center;
+            gap: 0.5rem;
+            margin-bottom: 0.75rem;
+            font-size: 0.85rem;
+        }
+        
+        .pick-btn {
+            padding: 0.4rem 0.8rem;
+            background: white;
+            border: 1px dashed #667eea;
+            border-radius: 20px;
+            color: #667eea;
+            cursor: pointer;
+            transition: all 0.3s;
+        }
+        
+        .pick-btn.active {
+            background: #667eea;
+            color: white;
+        }
+        
+        .selected-element {
+            display: none;
+            align-items: center;
+            gap: 0.25rem;
+            padding: 0.25rem 0.6rem;
+            background: #e8f5e9;
+            color: #2e7d32;
+            border-radius: 12px;
+            font-family: monospace;
+            max-width: 220px;
+            overflow: hidden;
+            text-overflow: ellipsis;
+            white-space: nowrap;
+        }
+        
+        .selected-element.active {
+            display: inline-flex;
+        }
+        
+        .selected-element button {
+            background: none;
+            border: none;
+            color: inherit;
+            cursor: pointer;
+        }
+        
         .action-buttons {
             display: flex;
             gap: 1rem;
@@ -695,6 +823,26 @@ HTML_TEMPLATE = """
             font-size: 0.9rem;
         }
         
+        .diff-line {
+            white-space: pre-wrap;
+            word-break: break-all;
+        }
+        
+        .diff-line.added {
+            background: #e6ffed;
+            color: #22863a;
+        }
+        
+        .diff-line.removed {
+            background: #ffeef0;
+            color: #b31d28;
+        }
+        
+        .diff-hunk {
+            color: #6f42c1;
+            margin-top: 0.75rem;
+        }
+        
         .close-btn {
             background: none;
             border: none;
@@ -821,6 +969,11 @@ HTML_TEMPLATE = """
                     <label for="enhancePrompt">🚀 Auto-enhance prompt for better results</label>
                 </div>
                 
+                <div class="prompt-enhance-toggle">
+                    <input type="checkbox" id="parallelSections"__PARALLEL_SECTIONS_CHECKED__>
+                    <label for="parallelSections">⚡ Generate sections in parallel (faster for long pages)</label>
+                </div>
+                
                 <div class="enhanced-prompt-display" id="enhancedPromptDisplay">
                     <strong>Enhanced prompt:</strong> <span id="enhancedText"></span>
                 </div>
@@ -836,6 +989,12 @@ HTML_TEMPLATE = """
                 
                 <button class="generate-btn" onclick="generateUI()">Generate UI</button>
                 
+                <div class="examples gallery">
+                    <h3>Past Designs</h3>
+                    <input type="text" id="gallerySearch" class="api-input" placeholder="Search past prompts and pages..." oninput="searchGallery()">
+                    <div id="galleryResults" class="gallery-results"></div>
+                </div>
+                
                 <!-- Refinement Section -->
                 <div class="refinement-section" id="refinementSection">
                     <div class="refinement-header">
@@ -848,11 +1007,17 @@ HTML_TEMPLATE = """
                     </p>
                     
                     <div class="suggestion-chips">
-                        <button class="suggestion-chip" onclick="addSuggestion('Make the colors more vibrant')">🎨 More vibrant colors</button>
-                        <button class="suggestion-chip" onclick="addSuggestion('Add more spacing between elements')">📐 Better spacing</button>
-                        <button class="suggestion-chip" onclick="addSuggestion('Make it mobile responsive')">📱 Mobile responsive</button>
-                        <button class="suggestion-chip" onclick="addSuggestion('Add animations')">✨ Add animations</button>
-                        <button class="suggestion-chip" onclick="addSuggestion('Fix the layout')">🔧 Fix layout</button>
+__SUGGESTION_CHIPS__
+                    </div>
+                    
+__SPECULATION_TOGGLE__
+                    
+                    <div class="element-picker">
+                        <button class="pick-btn" id="pickBtn" onclick="togglePickMode()">🎯 Pick element</button>
+                        <span class="selected-element" id="selectedElement">
+                            <span id="selectedElementLabel"></span>
+                            <button onclick="clearSelectedElement()" title="Refine the whole page">×</button>
+                        </span>
                     </div>
                     
                     <textarea 
@@ -882,6 +1047,10 @@ HTML_TEMPLATE = """
                     <h2>Live Preview</h2>
                     <div class="preview-controls">
                         <span class="version-indicator" id="versionIndicator" style="display: none;">Version 1</span>
+                        <select class="preview-control-btn" id="versionSelect" style="display: none;" onchange="previewVersion(this.value)"></select>
+                        <button class="preview-control-btn" id="restoreBtn" style="display: none;" onclick="restoreVersion()">⏪ Restore</button>
+                        <button class="preview-control-btn" id="compareBtn" style="display: none;" onclick="showDiff()">🔍 Changes</button>
+                        <button class="preview-control-btn" id="exportBtn" style="display: none;" onclick="exportSession()">📦 Export</button>
                         <button class="preview-control-btn" onclick="resetPreview()">🔄 Reset</button>
                         <span id="status">Ready</span>
                     </div>
@@ -895,12 +1064,28 @@ HTML_TEMPLATE = """
                     <div class="loading-overlay" id="loading">
                         <div class="spinner"></div>
                         <div class="loading-text" id="loadingText">Generating...</div>
+                        <button class="preview-control-btn" onclick="cancelActiveRequest()">✖ Cancel</button>
                     </div>
                 </div>
             </div>
         </div>
     </div>
     
+    <!-- Diff Modal -->
+    <div class="code-modal" id="diffModal">
+        <div class="modal-content">
+            <div class="modal-header">
+                <h2 id="diffTitle">Changes</h2>
+                <button class="close-btn" onclick="closeDiff()">×</button>
+            </div>
+            <div class="modal-body">
+                <div class="code-block">
+                    <pre id="diffContent"></pre>
+                </div>
+            </div>
+        </div>
+    </div>
+    
     <!-- Code Modal -->
     <div class="code-modal" id="codeModal">
         <div class="modal-content">
@@ -928,13 +1113,7 @@ HTML_TEMPLATE = """
             return 'session_' + Date.now() + '_' + Math.random().toString(36).substr(2, 9);
         }
         
-        const examples = {
-            finance: "Create a finance dashboard with a dark blue sidebar on the left containing menu items for Dashboard, Transactions, Analytics, and Settings. The main area should have three colorful charts: a line chart showing revenue trends, a bar chart for monthly expenses, and a pie chart for portfolio distribution. Add a top header with the company name and user profile section.",
-            blog: "Design a clean blog homepage with a large hero section featuring a background image and the blog title. Below that, create a grid of blog post cards with featured images, titles, excerpts, and read more buttons. Include a sticky navigation bar with Home, Articles, About, and Contact links.",
-            ecommerce: "Build an e-commerce product page with a large product image gallery on the left and product details on the right including title, price, description, size selector, quantity input, and an add to cart button. Include customer reviews section below with star ratings.",
-            portfolio: "Create a modern portfolio website with a hero section containing name and title, an about section with skills, a projects grid showcasing work with hover effects, and a contact form at the bottom. Use a gradient background and smooth animations.",
-            landing: "Design a SaaS landing page with a navigation bar, hero section with headline and CTA buttons, features section with icons and descriptions in a grid, pricing cards with different tiers, testimonials carousel, and a footer with links and newsletter signup."
-        };
+        const examples = __EXAMPLE_PROMPTS__;
         
         function toggleApiKeyVisibility() {
             const input = document.getElementById('apiKeyInput');
@@ -981,6 +1160,7 @@ HTML_TEMPLATE = """
                     isConnected = true;
                     sessionId = generateSessionId();
                     showConnected();
+                    searchGallery();
                 } else {
                     showError(data.error || 'Invalid API key. Please check and try again.');
                 }
@@ -1018,6 +1198,8 @@ HTML_TEMPLATE = """
             const apiKeyContent = document.getElementById('apiKeyContent');
             const apiKeyInput = document.getElementById('apiKeyInput');
             
+            cancelActiveRequest();
+            cancelSpeculation();
             apiKey = '';
             isConnected = false;
             sessionId = '';
@@ -1065,7 +1247,78 @@ HTML_TEMPLATE = """
             }
         }
         
-        async function generateUI() {
+        // Only one model request runs at a time. Starting another aborts the
+        // previous fetch (the server supersedes it on its own); cancelling or
+        // leaving the page also tells the server to stop.
+        let activeController = null;
+        
+        // Refinements don't abort each other: the server merges the ones
+        // sent while another is running into a single model call
+        const refineControllers = new Set();
+        
+        function abortRefinements() {
+            refineControllers.forEach(controller => controller.abort());
+            refineControllers.clear();
+        }
+        
+        function beginRequest() {
+            if (activeController) activeController.abort();
+            abortRefinements();
+            activeController = new AbortController();
+            return activeController.signal;
+        }
+        
+        function endRequest(signal) {
+            if (activeController && activeController.signal === signal) activeController = null;
+        }
+        
+        function cancelActiveRequest() {
+            if (!activeController && !refineControllers.size) return;
+            if (activeController) activeController.abort();
+            activeController = null;
+            abortRefinements();
+            if (sessionId) {
+                navigator.sendBeacon(`/sessions/${encodeURIComponent(sessionId)}/cancel`);
+            }
+        }
+        
+        window.addEventListener('pagehide', cancelActiveRequest);
+        
+        // Speculative refinements: after the user has looked at a new
+        // version for a moment, the server pre-runs the likeliest suggestions
+        const SPECULATION_IDLE_MS = 4000;
+        let speculationTimer = null;
+        let speculating = false;
+        
+        function scheduleSpeculation() {
+            clearTimeout(speculationTimer);
+            const toggle = document.getElementById('speculativeMode');
+            if (!toggle || !toggle.checked || !sessionId) return;
+            speculationTimer = setTimeout(() => {
+                if (activeController || refineControllers.size) return;
+                if (document.getElementById('refinementPrompt').value.trim()) return;
+                speculating = true;
+                fetch(`/sessions/${encodeURIComponent(sessionId)}/speculate`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ api_key: apiKey })
+                }).catch(() => {});
+            }, SPECULATION_IDLE_MS);
+        }
+        
+        function cancelSpeculation() {
+            clearTimeout(speculationTimer);
+            if (speculating && sessionId) {
+                navigator.sendBeacon(`/sessions/${encodeURIComponent(sessionId)}/speculate/cancel`);
+            }
+            speculating = false;
+        }
+        
+        // Typing something new makes the pre-run suggestions unlikely
+        document.getElementById('refinementPrompt').addEventListener('input', cancelSpeculation);
+        
+        async function generateUI(fresh = false) {
+            cancelSpeculation();
             if (!isConnected || !apiKey) {
                 alert('Please connect your Gemini API key first!');
                 return;
@@ -1078,6 +1331,7 @@ HTML_TEMPLATE = """
             }
             
             const enhancePrompt = document.getElementById('enhancePrompt').checked;
+            const parallelSections = document.getElementById('parallelSections').checked;
             const loadingOverlay = document.getElementById('loading');
             const loadingText = document.getElementById('loadingText');
             const generateBtn = document.querySelector('.generate-btn');
@@ -1101,9 +1355,32 @@ HTML_TEMPLATE = """
                 enhancedText.textContent = 'Enhancing your prompt...';
             }
             
+            // Show a stored design for a near-duplicate prompt as a draft
+            // while the fresh generation runs
+            let generationDone = false;
+            const signal = beginRequest();
+            fetch('/similar', {
+                method: 'POST',
+                signal: signal,
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({
+                    description: description,
+                    enhance_prompt: enhancePrompt,
+                    api_key: apiKey
+                })
+            }).then(r => r.json()).then(data => {
+                if (generationDone || !data.success || !data.match) return;
+                document.getElementById('preview-iframe').srcdoc = data.match.code;
+                loadingOverlay.classList.remove('active');
+                status.textContent = `Draft (${Math.round(data.match.similarity * 100)}% similar) - generating fresh...`;
+            }).catch(() => {});
+            
             try {
                 const response = await fetch('/generate', {
                     method: 'POST',
+                    signal: signal,
                     headers: {
                         'Content-Type': 'application/json',
                     },
@@ -1111,11 +1388,14 @@ HTML_TEMPLATE = """
                         description: description,
                         api_key: apiKey,
                         enhance_prompt: enhancePrompt,
-                        session_id: sessionId
+                        parallel_sections: parallelSections,
+                        session_id: sessionId,
+                        fresh: fresh
                     })
                 });
                 
                 const data = await response.json();
+                generationDone = true;
                 
                 if (data.success) {
                     currentCode = data.code;
@@ -1128,33 +1408,144 @@ HTML_TEMPLATE = """
                     // Update iframe with new content
                     document.getElementById('preview-iframe').srcdoc = currentCode;
                     
+                    clearSelectedElement();
+                    
                     // Show refinement section
                     document.getElementById('refinementSection').classList.add('active');
                     document.getElementById('versionBadge').textContent = 'v1';
                     document.getElementById('versionIndicator').textContent = 'Version 1';
                     document.getElementById('versionIndicator').style.display = 'inline-block';
                     
-                    status.textContent = 'Generated Successfully!';
+                    status.textContent = data.prewarmed
+                        ? 'Loaded instantly from cache - click Regenerate for a fresh version'
+                        : 'Generated Successfully!';
+                    loadVersions();
+                    scheduleSpeculation();
                     viewCodeBtn.disabled = false;
                     downloadBtn.disabled = false;
                     
                     // Clear refinement textarea
                     document.getElementById('refinementPrompt').value = '';
+                } else if (data.cancelled) {
+                    status.textContent = 'Cancelled';
+                    enhancedPromptDisplay.classList.remove('active');
                 } else {
                     alert('Error: ' + data.error);
                     status.textContent = 'Error';
                     enhancedPromptDisplay.classList.remove('active');
                 }
             } catch (error) {
-                alert('Failed to generate UI: ' + error.message);
-                status.textContent = 'Error';
+                generationDone = true;
+                if (error.name === 'AbortError') {
+                    status.textContent = 'Cancelled';
+                } else {
+                    alert('Failed to generate UI: ' + error.message);
+                    status.textContent = 'Error';
+                }
                 enhancedPromptDisplay.classList.remove('active');
             } finally {
+                endRequest(signal);
                 loadingOverlay.classList.remove('active');
                 generateBtn.disabled = false;
             }
         }
         
+        let pickMode = false;
+        let selectedTargetPath = '';
+        let selectedTarget = {tag: '', text: ''};
+        
+        // Build a path like "#pricing > div:nth-of-type(2)" that the server
+        // can resolve against the page source
+        function getElementPath(el) {
+            const steps = [];
+            while (el && el.nodeType === 1) {
+                const tag = el.tagName.toLowerCase();
+                if (el.id) {
+                    steps.unshift('#' + el.id);
+                    break;
+                }
+                if (tag === 'body' || tag === 'html') {
+                    steps.unshift(tag);
+                    break;
+                }
+                let index = 1;
+                let sibling = el.previousElementSibling;
+                while (sibling) {
+                    if (sibling.tagName === el.tagName) index++;
+                    sibling = sibling.previousElementSibling;
+                }
+                steps.unshift(`${tag}:nth-of-type(${index})`);
+                el = el.parentElement;
+            }
+            return steps.join(' > ');
+        }
+        
+        function describeElement(el) {
+            let label = el.tagName.toLowerCase();
+            if (el.id) label += '#' + el.id;
+            if (el.classList.length) label += '.' + Array.from(el.classList).join('.');
+            return label;
+        }
+        
+        function togglePickMode() {
+            const doc = document.getElementById('preview-iframe').contentDocument;
+            if (!doc || !currentCode) {
+                alert('Generate a UI first!');
+                return;
+            }
+            
+            pickMode = !pickMode;
+            document.getElementById('pickBtn').classList.toggle('active', pickMode);
+            document.getElementById('status').textContent = pickMode ? 'Click an element in the preview' : 'Ready';
+            
+            if (pickMode) {
+                doc.addEventListener('mouseover', highlightPickTarget, true);
+                doc.addEventListener('mouseout', unhighlightPickTarget, true);
+                doc.addEventListener('click', pickElement, true);
+            } else {
+                stopPickMode(doc);
+            }
+        }
+        
+        function stopPickMode(doc) {
+            pickMode = false;
+            document.getElementById('pickBtn').classList.remove('active');
+            if (!doc) return;
+            doc.removeEventListener('mouseover', highlightPickTarget, true);
+            doc.removeEventListener('mouseout', unhighlightPickTarget, true);
+            doc.removeEventListener('click', pickElement, true);
+        }
+        
+        function highlightPickTarget(e) {
+            e.target.style.outline = '2px dashed #667eea';
+        }
+        
+        function unhighlightPickTarget(e) {
+            e.target.style.outline = '';
+        }
+        
+        function pickElement(e) {
+            e.preventDefault();
+            e.stopPropagation();
+            e.target.style.outline = '';
+            selectedTargetPath = getElementPath(e.target);
+            // Lets the server check it found the same element in the source
+            selectedTarget = {
+                tag: e.target.tagName.toLowerCase(),
+                text: (e.target.textContent || '').replace(/\\s+/g, ' ').trim().slice(0, 200)
+            };
+            document.getElementById('selectedElementLabel').textContent = describeElement(e.target);
+            document.getElementById('selectedElement').classList.add('active');
+            document.getElementById('status').textContent = 'Element selected';
+            stopPickMode(e.target.ownerDocument);
+        }
+        
+        function clearSelectedElement() {
+            selectedTargetPath = '';
+            selectedTarget = {tag: '', text: ''};
+            document.getElementById('selectedElement').classList.remove('active');
+        }
+        
         async function refineUI() {
             if (!isConnected || !apiKey) {
                 alert('Please connect your Gemini API key first!');
@@ -1174,17 +1565,26 @@ HTML_TEMPLATE = """
             
             const loadingOverlay = document.getElementById('loading');
             const loadingText = document.getElementById('loadingText');
-            const refineBtn = document.querySelector('.refine-btn');
             const status = document.getElementById('status');
             
+            // Further refinements can be sent while this one runs; they
+            // are queued and applied together
+            const controller = new AbortController();
+            refineControllers.add(controller);
             loadingOverlay.classList.add('active');
-            loadingText.textContent = 'Applying fixes to your UI...';
-            refineBtn.disabled = true;
+            loadingText.textContent = refineControllers.size > 1
+                ? `Applying fixes to your UI (${refineControllers.size - 1} queued)...`
+                : 'Applying fixes to your UI...';
             status.textContent = 'Refining...';
+            const targetPath = selectedTargetPath;
+            const target = selectedTarget;
+            document.getElementById('refinementPrompt').value = '';
+            clearSelectedElement();
             
             try {
                 const response = await fetch('/refine', {
                     method: 'POST',
+                    signal: controller.signal,
                     headers: {
                         'Content-Type': 'application/json',
                     },
@@ -1192,15 +1592,23 @@ HTML_TEMPLATE = """
                         current_code: currentCode,
                         refinement_prompt: refinementPrompt,
                         api_key: apiKey,
-                        session_id: sessionId
+                        session_id: sessionId,
+                        target_path: targetPath,
+                        target_tag: target.tag,
+                        target_text: target.text
                     })
                 });
                 
                 const data = await response.json();
                 
+                // Requests merged into one refinement all get its result
+                if (data.success && data.version && data.version <= currentVersion) {
+                    return;
+                }
+                
                 if (data.success) {
                     currentCode = data.code;
-                    currentVersion++;
+                    currentVersion = data.version || currentVersion + 1;
                     
                     // Update iframe with refined content
                     document.getElementById('preview-iframe').srcdoc = currentCode;
@@ -1209,26 +1617,203 @@ HTML_TEMPLATE = """
                     document.getElementById('versionBadge').textContent = `v${currentVersion}`;
                     document.getElementById('versionIndicator').textContent = `Version ${currentVersion}`;
                     
-                    status.textContent = 'Refined Successfully!';
-                    
-                    // Clear refinement textarea
-                    document.getElementById('refinementPrompt').value = '';
+                    status.textContent = data.speculative
+                        ? 'Refined instantly (pre-computed)'
+                        : data.coalesced > 1
+                            ? `Refined Successfully! (${data.coalesced} changes in one pass)`
+                            : 'Refined Successfully!';
+                    loadVersions();
+                    scheduleSpeculation();
+                } else if (data.cancelled) {
+                    status.textContent = 'Cancelled';
+                } else if (data.reselect) {
+                    // The picked element isn't in the current source any more
+                    document.getElementById('refinementPrompt').value = refinementPrompt;
+                    alert(data.error);
+                    status.textContent = 'Select the element again';
                 } else {
+                    document.getElementById('refinementPrompt').value = refinementPrompt;
                     alert('Error: ' + data.error);
                     status.textContent = 'Refinement Error';
                 }
             } catch (error) {
-                alert('Failed to refine UI: ' + error.message);
-                status.textContent = 'Error';
+                if (error.name === 'AbortError') {
+                    status.textContent = 'Cancelled';
+                } else {
+                    alert('Failed to refine UI: ' + error.message);
+                    status.textContent = 'Error';
+                }
             } finally {
-                loadingOverlay.classList.remove('active');
-                refineBtn.disabled = false;
+                refineControllers.delete(controller);
+                if (!refineControllers.size && !activeController) {
+                    loadingOverlay.classList.remove('active');
+                }
+            }
+        }
+        
+        let previewedVersion = 0;
+        
+        async function loadVersions() {
+            if (!sessionId) return;
+            try {
+                const response = await fetch(`/sessions/${encodeURIComponent(sessionId)}/versions`);
+                const data = await response.json();
+                if (!data.success) return;
+                
+                const select = document.getElementById('versionSelect');
+                select.innerHTML = '';
+                data.versions.forEach(v => {
+                    const option = document.createElement('option');
+                    option.value = v.version;
+                    option.textContent = `v${v.version}: ${(v.prompt || '').slice(0, 40)}`;
+                    select.appendChild(option);
+                });
+                select.value = data.current_version;
+                select.style.display = data.versions.length > 1 ? 'inline-block' : 'none';
+                document.getElementById('compareBtn').style.display = data.versions.length > 1 ? 'inline-block' : 'none';
+                document.getElementById('exportBtn').style.display = data.versions.length > 1 ? 'inline-block' : 'none';
+                currentVersion = data.current_version;
+                previewedVersion = currentVersion;
+                document.getElementById('restoreBtn').style.display = 'none';
+            } catch (error) {
+                console.error('Failed to load versions', error);
+            }
+        }
+        
+        async function previewVersion(version) {
+            version = parseInt(version, 10);
+            const response = await fetch(`/sessions/${encodeURIComponent(sessionId)}/versions/${version}`);
+            const data = await response.json();
+            if (!data.success) {
+                alert('Error: ' + data.error);
+                return;
+            }
+            previewedVersion = version;
+            document.getElementById('preview-iframe').srcdoc = data.code;
+            document.getElementById('restoreBtn').style.display = version === currentVersion ? 'none' : 'inline-block';
+            document.getElementById('status').textContent = version === currentVersion ? 'Ready' : `Previewing v${version}`;
+        }
+        
+        function exportSession() {
+            const a = document.createElement('a');
+            a.href = `/sessions/${encodeURIComponent(sessionId)}/export`;
+            document.body.appendChild(a);
+            a.click();
+            document.body.removeChild(a);
+        }
+        
+        async function restoreVersion() {
+            const response = await fetch(`/sessions/${encodeURIComponent(sessionId)}/versions/${previewedVersion}/restore`, {
+                method: 'POST'
+            });
+            const data = await response.json();
+            if (!data.success) {
+                alert('Error: ' + data.error);
+                return;
+            }
+            currentCode = data.code;
+            document.getElementById('preview-iframe').srcdoc = currentCode;
+            document.getElementById('versionBadge').textContent = `v${data.version}`;
+            document.getElementById('versionIndicator').textContent = `Version ${data.version}`;
+            document.getElementById('status').textContent = `Restored v${previewedVersion}`;
+            loadVersions();
+        }
+        
+        async function showDiff() {
+            // Compare the previewed version with the current one, or the
+            // current version with its predecessor
+            const toVersion = currentVersion;
+            const fromVersion = previewedVersion !== currentVersion ? previewedVersion : currentVersion - 1;
+            const response = await fetch(`/sessions/${encodeURIComponent(sessionId)}/diff?from=${fromVersion}&to=${toVersion}`);
+            const data = await response.json();
+            if (!data.success) {
+                alert('Error: ' + data.error);
+                return;
+            }
+            
+            const content = document.getElementById('diffContent');
+            content.innerHTML = '';
+            document.getElementById('diffTitle').textContent =
+                `v${fromVersion} → v${toVersion} (+${data.diff.added} / -${data.diff.removed})`;
+            data.diff.hunks.forEach(hunk => {
+                const header = document.createElement('div');
+                header.className = 'diff-line diff-hunk';
+                header.textContent = `@@ -${hunk.old_start},${hunk.old_lines} +${hunk.new_start},${hunk.new_lines} @@`;
+                content.appendChild(header);
+                hunk.lines.forEach(([op, text]) => {
+                    const line = document.createElement('div');
+                    line.className = 'diff-line' + (op === '+' ? ' added' : op === '-' ? ' removed' : '');
+                    line.textContent = op + ' ' + text;
+                    content.appendChild(line);
+                });
+            });
+            if (!data.diff.hunks.length) {
+                content.textContent = 'No changes.';
+            }
+            document.getElementById('diffModal').classList.add('active');
+        }
+        
+        function closeDiff() {
+            document.getElementById('diffModal').classList.remove('active');
+        }
+        
+        let gallerySearchTimer = null;
+        
+        function searchGallery() {
+            clearTimeout(gallerySearchTimer);
+            gallerySearchTimer = setTimeout(async () => {
+                const query = document.getElementById('gallerySearch').value;
+                const response = await fetch('/gallery?q=' + encodeURIComponent(query) + '&limit=10', {
+                    headers: { 'X-API-Key': apiKey }
+                });
+                const data = await response.json();
+                const results = document.getElementById('galleryResults');
+                results.innerHTML = '';
+                if (!data.success) return;
+                data.results.forEach(item => {
+                    const button = document.createElement('button');
+                    button.className = 'example-btn';
+                    button.textContent = item.title || (item.prompt || item.filename).slice(0, 60);
+                    const meta = document.createElement('small');
+                    meta.textContent = (item.snippet || item.prompt || '').slice(0, 90);
+                    button.appendChild(meta);
+                    button.onclick = () => useGalleryItem(item.filename);
+                    results.appendChild(button);
+                });
+            }, 150);
+        }
+        
+        async function useGalleryItem(filename) {
+            const response = await fetch(`/gallery/${encodeURIComponent(filename)}/use`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ api_key: apiKey })
+            });
+            const data = await response.json();
+            if (!data.success) {
+                alert('Error: ' + data.error);
+                return;
             }
+            // The server starts a fresh session for the reused page
+            sessionId = data.session_id;
+            currentCode = data.code;
+            currentVersion = 1;
+            document.getElementById('versionBadge').textContent = 'v1';
+            document.getElementById('versionIndicator').textContent = 'Version 1';
+            document.getElementById('preview-iframe').srcdoc = currentCode;
+            document.getElementById('refinementSection').classList.add('active');
+            document.getElementById('versionIndicator').style.display = 'inline-block';
+            document.getElementById('viewCodeBtn').disabled = false;
+            document.getElementById('downloadBtn').disabled = false;
+            document.getElementById('status').textContent = 'Loaded from gallery';
+            loadVersions();
         }
         
         async function regenerateUI() {
             if (confirm('This will create a completely new version. Are you sure?')) {
-                generateUI();
+                generateUI(true);
             }
         }
         
@@ -1251,6 +1836,16 @@ HTML_TEMPLATE = """
                 return;
             }
             
+            if (sessionId && currentVersion) {
+                // Download the stored version from the server
+                const a = document.createElement('a');
+                a.href = `/sessions/${encodeURIComponent(sessionId)}/versions/${previewedVersion || currentVersion}/download`;
+                document.body.appendChild(a);
+                a.click();
+                document.body.removeChild(a);
+                return;
+            }
+            
             const blob = new Blob([currentCode], { type: 'text/html' });
             const url = window.URL.createObjectURL(blob);
             const a = document.createElement('a');
@@ -1280,9 +1875,26 @@ HTML_TEMPLATE = """
 </html>
 """
 
+SUGGESTION_CHIPS_HTML = '\n'.join(
+    f'                        <button class="suggestion-chip" '
+    f'onclick="addSuggestion({html.escape(json.dumps(instruction))})">{html.escape(label)}</button>'
+    for label, instruction in SUGGESTED_REFINEMENTS)
+
+SPECULATION_TOGGLE_HTML = """                    <div class="prompt-enhance-toggle">
+                        <input type="checkbox" id="speculativeMode">
+                        <label for="speculativeMode">🔮 Pre-run suggested fixes while I review</label>
+                    </div>
+"""
+
+INDEX_PAGE = (HTML_TEMPLATE
+              .replace('__EXAMPLE_PROMPTS__', json.dumps(EXAMPLE_PROMPTS))
+              .replace('__SUGGESTION_CHIPS__', SUGGESTION_CHIPS_HTML)
+              .replace('__PARALLEL_SECTIONS_CHECKED__', ' checked' if PARALLEL_SECTIONS_ENABLED else '')
+              .replace('__SPECULATION_TOGGLE__\n', SPECULATION_TOGGLE_HTML if SPECULATION_ENABLED else ''))
+
 @app.route('/')
 def index():
-    return HTML_TEMPLATE
+    return INDEX_PAGE
 
 @app.route('/test-api-key', methods=['POST'])
 def test_api_key():
@@ -1295,10 +1907,10 @@ def test_api_key():
             return jsonify({'success': False, 'error': 'No API key provided'})
         
         # Configure Gemini with the provided API key
-        genai.configure(api_key=api_key)
+        model_backend.configure(api_key)
         
         # Try a simple test to verify the API key works
-        model = genai.GenerativeModel('models/gemini-2.5-flash')
+        model = model_backend.model(model_router.select('validate'))
         response = model.generate_content("Say 'Hello'")
         
         return jsonify({'success': True})
@@ -1310,223 +1922,3911 @@ def test_api_key():
         else:
             return jsonify({'success': False, 'error': f'Connection failed: {error_message}'})
 
-def enhance_user_prompt(description):
+# Prompt enhancement rules. Each rule fires on whole-word keyword matches
+# (a trailing "s"/"es" plural is accepted), so 'nav' no longer hits 'canvas'.
+#   name     - optional category name (e.g. 'dashboard')
+#   keywords - rule fires when any of these appear
+#   unless   - rule is skipped when any of these appear
+#   requires - rule only fires when one of these also appears
+#   append   - text added to the description
+#   group    - 'pattern' rules are appended inline, 'technical' rules are
+#              joined into one sentence, 'interaction' rules come last
+PROMPT_RULES = [
+    {'group': 'pattern', 'name': 'dashboard', 'keywords': ['dashboard'],
+     'append': 'with sidebar navigation, header with user profile, main content area with cards and charts'},
+    {'group': 'pattern', 'name': 'landing', 'keywords': ['landing'],
+     'append': 'with hero section, features grid, testimonials, pricing section, and footer'},
+    {'group': 'pattern', 'name': 'blog', 'keywords': ['blog'],
+     'append': 'with header navigation, article cards in grid layout, sidebar for categories'},
+    {'group': 'pattern', 'name': 'ecommerce', 'keywords': ['ecommerce', 'e-commerce'],
+     'append': 'with product gallery, add to cart functionality, reviews section'},
+    {'group': 'pattern', 'name': 'portfolio', 'keywords': ['portfolio'],
+     'append': 'with projects showcase, about section, contact form, smooth scrolling'},
+    {'group': 'technical', 'unless': ['responsive', 'mobile'],
+     'append': 'Make it fully responsive for all devices'},
+    {'group': 'technical', 'unless': ['color', 'colour', 'colorful', 'colourful', 'theme'],
+     'append': 'Use a modern color scheme with good contrast'},
+    {'group': 'technical', 'unless': ['navigation', 'nav', 'navbar', 'menu'],
+     'requires': ['website', 'site', 'page', 'homepage', 'app', 'application'],
+     'append': 'Include proper navigation'},
+    {'group': 'interaction', 'keywords': ['button', 'link', 'tab'],
+     'append': 'IMPORTANT: Make all navigation links and tabs work within the page using JavaScript (single-page behavior). Use # anchors or JavaScript to show/hide content instead of loading new pages.'},
+]
+
+# Optional JSON file with extra rules in the same format as PROMPT_RULES
+PROMPT_RULES_FILE = os.environ.get('PROMPT_RULES_FILE', '')
+
+def _keyword_trie_pattern(keywords):
+    """
+    Build a regex alternation from a character trie of the keywords so the
+    regex engine branches on one character at a time instead of trying every
+    keyword at every position
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for ch in keyword:
+            node = node.setdefault(ch, {})
+        node[''] = True
+
+    def emit(node):
+        branches = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            body = '(?:' + body + ')?'
+        return body
+
+    return emit(trie)
+
+class PromptRuleEngine:
+    """
+    Compiles a list of prompt rules into a single word-boundary regex and
+    evaluates them against a description in one pass
+    """
+
+    def __init__(self, rules):
+        self.rules = [dict(rule) for rule in rules]
+        for rule in self.rules:
+            rule.setdefault('group', 'pattern')
+        self.keyword_rules = {}
+        self.always_rules = []
+        keywords = set()
+        for index, rule in enumerate(self.rules):
+            for field in ('keywords', 'unless', 'requires'):
+                rule[field] = frozenset(k.lower() for k in rule.get(field, ()))
+                keywords.update(rule[field])
+            if rule['keywords']:
+                for keyword in rule['keywords']:
+                    self.keyword_rules.setdefault(keyword, []).append(index)
+            else:
+                self.always_rules.append(index)
+        self.keywords = keywords
+        self.matcher = None
+        if keywords:
+            self.matcher = re.compile(r'\b(' + _keyword_trie_pattern(keywords) + r')(?:e?s)?\b')
+
+    def find_keywords(self, text):
+        """Return the set of rule keywords that appear as whole words in text"""
+        if self.matcher is None:
+            return set()
+        return {m.group(1) for m in self.matcher.finditer(text.lower())}
+
+    def matching_rules(self, text):
+        """Return the rules that fire for text, in declaration order"""
+        found = self.find_keywords(text)
+        candidates = set(self.always_rules)
+        for keyword in found:
+            candidates.update(self.keyword_rules.get(keyword, ()))
+
+        matched = []
+        for index in sorted(candidates):
+            rule = self.rules[index]
+            if rule['unless'] & found:
+                continue
+            if rule['requires'] and not rule['requires'] & found:
+                continue
+            matched.append(rule)
+        return matched
+
+def load_prompt_rules(path=None):
+    """
+    Load the built-in prompt rules plus any extra rules from a JSON file
+    """
+    rules = list(PROMPT_RULES)
+    path = path or PROMPT_RULES_FILE
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            rules.extend(json.load(f))
+    return rules
+
+# Compiled once at startup and shared by every request
+prompt_rule_engine = PromptRuleEngine(load_prompt_rules())
+
+def enhance_user_prompt(description, engine=None):
     """
     Enhance the user's prompt to ensure better UI generation
     """
-    # Keywords that indicate specific UI elements
-    ui_patterns = {
-        'dashboard': 'with sidebar navigation, header with user profile, main content area with cards and charts',
-        'landing': 'with hero section, features grid, testimonials, pricing section, and footer',
-        'blog': 'with header navigation, article cards in grid layout, sidebar for categories',
-        'ecommerce': 'with product gallery, add to cart functionality, reviews section',
-        'portfolio': 'with projects showcase, about section, contact form, smooth scrolling'
-    }
-    
+    engine = engine or prompt_rule_engine
+
     # Check if description is too short or vague
     if len(description.split()) < 10:
         description += ". Make it modern, responsive, and visually appealing with proper colors and spacing."
-    
-    # Add pattern-specific enhancements
+
     lower_desc = description.lower()
-    for pattern, enhancement in ui_patterns.items():
-        if pattern in lower_desc and enhancement not in lower_desc:
-            description += f" {enhancement}"
-    
+    rules = engine.matching_rules(lower_desc)
+
+    # Add pattern-specific enhancements
+    for rule in rules:
+        if rule['group'] == 'pattern' and rule['append'].lower() not in lower_desc:
+            description += f" {rule['append']}"
+
     # Add technical requirements if not present
-    technical_additions = []
-    
-    if 'responsive' not in lower_desc and 'mobile' not in lower_desc:
-        technical_additions.append("Make it fully responsive for all devices")
-    
-    if 'color' not in lower_desc and 'theme' not in lower_desc:
-        technical_additions.append("Use a modern color scheme with good contrast")
-    
-    if 'navigation' not in lower_desc and 'nav' not in lower_desc and 'menu' not in lower_desc:
-        if any(word in lower_desc for word in ['website', 'site', 'page', 'app']):
-            technical_additions.append("Include proper navigation")
-    
+    technical_additions = [rule['append'] for rule in rules if rule['group'] == 'technical']
     if technical_additions:
         description += ". " + ". ".join(technical_additions)
-    
+
     # Add interaction requirements
-    if 'button' in lower_desc or 'link' in lower_desc or 'tab' in lower_desc:
-        description += ". IMPORTANT: Make all navigation links and tabs work within the page using JavaScript (single-page behavior). Use # anchors or JavaScript to show/hide content instead of loading new pages."
-    
+    for rule in rules:
+        if rule['group'] == 'interaction':
+            description += ". " + rule['append']
+
     return description
 
-@app.route('/generate', methods=['POST'])
-def generate():
-    try:
-        data = request.json
-        description = data.get('description', '')
-        api_key = data.get('api_key', '')
-        enhance_prompt = data.get('enhance_prompt', True)
-        session_id = data.get('session_id', '')
-        
-        if not description:
-            return jsonify({'success': False, 'error': 'No description provided'})
-        
-        if not api_key:
-            return jsonify({'success': False, 'error': 'No API key provided'})
-        
-        # Enhance the prompt if enabled
-        enhanced_description = description
-        if enhance_prompt:
-            enhanced_description = enhance_user_prompt(description)
-        
-        # Generate UI code using Gemini API
-        generated_code = generate_ui_code(enhanced_description, api_key)
-        
-        # Process the generated code to fix navigation issues
-        generated_code = fix_navigation_issues(generated_code)
-        
-        # Store in session
-        if session_id:
-            current_sessions[session_id] = {
-                'code': generated_code,
-                'version': 1,
-                'original_prompt': description
-            }
+# Optional near-duplicate prompt cache in front of generate_ui_code()
+SIMILARITY_CACHE_ENABLED = os.environ.get('SIMILARITY_CACHE_ENABLED', '0') == '1'
+SIMILARITY_CACHE_THRESHOLD = float(os.environ.get('SIMILARITY_CACHE_THRESHOLD', 0.7))
+SIMILARITY_CACHE_SIZE = int(os.environ.get('SIMILARITY_CACHE_SIZE', 1000))
+
+# Words ignored when comparing prompts
+_STOPWORDS = {
+    'a', 'an', 'and', 'the', 'for', 'with', 'of', 'to', 'in', 'on', 'at', 'by',
+    'it', 'its', 'is', 'be', 'that', 'this', 'my', 'our', 'your', 'some', 'me',
+    'make', 'create', 'build', 'design', 'page', 'please',
+}
+_WORD_RE = re.compile(r'[a-z0-9]+')
+_MERSENNE_PRIME = (1 << 61) - 1
+
+class SimilarityCache:
+    """
+    Near-duplicate prompt cache based on MinHash signatures and LSH banding.
+
+    Prompts are reduced to sets of word and word-pair shingles. Candidates
+    sharing at least one LSH band are checked with exact Jaccard similarity,
+    and the best one above the threshold is returned. Runs entirely in
+    process and keeps at most max_entries results (least recently used are
+    dropped first).
+
+    Every entry belongs to a scope (the tenant id of the API key that
+    generated it) and is only matched by lookups in the same scope, so one
+    user's pages are never served to another.
+    """
+
+    def __init__(self, threshold=SIMILARITY_CACHE_THRESHOLD, max_entries=SIMILARITY_CACHE_SIZE,
+                 num_perm=64, bands=16, seed=1):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                             for _ in range(num_perm)]
+        self.entries = OrderedDict()   # entry id -> {'shingles', 'bands', 'prompt', 'result'}
+        self.buckets = {}              # (band index, band hash) -> set of entry ids
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def shingles(text):
+        words = [w for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS]
+        shingles = set(words)
+        shingles.update(' '.join(pair) for pair in zip(words, words[1:]))
+        return shingles
+
+    def _band_keys(self, shingles, scope):
+        hashes = [zlib.crc32(s.encode('utf-8')) for s in shingles] or [0]
+        signature = [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self.permutations]
+        # The scope is part of every bucket key, so other scopes are never candidates
+        return [(scope, band, hash(tuple(signature[band * self.rows:(band + 1) * self.rows])))
+                for band in range(self.bands)]
+
+    def add(self, prompt, result, scope):
+        shingles = self.shingles(prompt)
+        if not shingles:
+            return
+        band_keys = self._band_keys(shingles, scope)
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = {'shingles': shingles, 'bands': band_keys,
+                                      'prompt': prompt, 'result': result}
+            for key in band_keys:
+                self.buckets.setdefault(key, set()).add(entry_id)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def lookup(self, prompt, scope):
+        """
+        Return {'result', 'prompt', 'similarity'} for the most similar stored
+        prompt of this scope above the threshold, or None
+        """
+        shingles = self.shingles(prompt)
+        if not shingles:
+            return None
+        band_keys = self._band_keys(shingles, scope)
+        with self.lock:
+            candidates = set()
+            for key in band_keys:
+                candidates.update(self.buckets.get(key, ()))
+
+            best_id, best_score = None, 0.0
+            for entry_id in candidates:
+                stored = self.entries[entry_id]['shingles']
+                score = len(shingles & stored) / len(shingles | stored)
+                if score > best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None or best_score < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best_id)
+            entry = self.entries[best_id]
+            return {'result': entry['result'], 'prompt': entry['prompt'], 'similarity': round(best_score, 3)}
+
+    def _remove(self, entry_id):
+        entry = self.entries.pop(entry_id)
+        for key in entry['bands']:
+            bucket = self.buckets.get(key)
+            if bucket:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self.buckets[key]
+
+similarity_cache = SimilarityCache()
+
+def find_similar_generation(description, api_key, enhance_prompt=True):
+    """
+    Look up a previous generation of the same API key for a near-duplicate prompt
+    """
+    if not SIMILARITY_CACHE_ENABLED:
+        return None
+    prompt = enhance_user_prompt(description) if enhance_prompt else description
+    return similarity_cache.lookup(prompt, tenant_id(api_key))
+
+# Version history is stored as zlib-compressed snapshots plus line deltas
+# against the most recent snapshot, so any version is one snapshot + one delta
+VERSION_SNAPSHOT_INTERVAL = int(os.environ.get('VERSION_SNAPSHOT_INTERVAL', 20))
+VERSION_SNAPSHOT_RATIO = 0.5
+
+def compute_delta(base, target):
+    """
+    Line-based delta from base to target: a list of [start, end] ranges of
+    base lines to copy and strings to insert
+    """
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, target_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(target_lines[j1:j2]))
+    return ops
+
+def apply_delta(base, ops):
+    base_lines = base.splitlines(keepends=True)
+    return ''.join(''.join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+
+def encode_snapshot(code):
+    return zlib.compress(code.encode('utf-8'))
+
+def decode_snapshot(payload):
+    return zlib.decompress(payload).decode('utf-8')
+
+def encode_version(code, snapshot_code, deltas_since_snapshot):
+    """
+    Encode a new version as a delta against snapshot_code, or as a new
+    snapshot when there is none, the delta chain is long or the delta is
+    not much smaller than a snapshot. Returns (is_snapshot, payload).
+    """
+    snapshot_payload = encode_snapshot(code)
+    if snapshot_code is None or deltas_since_snapshot >= VERSION_SNAPSHOT_INTERVAL:
+        return True, snapshot_payload
+    delta_payload = zlib.compress(json.dumps(compute_delta(snapshot_code, code)).encode('utf-8'))
+    if len(delta_payload) >= VERSION_SNAPSHOT_RATIO * len(snapshot_payload):
+        return True, snapshot_payload
+    return False, delta_payload
+
+def decode_version(payload, snapshot_code):
+    """Rebuild a version from its payload and (for deltas) its snapshot"""
+    if snapshot_code is None:
+        return decode_snapshot(payload)
+    return apply_delta(snapshot_code, json.loads(zlib.decompress(payload)))
+
+class VersionHistory:
+    """
+    In-memory version history of one session
+    """
+
+    def __init__(self):
+        self.entries = []           # one dict per version, in order
+        self.snapshot_version = None
+        self.deltas_since_snapshot = 0
+
+    def add(self, code, prompt, meta=None):
+        snapshot_code = None
+        if self.snapshot_version is not None:
+            snapshot_code = decode_snapshot(self.entries[self.snapshot_version - 1]['payload'])
+        is_snapshot, payload = encode_version(code, snapshot_code, self.deltas_since_snapshot)
+
+        version = len(self.entries) + 1
+        if is_snapshot:
+            self.snapshot_version = version
+            self.deltas_since_snapshot = 0
+        else:
+            self.deltas_since_snapshot += 1
+        self.entries.append({
+            'version': version,
+            'base': None if is_snapshot else self.snapshot_version,
+            'payload': payload,
+            'prompt': prompt,
+            'created_at': time.time(),
+            'meta': meta or {},
+        })
+        return version
+
+    def checkout(self, version):
+        if not 1 <= version <= len(self.entries):
+            return None
+        entry = self.entries[version - 1]
+        snapshot_code = None
+        if entry['base'] is not None:
+            snapshot_code = decode_snapshot(self.entries[entry['base'] - 1]['payload'])
+        return decode_version(entry['payload'], snapshot_code)
+
+    def list(self):
+        return [{'version': e['version'], 'prompt': e['prompt'], 'created_at': e['created_at'],
+                 'meta': dict(e['meta']), 'size': len(e['payload']), 'snapshot': e['base'] is None}
+                for e in self.entries]
+
+class MemorySessionStore:
+    """
+    Process-local session store. Fast, but sessions are lost on restart and
+    are not shared between worker processes.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, session_id):
+        """Return the session (code, version, original_prompt, last_access) or None"""
+        with self.lock:
+            session_data = self.sessions.get(session_id)
+            if not session_data:
+                return None
+            return {k: session_data[k] for k in ('code', 'version', 'original_prompt', 'last_access')}
+
+    def create_session(self, session_id, code, original_prompt, meta=None):
+        """Start (or restart) a session with its first version"""
+        history = VersionHistory()
+        history.add(code, original_prompt, meta)
+        with self.lock:
+            self.sessions[session_id] = {
+                'code': code,
+                'version': 1,
+                'original_prompt': original_prompt,
+                'last_access': time.time(),
+                'history': history,
+            }
+        return 1
+
+    def add_version(self, session_id, code, prompt, meta=None):
+        """Store a new version of a session and return its number, or None if the session is unknown"""
+        with self.lock:
+            session_data = self.sessions.get(session_id)
+            if session_data is None:
+                return None
+            session_data['version'] = session_data['history'].add(code, prompt, meta)
+            session_data['code'] = code
+            session_data['last_access'] = time.time()
+            return session_data['version']
+
+    def get_version(self, session_id, version):
+        """Return the code of any stored version, or None"""
+        with self.lock:
+            session_data = self.sessions.get(session_id)
+            if not session_data:
+                return None
+            if version == session_data['version']:
+                return session_data['code']
+            return session_data['history'].checkout(version)
+
+    def list_versions(self, session_id):
+        with self.lock:
+            session_data = self.sessions.get(session_id)
+            return session_data['history'].list() if session_data else []
+
+    def touch(self, session_id):
+        with self.lock:
+            if session_id in self.sessions:
+                self.sessions[session_id]['last_access'] = time.time()
+
+    def evict_idle(self, cutoff):
+        """Delete sessions last used before cutoff and return their ids"""
+        with self.lock:
+            evicted = [sid for sid, s in self.sessions.items() if s['last_access'] < cutoff]
+            for session_id in evicted:
+                del self.sessions[session_id]
+        return evicted
+
+    def session_ids(self):
+        with self.lock:
+            return list(self.sessions)
+
+class SQLiteSessionStore:
+    """
+    Persistent session and version store shared by all worker processes.
+
+    Uses SQLite in WAL mode so readers never block the single writer, one
+    connection per thread, and fixed parameterised statements that sqlite3
+    keeps prepared in its statement cache. Every version is stored as a
+    snapshot or a delta against the session's latest snapshot. A new version
+    and the session update are written in one transaction, and last-access
+    updates are buffered and flushed in batches.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        code TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        original_prompt TEXT,
+        snapshot_version INTEGER NOT NULL,
+        deltas_since_snapshot INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        last_access REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS versions (
+        session_id TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        base_version INTEGER,
+        payload BLOB NOT NULL,
+        prompt TEXT,
+        created_at REAL NOT NULL,
+        meta TEXT,
+        PRIMARY KEY (session_id, version)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access);
+    """
+
+    SELECT_SESSION = 'SELECT code, version, original_prompt, last_access FROM sessions WHERE id = ?'
+    SELECT_SNAPSHOT = ('SELECT s.version, s.snapshot_version, s.deltas_since_snapshot, v.payload '
+                       'FROM sessions s JOIN versions v ON v.session_id = s.id AND v.version = s.snapshot_version '
+                       'WHERE s.id = ?')
+    DELETE_SESSION_VERSIONS = 'DELETE FROM versions WHERE session_id = ?'
+    UPSERT_SESSION = ('INSERT OR REPLACE INTO sessions (id, code, version, original_prompt, snapshot_version, '
+                      'deltas_since_snapshot, created_at, last_access) VALUES (?, ?, 1, ?, 1, 0, ?, ?)')
+    BUMP_SESSION = ('UPDATE sessions SET code = ?, version = version + 1, last_access = ?, '
+                    'snapshot_version = CASE WHEN ? THEN version + 1 ELSE snapshot_version END, '
+                    'deltas_since_snapshot = CASE WHEN ? THEN 0 ELSE deltas_since_snapshot + 1 END '
+                    'WHERE id = ? AND version = ? RETURNING version')
+    INSERT_VERSION = ('INSERT INTO versions (session_id, version, base_version, payload, prompt, created_at, meta) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?)')
+    SELECT_VERSION = 'SELECT base_version, payload FROM versions WHERE session_id = ? AND version = ?'
+    SELECT_PAYLOAD = 'SELECT payload FROM versions WHERE session_id = ? AND version = ?'
+    LIST_VERSIONS = ('SELECT version, prompt, created_at, meta, length(payload), base_version IS NULL '
+                     'FROM versions WHERE session_id = ? ORDER BY version')
+    TOUCH_SESSION = 'UPDATE sessions SET last_access = MAX(last_access, ?) WHERE id = ?'
+    SELECT_IDLE = 'SELECT id FROM sessions WHERE last_access < ?'
+    DELETE_SESSION = 'DELETE FROM sessions WHERE id = ?'
+    SELECT_IDS = 'SELECT id FROM sessions'
+
+    def __init__(self, path, touch_batch_size=50, touch_flush_seconds=5.0):
+        self.path = path
+        self.local = threading.local()
+        self.pending_touches = {}
+        self.touch_batch_size = touch_batch_size
+        self.touch_flush_seconds = touch_flush_seconds
+        self.last_flush = time.time()
+        self.touch_lock = threading.Lock()
+        connection = self._connection()
+        connection.executescript(self.SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, cached_statements=64)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('PRAGMA busy_timeout=30000')
+            self.local.connection = connection
+        return connection
+
+    def _write(self, statements):
+        """Run (sql, params) pairs in a single immediate transaction"""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            results = [connection.execute(sql, params).fetchall() for sql, params in statements]
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return results
+
+    def get_session(self, session_id):
+        row = self._connection().execute(self.SELECT_SESSION, (session_id,)).fetchone()
+        if row is None:
+            return None
+        code, version, original_prompt, last_access = row
+        with self.touch_lock:
+            last_access = max(last_access, self.pending_touches.get(session_id, 0))
+        return {'code': code, 'version': version, 'original_prompt': original_prompt,
+                'last_access': last_access}
+
+    def create_session(self, session_id, code, original_prompt, meta=None):
+        now = time.time()
+        self._write([
+            (self.DELETE_SESSION_VERSIONS, (session_id,)),
+            (self.UPSERT_SESSION, (session_id, code, original_prompt, now, now)),
+            (self.INSERT_VERSION, (session_id, 1, None, encode_snapshot(code), original_prompt, now,
+                                   json.dumps(meta or {}))),
+        ])
+        return 1
+
+    def add_version(self, session_id, code, prompt, meta=None):
+        connection = self._connection()
+        # Encode outside the write transaction; retry if another worker
+        # added a version in the meantime
+        for _ in range(5):
+            row = connection.execute(self.SELECT_SNAPSHOT, (session_id,)).fetchone()
+            if row is None:
+                return None
+            current_version, snapshot_version, deltas_since_snapshot, snapshot_payload = row
+            is_snapshot, payload = encode_version(code, decode_snapshot(snapshot_payload), deltas_since_snapshot)
+
+            now = time.time()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                bumped = connection.execute(self.BUMP_SESSION, (
+                    code, now, is_snapshot, is_snapshot, session_id, current_version)).fetchone()
+                if bumped is None:
+                    connection.execute('ROLLBACK')
+                    continue
+                connection.execute(self.INSERT_VERSION, (
+                    session_id, bumped[0], None if is_snapshot else snapshot_version, payload,
+                    prompt, now, json.dumps(meta or {})))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            return bumped[0]
+        raise RuntimeError(f'Could not add a version to session {session_id}: too many concurrent writers')
+
+    def get_version(self, session_id, version):
+        connection = self._connection()
+        row = connection.execute(self.SELECT_VERSION, (session_id, version)).fetchone()
+        if row is None:
+            return None
+        base_version, payload = row
+        snapshot_code = None
+        if base_version is not None:
+            snapshot = connection.execute(self.SELECT_PAYLOAD, (session_id, base_version)).fetchone()
+            snapshot_code = decode_snapshot(snapshot[0])
+        return decode_version(payload, snapshot_code)
+
+    def list_versions(self, session_id):
+        rows = self._connection().execute(self.LIST_VERSIONS, (session_id,)).fetchall()
+        return [{'version': v, 'prompt': p, 'created_at': c, 'meta': json.loads(m or '{}'),
+                 'size': size, 'snapshot': bool(snapshot)}
+                for v, p, c, m, size, snapshot in rows]
+
+    def touch(self, session_id):
+        now = time.time()
+        with self.touch_lock:
+            self.pending_touches[session_id] = now
+            due = (len(self.pending_touches) >= self.touch_batch_size
+                   or now - self.last_flush >= self.touch_flush_seconds)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write buffered last-access updates with one executemany"""
+        with self.touch_lock:
+            pending, self.pending_touches = self.pending_touches, {}
+            self.last_flush = time.time()
+        if pending:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany(self.TOUCH_SESSION, [(t, sid) for sid, t in pending.items()])
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+
+    def evict_idle(self, cutoff):
+        self.flush()
+        connection = self._connection()
+        evicted = [row[0] for row in connection.execute(self.SELECT_IDLE, (cutoff,))]
+        if evicted:
+            statements = []
+            for session_id in evicted:
+                statements.append((self.DELETE_SESSION, (session_id,)))
+                statements.append((self.DELETE_SESSION_VERSIONS, (session_id,)))
+            self._write(statements)
+        return evicted
+
+    def session_ids(self):
+        return [row[0] for row in self._connection().execute(self.SELECT_IDS)]
+
+def create_session_store(backend=None, path=None):
+    """
+    Create the session store selected by SESSION_STORE ('memory' or 'sqlite')
+    """
+    backend = backend or SESSION_STORE
+    if backend == 'sqlite':
+        return SQLiteSessionStore(path or SESSION_DB_PATH)
+    return MemorySessionStore()
+
+session_store = create_session_store()
+
+# Full-text index of saved generations (SQLite FTS5)
+GALLERY_DB_PATH = os.environ.get('GALLERY_DB_PATH', 'gallery.db')
+GALLERY_MAX_TEXT_CHARS = 20000
+
+class _PageTextExtractor(HTMLParser):
+    """
+    Collects the title and visible text of a page, skipping scripts and styles
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.title = []
+        self.text = []
+        self.skip_depth = 0
+        self.in_title = False
+        self.length = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.skip_depth += 1
+        elif tag == 'title':
+            self.in_title = True
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag == 'title':
+            self.in_title = False
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        data = data.strip()
+        if not data:
+            return
+        if self.in_title:
+            self.title.append(data)
+        elif self.length < GALLERY_MAX_TEXT_CHARS:
+            self.text.append(data)
+            self.length += len(data) + 1
+
+def extract_page_text(html_code):
+    """
+    Return (title, visible text) of a page for indexing
+    """
+    extractor = _PageTextExtractor()
+    extractor.feed(html_code)
+    extractor.close()
+    return ' '.join(extractor.title), ' '.join(extractor.text)[:GALLERY_MAX_TEXT_CHARS]
+
+# Gallery owner of pre-warmed example pages, which every tenant may reuse
+SHARED_GALLERY_TENANT = 'shared'
+
+class GalleryIndex:
+    """
+    Index of every saved generation, searchable with SQLite FTS5.
+
+    Rows are added when a file is saved, so listing and searching never
+    scan UPLOAD_FOLDER. Every row belongs to the tenant (API key
+    fingerprint) that generated it and is only listed to that tenant;
+    pre-warmed pages belong to SHARED_GALLERY_TENANT and are listed to
+    everyone. Rows indexed without a tenant are listed to no one.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS generations (
+        id INTEGER PRIMARY KEY,
+        filename TEXT NOT NULL UNIQUE,
+        created_at REAL NOT NULL,
+        kind TEXT NOT NULL,
+        session_id TEXT,
+        version INTEGER,
+        prompt TEXT,
+        enhanced_prompt TEXT,
+        title TEXT,
+        size INTEGER NOT NULL,
+        last_access REAL NOT NULL DEFAULT 0,
+        tenant TEXT
+    );
+    CREATE INDEX IF NOT EXISTS generations_created_at ON generations (created_at);
+    CREATE INDEX IF NOT EXISTS generations_tenant ON generations (tenant, created_at);
+    CREATE INDEX IF NOT EXISTS generations_latest ON generations (kind, enhanced_prompt, created_at);
+    CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5(
+        prompt, enhanced_prompt, title, body, tokenize = 'porter unicode61'
+    );
+    """
+
+    INSERT_GENERATION = ('INSERT OR REPLACE INTO generations (filename, created_at, kind, session_id, version, '
+                         'prompt, enhanced_prompt, title, size, last_access, tenant) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING id')
+    DELETE_FTS = 'DELETE FROM generations_fts WHERE rowid = (SELECT id FROM generations WHERE filename = ?)'
+    INSERT_FTS = 'INSERT INTO generations_fts (rowid, prompt, enhanced_prompt, title, body) VALUES (?, ?, ?, ?, ?)'
+    SEARCH = ('SELECT g.filename, g.created_at, g.kind, g.prompt, g.title, g.size, '
+              "snippet(generations_fts, -1, '[', ']', '…', 12) "
+              'FROM generations_fts JOIN generations g ON g.id = generations_fts.rowid '
+              'WHERE generations_fts MATCH ? AND g.tenant IN (?, ?) '
+              'ORDER BY bm25(generations_fts, 4.0, 1.0, 3.0, 1.0) LIMIT ?')
+    RECENT = ('SELECT filename, created_at, kind, prompt, title, size, NULL '
+              'FROM generations WHERE tenant IN (?, ?) ORDER BY created_at DESC LIMIT ?')
+    SELECT_ONE = ('SELECT filename, created_at, kind, prompt, enhanced_prompt, title, size, tenant '
+                  'FROM generations WHERE filename = ?')
+    SELECT_LATEST = ('SELECT filename, created_at FROM generations WHERE kind = ? AND enhanced_prompt = ? '
+                     'ORDER BY created_at DESC LIMIT 1')
+    TOUCH = 'UPDATE generations SET last_access = ? WHERE filename = ?'
+    TOTAL_SIZE = 'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM generations'
+    LEAST_RECENTLY_USED = ('SELECT filename, created_at, last_access, size, session_id '
+                           'FROM generations ORDER BY last_access LIMIT ?')
+    DELETE_ONE = 'DELETE FROM generations WHERE filename = ?'
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        connection = self._connection()
+        columns = {row[1] for row in connection.execute('PRAGMA table_info(generations)')}
+        if columns and 'last_access' not in columns:
+            # Indexes created before retention tracking
+            connection.execute('ALTER TABLE generations ADD COLUMN last_access REAL NOT NULL DEFAULT 0')
+            connection.execute('UPDATE generations SET last_access = created_at')
+        if columns and 'tenant' not in columns:
+            # Indexes created before tenant scoping; their rows stay unlisted
+            connection.execute('ALTER TABLE generations ADD COLUMN tenant TEXT')
+        connection.executescript(self.SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def add(self, filename, code, kind, prompt=None, enhanced_prompt=None, session_id=None, version=None,
+            created_at=None, tenant=None):
+        """Index one saved file (replacing any previous entry with the same name)"""
+        title, text = extract_page_text(code)
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(self.DELETE_FTS, (filename,))
+            now = time.time() if created_at is None else created_at
+            row_id = connection.execute(self.INSERT_GENERATION, (
+                filename, now, kind, session_id, version, prompt, enhanced_prompt, title,
+                len(code.encode('utf-8')), now, tenant)).fetchone()[0]
+            connection.execute(self.INSERT_FTS, (row_id, prompt or '', enhanced_prompt or '', title, text))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _match_query(query):
+        # Quote every word so user input can never be parsed as FTS5 syntax,
+        # and let the last one match as a prefix while typing
+        words = re.findall(r'\w+', query.lower())
+        if not words:
+            return None
+        terms = [f'"{w}"' for w in words]
+        terms[-1] += '*'
+        return ' '.join(terms)
+
+    def search(self, query, tenant, limit=20):
+        """
+        Return a tenant's matching generations (plus shared ones), best
+        first; the most recent when query is empty
+        """
+        match = self._match_query(query or '')
+        connection = self._connection()
+        if match:
+            rows = connection.execute(self.SEARCH, (match, tenant, SHARED_GALLERY_TENANT, limit)).fetchall()
+        else:
+            rows = connection.execute(self.RECENT, (tenant, SHARED_GALLERY_TENANT, limit)).fetchall()
+        return [{'filename': f, 'created_at': c, 'kind': k, 'prompt': p, 'title': t, 'size': s, 'snippet': sn}
+                for f, c, k, p, t, s, sn in rows]
+
+    def get(self, filename):
+        row = self._connection().execute(self.SELECT_ONE, (filename,)).fetchone()
+        if row is None:
+            return None
+        keys = ('filename', 'created_at', 'kind', 'prompt', 'enhanced_prompt', 'title', 'size', 'tenant')
+        return dict(zip(keys, row))
+
+    def get_for(self, filename, tenant):
+        """Return an entry if the tenant may see it, or None"""
+        item = self.get(filename)
+        if item is None or item['tenant'] not in (tenant, SHARED_GALLERY_TENANT):
+            return None
+        return item
+
+    def latest(self, kind, enhanced_prompt):
+        """Return the newest generation of a kind for an exact enhanced prompt"""
+        row = self._connection().execute(self.SELECT_LATEST, (kind, enhanced_prompt)).fetchone()
+        return {'filename': row[0], 'created_at': row[1]} if row else None
+
+    def touch(self, filename):
+        self._connection().execute(self.TOUCH, (time.time(), filename))
+
+    def totals(self):
+        """Return (file count, total bytes) of indexed files"""
+        return self._connection().execute(self.TOTAL_SIZE).fetchone()
+
+    def least_recently_used(self, limit):
+        rows = self._connection().execute(self.LEAST_RECENTLY_USED, (limit,)).fetchall()
+        return [{'filename': f, 'created_at': c, 'last_access': a, 'size': s, 'session_id': sid}
+                for f, c, a, s, sid in rows]
+
+    def remove(self, filename):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(self.DELETE_FTS, (filename,))
+            connection.execute(self.DELETE_ONE, (filename,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+gallery_index = GalleryIndex(GALLERY_DB_PATH)
+
+def sharded_ui_file_path(filename):
+    """
+    Return where a saved page is stored in the sharded layout
+    """
+    shard = hashlib.sha1(filename.encode('utf-8')).hexdigest()[:2]
+    return os.path.join(app.config['UPLOAD_FOLDER'], shard, filename)
+
+def ui_file_path(filename):
+    """
+    Return the path of a saved page. Files are sharded into 256
+    subdirectories by a hash of their name to keep directories small;
+    files saved before sharding are still found at the top level.
+    """
+    path = sharded_ui_file_path(filename)
+    if not os.path.exists(path):
+        legacy_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        if os.path.exists(legacy_path):
+            return legacy_path
+    return path
+
+def save_ui_file(code, prefix):
+    """
+    Write a generated page to UPLOAD_FOLDER and return its filename
+    """
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    filename = f'{prefix}_{timestamp}_{secrets.token_hex(3)}.html'
+    filepath = ui_file_path(filename)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    
+    with open(filepath, 'w', encoding='utf-8') as f:
+        f.write(code)
+    return filename
+
+def read_ui_file(filename):
+    """
+    Read a saved page by its indexed filename, or return None
+    """
+    if not gallery_index.get(filename):
+        return None
+    filepath = ui_file_path(filename)
+    if not os.path.exists(filepath):
+        return None
+    gallery_index.touch(filename)
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return f.read()
+
+# Disk retention for UPLOAD_FOLDER; 0 disables a limit
+RETENTION_MAX_BYTES = int(os.environ.get('RETENTION_MAX_BYTES', 0))
+RETENTION_MAX_AGE_DAYS = float(os.environ.get('RETENTION_MAX_AGE_DAYS', 0))
+RETENTION_INTERVAL_SECONDS = int(os.environ.get('RETENTION_INTERVAL_SECONDS', 600))
+
+class RetentionManager:
+    """
+    Garbage-collects saved pages to keep UPLOAD_FOLDER under a byte budget
+    and an age limit.
+
+    Files are visited least recently used first (creation and every read
+    through read_ui_file() count as use), and files unused for longer than
+    the age limit are deleted even under budget. Files that belong to a live
+    session, or are referenced by any of its versions, are never deleted.
+
+    Live sessions are read from the session store, so retention only runs
+    with SESSION_STORE=sqlite: the memory store only knows the sessions of
+    its own worker process and would let pages of other workers' sessions
+    be deleted.
+    """
+
+    def __init__(self, index, max_bytes=RETENTION_MAX_BYTES, max_age_days=RETENTION_MAX_AGE_DAYS,
+                 interval_seconds=RETENTION_INTERVAL_SECONDS, batch_size=500):
+        self.index = index
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self.last_report = None
+        self.total_reclaimed = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def configured(self):
+        return bool(self.max_bytes or self.max_age_seconds)
+
+    @property
+    def enabled(self):
+        return self.configured and not isinstance(session_store, MemorySessionStore)
+
+    def _protected(self):
+        live_sessions = set(session_store.session_ids())
+        referenced = set()
+        for session_id in live_sessions:
+            for version in session_store.list_versions(session_id):
+                filename = version['meta'].get('filename')
+                if filename:
+                    referenced.add(filename)
+        return live_sessions, referenced
+
+    def backfill(self):
+        """
+        Index and shard pages saved at the top of UPLOAD_FOLDER before the
+        gallery index existed, so the budget counts them and they age out
+        like any other file. Their modification time counts as last use.
+        """
+        folder = app.config['UPLOAD_FOLDER']
+        moved = 0
+        with self.lock:
+            for entry in os.scandir(folder):
+                if not entry.is_file() or not entry.name.endswith('.html'):
+                    continue
+                filename = entry.name
+                if not self.index.get(filename):
+                    with open(entry.path, 'r', encoding='utf-8', errors='replace') as f:
+                        code = f.read()
+                    kind = 'refine' if filename.startswith('ui_refined') else 'generate'
+                    self.index.add(filename, code, kind, created_at=entry.stat().st_mtime)
+                target = sharded_ui_file_path(filename)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                for source, destination in ((entry.path, target), (entry.path + '.gz', target + '.gz')):
+                    if os.path.exists(source):
+                        os.replace(source, destination)
+                moved += 1
+        if moved:
+            app.logger.info('Retention indexed and sharded %d legacy files', moved)
+        return moved
+
+    def run_once(self):
+        """Delete files until both limits hold and return a report"""
+        if isinstance(session_store, MemorySessionStore):
+            raise RuntimeError('Retention needs SESSION_STORE=sqlite to see the sessions of every worker')
+        with self.lock:
+            start = time.perf_counter()
+            live_sessions, referenced = self._protected()
+            file_count, total_bytes = self.index.totals()
+            age_cutoff = time.time() - self.max_age_seconds if self.max_age_seconds else None
+            deleted = reclaimed = skipped = 0
+
+            for item in self.index.least_recently_used(file_count):
+                over_budget = self.max_bytes and total_bytes > self.max_bytes
+                expired = age_cutoff is not None and item['last_access'] < age_cutoff
+                if not over_budget and not expired:
+                    # Everything after this entry was used more recently
+                    break
+                if item['session_id'] in live_sessions or item['filename'] in referenced:
+                    skipped += 1
+                    continue
+
+                filepath = ui_file_path(item['filename'])
+                for path in (filepath, filepath + '.gz'):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                self.index.remove(item['filename'])
+                deleted += 1
+                reclaimed += item['size']
+                total_bytes -= item['size']
+
+            self.total_reclaimed += reclaimed
+            self.last_report = {
+                'deleted_files': deleted,
+                'reclaimed_bytes': reclaimed,
+                'protected_files': skipped,
+                'remaining_files': file_count - deleted,
+                'remaining_bytes': total_bytes,
+                'total_reclaimed_bytes': self.total_reclaimed,
+                'duration_ms': round((time.perf_counter() - start) * 1000, 2),
+                'finished_at': time.time(),
+            }
+        if deleted:
+            app.logger.info('Retention removed %d files, reclaimed %d bytes', deleted, reclaimed)
+        return self.last_report
+
+    def start(self):
+        """Run the collector periodically in a daemon thread"""
+        if self.configured and not self.enabled:
+            app.logger.warning('Retention limits are set but SESSION_STORE is memory; '
+                               'not deleting pages, since sessions of other workers are unknown')
+        if not self.enabled or self.thread:
+            return
+
+        def loop():
+            try:
+                self.backfill()
+            except Exception as e:
+                app.logger.warning('Retention backfill failed: %s', e)
+            while True:
+                try:
+                    self.run_once()
+                except Exception as e:
+                    app.logger.warning('Retention run failed: %s', e)
+                time.sleep(self.interval_seconds)
+
+        self.thread = threading.Thread(target=loop, name='retention-manager', daemon=True)
+        self.thread.start()
+
+retention_manager = RetentionManager(gallery_index)
+
+def evict_expired_sessions():
+    """
+    Drop sessions that have been idle longer than SESSION_TTL_SECONDS,
+    together with their cached model context
+    """
+    for session_id in session_store.evict_idle(time.time() - SESSION_TTL_SECONDS):
+        context_cache.evict(session_id)
+        speculator.forget(session_id)
+
+# Pre-generation of the example prompts and pattern categories with a service key
+PREWARM_API_KEY = os.environ.get('PREWARM_API_KEY', '')
+PREWARM_INTERVAL_SECONDS = int(os.environ.get('PREWARM_INTERVAL_SECONDS', 24 * 60 * 60))
+
+class Prewarmer:
+    """
+    Generates the built-in example prompts and one page per pattern
+    category in the background, so the first click on an example returns
+    at once instead of waiting for a cold generation.
+
+    Pages are keyed by their enhanced prompt, so only requests with prompt
+    enhancement on (the default) are served from them. They are saved like
+    any other generation (kind 'prewarm') and reloaded from the gallery
+    after a restart while younger than PREWARM_INTERVAL_SECONDS. With an interval
+    set, the pages are regenerated that often.
+
+    Only one process per deployment warms pages; the others find them in
+    the shared gallery index on their first lookup.
+    """
+
+    def __init__(self, api_key=PREWARM_API_KEY, interval_seconds=PREWARM_INTERVAL_SECONDS):
+        self.api_key = api_key
+        self.interval_seconds = interval_seconds
+        self.entries = {}
+        self.last_report = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.api_key)
+
+    def prompts(self):
+        """Return (name, description) pairs to pre-generate"""
+        prompts = list(EXAMPLE_PROMPTS.items())
+        for rule in prompt_rule_engine.rules:
+            if rule['group'] == 'pattern':
+                prompts.append((f"pattern:{rule['name']}", f"Create a modern {rule['name']} page"))
+        return prompts
+
+    def _fresh(self, created_at):
+        # Without an interval pages never expire
+        return not self.interval_seconds or time.time() - created_at < self.interval_seconds
+
+    def _load(self, enhanced_description):
+        """Load the newest fresh page for a prompt from the gallery, or return None"""
+        existing = gallery_index.latest('prewarm', enhanced_description)
+        if not existing or not self._fresh(existing['created_at']):
+            return None
+        code = read_ui_file(existing['filename'])
+        if code is None:
+            return None
+        self._store(enhanced_description, code, existing['filename'], existing['created_at'])
+        return self.entries[enhanced_description]
+
+    def lookup(self, enhanced_description):
+        with self.lock:
+            entry = self.entries.get(enhanced_description)
+        if entry and self._fresh(entry['created_at']):
+            return entry
+        if not self.enabled:
+            return None
+        # Pages warmed by the process holding the background lock
+        return self._load(enhanced_description)
+
+    def _store(self, enhanced_description, code, filename, created_at):
+        with self.lock:
+            self.entries[enhanced_description] = {'code': code, 'filename': filename, 'created_at': created_at}
+
+    def warm(self, description, force=False):
+        """Generate (or reload) one prompt and return what happened"""
+        enhanced_description = enhance_user_prompt(description)
+        if not force and self._load(enhanced_description):
+            return 'loaded'
+        
+        # Pre-warming only uses capacity no user request is waiting for
+        code = admission_controller.run(PRIORITY_SPECULATIVE, 'prewarm', CancellationToken(),
+                                        generate_ui_code, enhanced_description, self.api_key)
+        if GENERATION_ERROR_TITLE in code:
+            return 'failed'
+        code = fix_navigation_issues(code)
+        filename = save_ui_file(code, 'ui_prewarm')
+        gallery_index.add(filename, code, 'prewarm', description, enhanced_description, None, None,
+                          tenant=SHARED_GALLERY_TENANT)
+        self._store(enhanced_description, code, filename, time.time())
+        return 'generated'
+
+    def run_once(self, force=False):
+        report = {'generated': 0, 'loaded': 0, 'failed': 0}
+        for name, description in self.prompts():
+            try:
+                report[self.warm(description, force)] += 1
+            except Exception as e:
+                app.logger.warning('Pre-warming %s failed: %s', name, e)
+                report['failed'] += 1
+        report['finished_at'] = time.time()
+        self.last_report = report
+        app.logger.info('Pre-warmed examples: %s', report)
+        return report
+
+    def start(self):
+        """Warm in a daemon thread now and then every interval"""
+        if not self.enabled or self.thread:
+            return
+
+        def loop():
+            force = False
+            while True:
+                self.run_once(force)
+                if not self.interval_seconds:
+                    break
+                time.sleep(self.interval_seconds)
+                force = True
+
+        self.thread = threading.Thread(target=loop, name='prewarmer', daemon=True)
+        self.thread.start()
+
+prewarmer = Prewarmer()
+
+# Background jobs run in one process per deployment: the one holding this lock
+BACKGROUND_LOCK_FILE = os.path.join(UPLOAD_FOLDER, '.background.lock')
+BACKGROUND_RETRY_SECONDS = 60
+
+class BackgroundWorkers:
+    """
+    Starts the background jobs once per deployment, not once per process.
+
+    Under gunicorn every worker process imports the app, and the debug
+    reloader runs it in a parent and a child process. The first process to
+    take an exclusive lock on BACKGROUND_LOCK_FILE runs the jobs and holds
+    the lock until it exits; the others try again every
+    BACKGROUND_RETRY_SECONDS so a replacement takes over when it dies.
+    """
+
+    def __init__(self, lock_path=BACKGROUND_LOCK_FILE, retry_seconds=BACKGROUND_RETRY_SECONDS):
+        self.lock_path = lock_path
+        self.retry_seconds = retry_seconds
+        self.lock_file = None
+        self.started = False
+        self.next_attempt = 0
+        self.lock = threading.Lock()
+
+    def _take_lock(self):
+        if fcntl is None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # Kept open for the life of the process
+        self.lock_file = lock_file
+        return True
+
+    def ensure_started(self):
+        """Start the jobs here if no other process runs them; returns whether this process does"""
+        if self.started or time.monotonic() < self.next_attempt:
+            return self.started
+        with self.lock:
+            if self.started:
+                return True
+            if not self._take_lock():
+                self.next_attempt = time.monotonic() + self.retry_seconds
+                return False
+            self.started = True
+        
+        # Garbage-collect saved pages if limits are set
+        retention_manager.start()
+        
+        # Pre-generate the example prompts if a service key is configured
+        prewarmer.start()
+        return True
+
+background_workers = BackgroundWorkers()
+
+@app.before_request
+def start_background_workers():
+    # Covers WSGI servers, where the __main__ block below never runs
+    background_workers.ensure_started()
+
+def overloaded_response(error):
+    """503 response telling the client when to retry"""
+    response = jsonify({'success': False, 'overloaded': True, 'retry_after': error.retry_after,
+                        'error': f'{error} - please retry in {error.retry_after} seconds'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+@app.route('/generate', methods=['POST'])
+def generate():
+    token = None
+    try:
+        data = request.json
+        description = data.get('description', '')
+        api_key = data.get('api_key', '')
+        enhance_prompt = data.get('enhance_prompt', True)
+        session_id = data.get('session_id', '')
+        reuse_similar = data.get('reuse_similar', False)
+        fresh = data.get('fresh', False)
+        parallel_sections = data.get('parallel_sections', PARALLEL_SECTIONS_ENABLED)
+        
+        if not description:
+            return jsonify({'success': False, 'error': 'No description provided'})
+        
+        if not api_key:
+            return jsonify({'success': False, 'error': 'No API key provided'})
+        
+        evict_expired_sessions()
+        if session_id:
+            speculator.cancel_session(session_id)
+        
+        # Enhance the prompt if enabled
+        enhanced_description = description
+        if enhance_prompt:
+            enhanced_description = enhance_user_prompt(description)
+        
+        # Pre-generated examples are served at once unless a fresh page is requested
+        prewarmed = None if fresh else prewarmer.lookup(enhanced_description)
+        
+        # Serve a stored result for a near-duplicate prompt if requested
+        similar = None
+        if SIMILARITY_CACHE_ENABLED and reuse_similar and not prewarmed:
+            similar = similarity_cache.lookup(enhanced_description, tenant_id(api_key))
+        
+        if prewarmed:
+            generated_code = prewarmed['code']
+        elif similar:
+            generated_code = similar['result']
+        else:
+            # Generate UI code using Gemini API, cancelled if the client leaves
+            token = in_flight_requests.begin(session_id)
+            generate_fn = generate_ui_code_parallel if parallel_sections else generate_ui_code
+            generated_code = admission_controller.run(PRIORITY_GENERATE, tenant_id(api_key, session_id), token,
+                                                      generate_fn, enhanced_description, api_key,
+                                                      slots=PARALLEL_SECTION_WORKERS if parallel_sections else 1)
+            
+            # Process the generated code to fix navigation issues
+            generated_code = fix_navigation_issues(generated_code)
+            token.raise_if_cancelled()
+            
+            if SIMILARITY_CACHE_ENABLED and GENERATION_ERROR_TITLE not in generated_code:
+                similarity_cache.add(enhanced_description, generated_code, tenant_id(api_key))
         
-        # Save the generated code
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f'ui_{timestamp}.html'
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        if prewarmed and gallery_index.get(prewarmed['filename']):
+            # Pre-generated pages are already saved and indexed
+            filename = prewarmed['filename']
+        else:
+            # Save the generated code and add it to the searchable gallery
+            filename = save_ui_file(generated_code, 'ui')
+            gallery_index.add(filename, generated_code, 'generate', description,
+                              enhanced_description if enhance_prompt else None, session_id or None, 1,
+                              tenant=tenant_id(api_key))
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(generated_code)
+        # Store in session
+        if session_id:
+            session_store.create_session(session_id, generated_code, description, {'filename': filename})
         
         return jsonify({
             'success': True,
             'code': generated_code,
             'filename': filename,
-            'enhanced_prompt': enhanced_description if enhance_prompt else None
+            'enhanced_prompt': enhanced_description if enhance_prompt else None,
+            'similarity': similar['similarity'] if similar else None,
+            'prewarmed': bool(prewarmed)
+        })
+        
+    except RequestCancelled as e:
+        # Nothing is saved for cancelled requests
+        app.logger.info('Generation cancelled: %s', e)
+        return jsonify({'success': False, 'cancelled': True, 'error': f'Request cancelled: {e}'})
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+    finally:
+        if token is not None:
+            in_flight_requests.end(session_id, token)
+
+@app.route('/similar', methods=['POST'])
+def similar():
+    """Return a stored generation for a near-duplicate prompt, to show as a draft"""
+    try:
+        data = request.json
+        description = data.get('description', '')
+        enhance_prompt = data.get('enhance_prompt', True)
+        api_key = data.get('api_key', '')
+        
+        if not description:
+            return jsonify({'success': False, 'error': 'No description provided'})
+        
+        if not api_key:
+            return jsonify({'success': False, 'error': 'No API key provided'})
+        
+        match = find_similar_generation(description, api_key, enhance_prompt)
+        if not match:
+            return jsonify({'success': True, 'match': None})
+        
+        return jsonify({
+            'success': True,
+            'match': {
+                'code': match['result'],
+                'prompt': match['prompt'],
+                'similarity': match['similarity']
+            }
         })
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-@app.route('/refine', methods=['POST'])
-def refine():
-    """Refine the existing UI based on user feedback"""
-    try:
-        data = request.json
-        current_code = data.get('current_code', '')
-        refinement_prompt = data.get('refinement_prompt', '')
-        api_key = data.get('api_key', '')
-        session_id = data.get('session_id', '')
-        
-        if not current_code:
-            return jsonify({'success': False, 'error': 'No current code provided'})
-        
-        if not refinement_prompt:
-            return jsonify({'success': False, 'error': 'No refinement prompt provided'})
-        
-        if not api_key:
-            return jsonify({'success': False, 'error': 'No API key provided'})
-        
-        # Refine the UI code using Gemini API
-        refined_code = refine_ui_code(current_code, refinement_prompt, api_key)
-        
-        # Process the refined code to fix navigation issues
-        refined_code = fix_navigation_issues(refined_code)
-        
-        # Update session
-        if session_id and session_id in current_sessions:
-            current_sessions[session_id]['code'] = refined_code
-            current_sessions[session_id]['version'] += 1
-        
-        # Save the refined code
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f'ui_refined_{timestamp}.html'
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(refined_code)
-        
-        return jsonify({
-            'success': True,
-            'code': refined_code,
-            'filename': filename
-        })
-        
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+class Speculator:
+    """
+    Pre-runs the most used suggestion chips against a session's current
+    version in the background, at the lowest admission priority.
+
+    Results are kept by (version hash, instruction). A matching /refine is
+    served from them immediately, or waits for a matching speculation that
+    is already calling the model; every other speculation of the session is
+    cancelled as soon as the user sends something new. Each session may
+    start at most SPECULATION_MAX_PER_SESSION speculations.
+    """
+
+    def __init__(self, enabled=SPECULATION_ENABLED, top_n=SPECULATION_TOP_N,
+                 max_per_session=SPECULATION_MAX_PER_SESSION, cache_size=SPECULATION_CACHE_SIZE):
+        self.enabled = enabled
+        self.top_n = top_n
+        self.max_per_session = max_per_session
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.jobs = {}
+        self.started = {}
+        self.uses = {self.normalize(instruction): 0 for _, instruction in SUGGESTED_REFINEMENTS}
+        self.stats = {'started': 0, 'completed': 0, 'cancelled': 0, 'hits': 0}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix='speculate')
+
+    @staticmethod
+    def normalize(instruction):
+        return ' '.join(instruction.lower().split())
+
+    def key(self, code, instruction):
+        return hashlib.sha1(code.encode('utf-8')).hexdigest(), self.normalize(instruction)
+
+    def record_use(self, instruction):
+        """Count a refinement that used a suggestion, to rank suggestions"""
+        instruction = self.normalize(instruction)
+        with self.lock:
+            if instruction in self.uses:
+                self.uses[instruction] += 1
+
+    def top_instructions(self):
+        # Most used first; ties keep the order of the chips
+        instructions = [instruction for _, instruction in SUGGESTED_REFINEMENTS]
+        ranked = sorted(range(len(instructions)), key=lambda i: (-self.uses[self.normalize(instructions[i])], i))
+        return [instructions[i] for i in ranked[:self.top_n]]
+
+    def speculate(self, session_id, api_key):
+        """Start speculations for the session's current version and return their instructions"""
+        stored_session = session_store.get_session(session_id)
+        if not self.enabled or not stored_session:
+            return []
+        code = stored_session['code']
+        started = []
+        with self.lock:
+            for instruction in self.top_instructions():
+                if self.started.get(session_id, 0) >= self.max_per_session:
+                    break
+                key = self.key(code, instruction)
+                if key in self.cache or key in self.jobs:
+                    continue
+                job = {'session_id': session_id, 'version': stored_session['version'], 'token': CancellationToken(),
+                       'running': False}
+                self.jobs[key] = job
+                job['future'] = self.executor.submit(self._run, key, job, code, instruction, api_key)
+                self.started[session_id] = self.started.get(session_id, 0) + 1
+                self.stats['started'] += 1
+                started.append(instruction)
+        return started
+
+    def _run(self, key, job, code, instruction, api_key):
+        compact_code, _ = minify_code_for_prompt(code)
+
+        def refine_speculatively():
+            job['running'] = True
+            # Same session and version as the user's refinement, so they can share a context cache
+            return refine_ui_code(compact_code, instruction, api_key, job['session_id'], job['version'])
+
+        try:
+            refined_code = admission_controller.run(PRIORITY_SPECULATIVE, tenant_id(api_key, job['session_id']),
+                                                    job['token'], refine_speculatively)
+            job['token'].raise_if_cancelled()
+            refined_code = fix_navigation_issues(restore_formatting(code, refined_code))
+            with self.lock:
+                self.cache[key] = refined_code
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                self.stats['completed'] += 1
+            return refined_code
+        except RequestCancelled:
+            with self.lock:
+                self.stats['cancelled'] += 1
+            return None
+        except Exception as e:
+            app.logger.info('Speculative refinement failed: %s', e)
+            return None
+        finally:
+            with self.lock:
+                if self.jobs.get(key) is job:
+                    del self.jobs[key]
+
+    def take(self, session_id, code, instruction):
+        """
+        Return the speculated result for this refinement of this version,
+        or None, and cancel the session's other speculations
+        """
+        if not self.enabled:
+            return None
+        key = self.key(code, instruction)
+        with self.lock:
+            result = self.cache.pop(key, None)
+            job = self.jobs.get(key) if result is None else None
+        if job is not None and job['running']:
+            # Already calling the model; waiting beats starting over
+            try:
+                result = job['future'].result(timeout=REQUEST_DEADLINE_SECONDS or None)
+            except Exception:
+                result = None
+        self.cancel_session(session_id)
+        if result is not None:
+            with self.lock:
+                self.stats['hits'] += 1
+        return result
+
+    def cancel_session(self, session_id):
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job['session_id'] == session_id]
+        for job in jobs:
+            job['token'].cancel('superseded by user input')
+        return len(jobs)
+
+    def forget(self, session_id):
+        self.cancel_session(session_id)
+        with self.lock:
+            self.started.pop(session_id, None)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, enabled=self.enabled, running=len(self.jobs), cached=len(self.cache),
+                        uses=dict(self.uses))
+
+speculator = Speculator()
+
+# Refinements sent while another one of the session is running are merged
+REFINE_COALESCING_ENABLED = os.environ.get('REFINE_COALESCING_ENABLED', '1') == '1'
+MAX_COALESCED_REFINEMENTS = int(os.environ.get('MAX_COALESCED_REFINEMENTS', 8))
+
+def combine_refinement_prompts(prompts):
+    """
+    Merge queued refinement instructions into one prompt
+    """
+    if len(prompts) == 1:
+        return prompts[0]
+    numbered = '\n'.join(f'{index}. {prompt}' for index, prompt in enumerate(prompts, 1))
+    return f'Apply all of these changes, in order:\n{numbered}'
+
+class RefinementCoalescer:
+    """
+    Per-session refinement queue.
+
+    While a refinement of a session runs, later ones wait in a batch. When
+    it finishes, the whole batch runs as one combined refinement on top of
+    its result, so N quick follow-ups cost one round trip instead of N.
+    Element-scoped refinements queue as batches of their own because their
+    target paths can't be merged.
+    """
+
+    def __init__(self, max_batch=MAX_COALESCED_REFINEMENTS):
+        self.max_batch = max_batch
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def _start_next(self, session_id):
+        # Caller holds the lock
+        state = self.sessions[session_id]
+        if state['pending']:
+            state['running'] = state['pending'].popleft()
+            state['running']['start'].set()
+        else:
+            del self.sessions[session_id]
+
+    def submit(self, session_id, item, run_batch):
+        """
+        Queue a refinement ({'prompt', 'target_path'}) and return
+        (result, items) once its batch has run. The first request of each
+        batch calls run_batch(items) for all of them.
+        """
+        mergeable = not item.get('target_path')
+        with self.lock:
+            state = self.sessions.setdefault(session_id, {'running': None, 'pending': deque()})
+            last = state['pending'][-1] if state['pending'] else None
+            if last and last['mergeable'] and mergeable and len(last['items']) < self.max_batch:
+                last['items'].append(item)
+                batch, runner = last, False
+            else:
+                batch = {'items': [item], 'mergeable': mergeable, 'start': threading.Event(),
+                         'done': threading.Event(), 'result': None, 'error': None}
+                state['pending'].append(batch)
+                runner = True
+                if state['running'] is None:
+                    self._start_next(session_id)
+        
+        if runner:
+            batch['start'].wait()
+            try:
+                batch['result'] = run_batch(list(batch['items']))
+            except BaseException as e:
+                batch['error'] = e
+            finally:
+                with self.lock:
+                    self.sessions[session_id]['running'] = None
+                    self._start_next(session_id)
+                batch['done'].set()
+        else:
+            batch['done'].wait()
+        
+        if batch['error'] is not None:
+            raise batch['error']
+        return batch['result'], batch['items']
+
+refinement_coalescer = RefinementCoalescer()
+
+def apply_refinements(items, current_code, api_key, session_id):
+    """
+    Run one refinement for a batch of instructions and store the result
+    """
+    stored_session = session_store.get_session(session_id) if session_id else None
+    version = None
+    if stored_session:
+        session_store.touch(session_id)
+        version = stored_session['version']
+        # Queued refinements build on the latest stored version
+        current_code = stored_session['code']
+    refinement_prompt = combine_refinement_prompts([item['prompt'] for item in items])
+    target_path = items[0]['target_path'] if len(items) == 1 else ''
+    for item in items:
+        speculator.record_use(item['prompt'])
+    
+    # Use a speculative result for this version and instruction if there is one
+    speculated = None
+    if stored_session and not target_path:
+        speculated = speculator.take(session_id, current_code, refinement_prompt)
+    
+    # Model calls are cancelled if the client leaves or a new generation starts;
+    # refinements of live sessions are admitted ahead of new generations
+    token = in_flight_requests.begin(session_id)
+    try:
+        priority = PRIORITY_REFINE if stored_session else PRIORITY_GENERATE
+        tenant = tenant_id(api_key, session_id)
+        if speculated is not None:
+            refined_code = speculated
+            prompt_stats = {'tokens_saved': estimate_tokens(current_code), 'speculative': True}
+        elif target_path:
+            # Scoped refinement of the element picked in the preview
+            refined_code, prompt_stats = admission_controller.run(
+                priority, tenant, token, refine_element_code, current_code, target_path, refinement_prompt, api_key,
+                items[0].get('target_tag', ''), items[0].get('target_text', ''))
+        else:
+            # Compact the current code before it goes into the prompt
+            compact_code, prompt_stats = minify_code_for_prompt(current_code)
+            
+            # Refine the UI code using Gemini API, then put back the original
+            # formatting of the lines the model didn't change
+            refined_code = admission_controller.run(priority, tenant, token, refine_ui_code, compact_code,
+                                                    refinement_prompt, api_key, session_id, version)
+            refined_code = restore_formatting(current_code, refined_code)
+        app.logger.info('Refine prompt compacted: %d tokens saved', prompt_stats['tokens_saved'])
+        
+        # Process the refined code to fix navigation issues
+        refined_code = fix_navigation_issues(refined_code)
+        token.raise_if_cancelled()
+    finally:
+        in_flight_requests.end(session_id, token)
+    
+    # Save the refined code
+    filename = save_ui_file(refined_code, 'ui_refined')
+    
+    # Update session
+    new_version = None
+    if stored_session:
+        new_version = session_store.add_version(session_id, refined_code, refinement_prompt,
+                                                {'filename': filename})
+    
+    # Add it to the searchable gallery
+    indexed_prompt = refinement_prompt
+    if stored_session and stored_session['original_prompt']:
+        indexed_prompt = f"{stored_session['original_prompt']}\n{refinement_prompt}"
+    gallery_index.add(filename, refined_code, 'refine', indexed_prompt, None,
+                      session_id or None, new_version, tenant=tenant_id(api_key))
+    
+    return {'code': refined_code, 'filename': filename, 'version': new_version, 'prompt_stats': prompt_stats,
+            'speculative': speculated is not None}
+
+@app.route('/refine', methods=['POST'])
+def refine():
+    """Refine the existing UI based on user feedback"""
+    try:
+        data = request.json
+        current_code = data.get('current_code', '')
+        refinement_prompt = data.get('refinement_prompt', '')
+        api_key = data.get('api_key', '')
+        session_id = data.get('session_id', '')
+        target_path = data.get('target_path', '')
+        
+        if not current_code:
+            return jsonify({'success': False, 'error': 'No current code provided'})
+        
+        if not refinement_prompt:
+            return jsonify({'success': False, 'error': 'No refinement prompt provided'})
+        
+        if not api_key:
+            return jsonify({'success': False, 'error': 'No API key provided'})
+        
+        evict_expired_sessions()
+        item = {'prompt': refinement_prompt, 'target_path': target_path,
+                'target_tag': data.get('target_tag', ''), 'target_text': data.get('target_text', '')}
+        
+        def run_batch(items):
+            return apply_refinements(items, current_code, api_key, session_id)
+        
+        if REFINE_COALESCING_ENABLED and session_id and session_store.get_session(session_id):
+            # Refinements sent while one is running are merged into one call
+            result, items = refinement_coalescer.submit(session_id, item, run_batch)
+        else:
+            result, items = run_batch([item]), [item]
+        
+        return jsonify({
+            'success': True,
+            'code': result['code'],
+            'filename': result['filename'],
+            'version': result['version'],
+            'prompt_stats': result['prompt_stats'],
+            'coalesced': len(items),
+            'speculative': result['speculative']
+        })
+        
+    except RequestCancelled as e:
+        # Nothing is saved for cancelled requests
+        app.logger.info('Refinement cancelled: %s', e)
+        return jsonify({'success': False, 'cancelled': True, 'error': f'Request cancelled: {e}'})
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ElementChanged as e:
+        return jsonify({'success': False, 'reselect': True, 'error': str(e)}), 409
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/sessions/<session_id>/cancel', methods=['POST'])
+def cancel_session_request(session_id):
+    """Cancel the running generation or refinement of a session"""
+    try:
+        cancelled = in_flight_requests.cancel(session_id)
+        return jsonify({'success': True, 'cancelled': cancelled})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/sessions/<session_id>/speculate', methods=['POST'])
+def speculate_session(session_id):
+    """Pre-run the likeliest suggested refinements of the session's current version"""
+    try:
+        data = request.json or {}
+        api_key = data.get('api_key', '')
+        
+        if not speculator.enabled:
+            return jsonify({'success': False, 'error': 'Speculative refinements are disabled'})
+        
+        if not api_key:
+            return jsonify({'success': False, 'error': 'No API key provided'})
+        
+        return jsonify({'success': True, 'started': speculator.speculate(session_id, api_key)})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/sessions/<session_id>/speculate/cancel', methods=['POST'])
+def cancel_speculation(session_id):
+    """Cancel the running speculative refinements of a session"""
+    try:
+        return jsonify({'success': True, 'cancelled': speculator.cancel_session(session_id)})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/sessions/<session_id>/versions', methods=['GET'])
+def list_session_versions(session_id):
+    """List the stored versions of a session"""
+    try:
+        stored_session = session_store.get_session(session_id)
+        if not stored_session:
+            return jsonify({'success': False, 'error': 'Session not found'})
+        
+        return jsonify({
+            'success': True,
+            'current_version': stored_session['version'],
+            'versions': session_store.list_versions(session_id)
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/sessions/<session_id>/versions/<int:version>', methods=['GET'])
+def get_session_version(session_id, version):
+    """Return the code of one version of a session"""
+    try:
+        code = session_store.get_version(session_id, version)
+        if code is None:
+            return jsonify({'success': False, 'error': 'Version not found'})
+        
+        return jsonify({'success': True, 'version': version, 'code': code})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/sessions/<session_id>/versions/<int:version>/restore', methods=['POST'])
+def restore_session_version(session_id, version):
+    """Make an earlier version the current one by storing it as a new version"""
+    try:
+        code = session_store.get_version(session_id, version)
+        if code is None:
+            return jsonify({'success': False, 'error': 'Version not found'})
+        
+        source = next((v for v in session_store.list_versions(session_id) if v['version'] == version), {})
+        meta = {'restored_from': version}
+        if source.get('meta', {}).get('filename'):
+            meta['filename'] = source['meta']['filename']
+        new_version = session_store.add_version(session_id, code, f'Restored version {version}', meta)
+        
+        return jsonify({'success': True, 'version': new_version, 'code': code})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/sessions/<session_id>/diff', methods=['GET'])
+def diff_session_versions(session_id):
+    """Return a line or tag-level diff between two versions of a session"""
+    try:
+        mode = request.args.get('mode', 'line')
+        if mode not in ('line', 'tag'):
+            return jsonify({'success': False, 'error': 'mode must be line or tag'})
+        
+        stored_session = session_store.get_session(session_id)
+        if not stored_session:
+            return jsonify({'success': False, 'error': 'Session not found'})
+        
+        to_version = request.args.get('to', stored_session['version'], type=int)
+        from_version = request.args.get('from', to_version - 1, type=int)
+        old_code = session_store.get_version(session_id, from_version)
+        new_code = session_store.get_version(session_id, to_version)
+        if old_code is None or new_code is None:
+            return jsonify({'success': False, 'error': 'Version not found'})
+        
+        diff = diff_versions(old_code, new_code, mode)
+        return jsonify({'success': True, 'from': from_version, 'to': to_version, 'diff': diff})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+# Memoized version diffs; versions never change, so results are keyed on content hashes
+DIFF_CACHE_SIZE = 256
+DIFF_CONTEXT_LINES = 3
+_TAG_BOUNDARY_RE = re.compile(r'(?<=>)|(?=<)')
+
+class DiffCache:
+    """
+    Small thread-safe LRU cache for computed diffs
+    """
+
+    def __init__(self, max_entries=DIFF_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+diff_cache = DiffCache()
+
+def _diff_units(code, mode):
+    if mode == 'tag':
+        # Tag-level units: every tag and every text run between tags
+        return [unit for unit in _TAG_BOUNDARY_RE.split(code) if unit.strip()]
+    return code.splitlines()
+
+def compute_diff(old_code, new_code, mode='line', context=DIFF_CONTEXT_LINES):
+    """
+    Diff two documents by lines ('line') or by tags and text runs ('tag').
+
+    The common prefix and suffix are trimmed in linear time first, so only
+    the changed region goes through SequenceMatcher. Returns unified-style
+    hunks and added/removed counts.
+    """
+    old_units = _diff_units(old_code, mode)
+    new_units = _diff_units(new_code, mode)
+
+    prefix = 0
+    limit = min(len(old_units), len(new_units))
+    while prefix < limit and old_units[prefix] == new_units[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < limit - prefix
+           and old_units[len(old_units) - 1 - suffix] == new_units[len(new_units) - 1 - suffix]):
+        suffix += 1
+
+    # Keep some context around the changed region
+    start = max(0, prefix - context)
+    old_middle = old_units[start:len(old_units) - max(0, suffix - context)]
+    new_middle = new_units[start:len(new_units) - max(0, suffix - context)]
+
+    hunks = []
+    added = removed = 0
+    matcher = difflib.SequenceMatcher(None, old_middle, new_middle, autojunk=False)
+    for group in matcher.get_grouped_opcodes(context):
+        lines = []
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                lines.extend([' ', unit] for unit in old_middle[i1:i2])
+                continue
+            if tag in ('replace', 'delete'):
+                lines.extend(['-', unit] for unit in old_middle[i1:i2])
+                removed += i2 - i1
+            if tag in ('replace', 'insert'):
+                lines.extend(['+', unit] for unit in new_middle[j1:j2])
+                added += j2 - j1
+        hunks.append({
+            'old_start': start + group[0][1] + 1,
+            'old_lines': group[-1][2] - group[0][1],
+            'new_start': start + group[0][3] + 1,
+            'new_lines': group[-1][4] - group[0][3],
+            'lines': lines,
+        })
+    return {'mode': mode, 'added': added, 'removed': removed, 'hunks': hunks}
+
+def diff_versions(old_code, new_code, mode='line'):
+    """
+    Return the memoized diff between two documents
+    """
+    key = (hashlib.sha1(old_code.encode('utf-8')).hexdigest(),
+           hashlib.sha1(new_code.encode('utf-8')).hexdigest(), mode)
+    result = diff_cache.get(key)
+    if result is None:
+        result = compute_diff(old_code, new_code, mode)
+        diff_cache.put(key, result)
+    return result
+
+@app.route('/gallery', methods=['GET'])
+def gallery():
+    """Search the caller's past generations, or list the most recent ones without a query"""
+    try:
+        query = request.args.get('q', '')
+        limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+        # The key comes in a header so it doesn't end up in access logs
+        api_key = request.headers.get('X-API-Key', '')
+        
+        if not api_key:
+            return jsonify({'success': False, 'error': 'No API key provided'})
+        
+        start = time.perf_counter()
+        results = gallery_index.search(query, tenant_id(api_key), limit)
+        
+        return jsonify({
+            'success': True,
+            'results': results,
+            'elapsed_ms': round((time.perf_counter() - start) * 1000, 2)
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/gallery/<filename>', methods=['GET'])
+def gallery_item(filename):
+    """Return the code of one of the caller's past generations"""
+    try:
+        api_key = request.headers.get('X-API-Key', '')
+        
+        if not api_key:
+            return jsonify({'success': False, 'error': 'No API key provided'})
+        
+        item = gallery_index.get_for(filename, tenant_id(api_key))
+        code = read_ui_file(filename) if item else None
+        if code is None:
+            return jsonify({'success': False, 'error': 'File not found'})
+        
+        del item['tenant']
+        return jsonify({'success': True, 'code': code, 'item': item})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/gallery/<filename>/use', methods=['POST'])
+def use_gallery_item(filename):
+    """
+    Start a new session from one of the caller's past generations instead
+    of regenerating it. The session id is always new, so an existing
+    session's history can't be overwritten.
+    """
+    try:
+        data = request.json or {}
+        api_key = data.get('api_key', '')
+        
+        if not api_key:
+            return jsonify({'success': False, 'error': 'No API key provided'})
+        
+        item = gallery_index.get_for(filename, tenant_id(api_key))
+        code = read_ui_file(filename) if item else None
+        if code is None:
+            return jsonify({'success': False, 'error': 'File not found'})
+        
+        session_id = f'session_{int(time.time() * 1000)}_{secrets.token_hex(6)}'
+        session_store.create_session(session_id, code, item['prompt'], {'filename': filename})
+        
+        return jsonify({'success': True, 'code': code, 'filename': filename, 'session_id': session_id})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+# Pages at least this large get a gzip sibling for downloads
+DOWNLOAD_GZIP_MIN_BYTES = int(os.environ.get('DOWNLOAD_GZIP_MIN_BYTES', 1024))
+
+def gzip_variant_path(filepath):
+    """
+    Return the path of an up-to-date .gz sibling of a saved page, creating
+    it on first use. Saved pages never change, so the variant is written
+    once and then served from disk like the original.
+    """
+    gz_path = filepath + '.gz'
+    try:
+        if os.path.getmtime(gz_path) >= os.path.getmtime(filepath):
+            return gz_path
+    except OSError:
+        pass
+    
+    # Write to a temporary name first so readers never see a partial file
+    tmp_path = f'{gz_path}.{secrets.token_hex(4)}.tmp'
+    with open(filepath, 'rb') as source, gzip.open(tmp_path, 'wb', compresslevel=9) as target:
+        while True:
+            chunk = source.read(64 * 1024)
+            if not chunk:
+                break
+            target.write(chunk)
+    os.replace(tmp_path, gz_path)
+    return gz_path
+
+def send_ui_file(filename, download_name=None, immutable=True):
+    """
+    Stream a saved page from disk with send_file(), which uses the WSGI
+    file wrapper (sendfile where the server supports it) and handles
+    ETag, If-None-Match/If-Modified-Since and Range requests. A gzip
+    variant is sent to clients that accept it. Saved files never change,
+    so they are cached for good unless immutable is False, for URLs that
+    can point to another file later.
+    """
+    filepath = ui_file_path(filename)
+    if not gallery_index.get(filename) or not os.path.exists(filepath):
+        abort(404)
+    gallery_index.touch(filename)
+    
+    as_attachment = request.args.get('inline') != '1'
+    download_name = download_name or filename
+    # Honour q-values: 'gzip;q=0' refuses gzip, '*' accepts it
+    accepts_gzip = request.accept_encodings['gzip'] > 0
+    if accepts_gzip and os.path.getsize(filepath) >= DOWNLOAD_GZIP_MIN_BYTES:
+        response = send_file(gzip_variant_path(filepath), mimetype='text/html', as_attachment=as_attachment,
+                             download_name=download_name, conditional=True, etag=True)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_file(filepath, mimetype='text/html', as_attachment=as_attachment,
+                             download_name=download_name, conditional=True, etag=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = ('private, max-age=31536000, immutable' if immutable
+                                         else 'private, no-cache')
+    return response
+
+@app.route('/download/<filename>', methods=['GET'])
+def download_ui_file(filename):
+    """Download a saved page straight from generated_uis"""
+    return send_ui_file(filename)
+
+@app.route('/sessions/<session_id>/versions/<int:version>/download', methods=['GET'])
+def download_session_version(session_id, version):
+    """Download one version of a session"""
+    versions = session_store.list_versions(session_id)
+    entry = next((v for v in versions if v['version'] == version), None)
+    if entry is None:
+        abort(404)
+    
+    # The same session and version can hold a different page after the
+    # session is regenerated, so browsers revalidate with the ETag
+    download_name = f'ui-prototype-v{version}.html'
+    filename = entry['meta'].get('filename')
+    if filename and gallery_index.get(filename) and os.path.exists(ui_file_path(filename)):
+        return send_ui_file(filename, download_name, immutable=False)
+    
+    # Versions without a saved file are rebuilt from the version history
+    code = session_store.get_version(session_id, version).encode('utf-8')
+    response = send_file(io.BytesIO(code), mimetype='text/html', as_attachment=True, download_name=download_name,
+                         conditional=True, etag=hashlib.sha256(code).hexdigest()[:32])
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+class _ZipStreamBuffer:
+    """
+    Write-only file object for zipfile that hands out what has been
+    written so far. zipfile falls back to data descriptors on streams
+    without seek(), so entries never have to be rewritten.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def iter_session_zip(session_id, versions, chunk_size=64 * 1024):
+    """
+    Yield a ZIP archive of every version of a session plus a manifest.
+    Only one version is decoded at a time, so memory stays flat no matter
+    how long the session is.
+    """
+    buffer = _ZipStreamBuffer()
+    manifest = {'session_id': session_id, 'exported_at': datetime.now().isoformat(), 'versions': []}
+    previous_created_at = None
+    
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for entry in versions:
+            code = session_store.get_version(session_id, entry['version'])
+            if code is None:
+                continue
+            name = f"v{entry['version']:03d}.html"
+            data = code.encode('utf-8')
+            
+            info = zipfile.ZipInfo(name, time.localtime(entry['created_at'])[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, 'w') as target:
+                for start in range(0, len(data), chunk_size):
+                    target.write(data[start:start + chunk_size])
+                    yield buffer.drain()
+            yield buffer.drain()
+            
+            manifest['versions'].append({
+                'version': entry['version'],
+                'file': name,
+                'prompt': entry['prompt'],
+                'created_at': datetime.fromtimestamp(entry['created_at']).isoformat(),
+                'seconds_since_previous': (round(entry['created_at'] - previous_created_at, 3)
+                                           if previous_created_at is not None else None),
+                'bytes': len(data),
+                'source_file': entry['meta'].get('filename'),
+                'restored_from': entry['meta'].get('restored_from'),
+            })
+            previous_created_at = entry['created_at']
+        
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+    yield buffer.drain()
+
+@app.route('/sessions/<session_id>/export', methods=['GET'])
+def export_session(session_id):
+    """Stream a ZIP of every version of a session with a manifest of prompts and timings"""
+    versions = session_store.list_versions(session_id)
+    if not versions:
+        abort(404)
+    
+    safe_name = re.sub(r'[^A-Za-z0-9_-]', '_', session_id)[:64]
+    response = Response(stream_with_context(iter_session_zip(session_id, versions)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{safe_name}_versions.zip"'
+    return response
+
+@app.route('/hedging', methods=['GET'])
+def hedging_status():
+    """Report hedged model calls and the current per-operation thresholds"""
+    try:
+        return jsonify({'success': True, 'hedging': hedging_policy.snapshot()})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/models', methods=['GET'])
+def model_status():
+    """Report the model used for each operation, the state of each circuit and the model backend"""
+    try:
+        return jsonify({'success': True, **model_router.snapshot(), 'backend': model_backend.snapshot()})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/admission', methods=['GET'])
+def admission_status():
+    """Report slots in use, queued model requests, shed counts and per-tenant wait times"""
+    try:
+        return jsonify({'success': True, 'admission': admission_controller.snapshot()})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/prewarm', methods=['GET'])
+def prewarm_status():
+    """Report which example prompts are pre-generated"""
+    try:
+        return jsonify({
+            'success': True,
+            'enabled': prewarmer.enabled,
+            'cached': len(prewarmer.entries),
+            'last_run': prewarmer.last_report
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/speculation', methods=['GET'])
+def speculation_status():
+    """Report speculative refinements started, served and cancelled"""
+    try:
+        return jsonify({'success': True, 'speculation': speculator.snapshot()})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/retention', methods=['GET'])
+def retention_status():
+    """Report disk usage of saved pages and the last garbage collection run"""
+    try:
+        file_count, total_bytes = gallery_index.totals()
+        return jsonify({
+            'success': True,
+            'enabled': retention_manager.enabled,
+            'files': file_count,
+            'bytes': total_bytes,
+            'max_bytes': retention_manager.max_bytes,
+            'last_run': retention_manager.last_report
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+class MarkdownFenceStripper:
+    """
+    Incrementally removes the outermost markdown code fence from model output.
+
+    Feed response chunks with feed() and finish with close(); both return a
+    list of text pieces that are safe to emit. The opening fence is the first
+    line starting with ``` (with or without a language tag) and the closing
+    fence is the last such line, so fenced code samples embedded in the page
+    survive. Text from the most recent fence line onwards is held back until
+    a later fence shows it was not the closing one. Each chunk is scanned once.
+
+    Code may also start on the opening fence line and the closing fence may
+    follow the code directly, as in ```html <div>...</div>```; backticks
+    ending the text so far are held back until more text arrives.
+    """
+
+    FENCE = '```'
+    # Language tag after the opening fence, e.g. html or json
+    LANGUAGE_TAG_RE = re.compile(r'[\w+#.-]*(?=\s|<|$)')
+    # Backticks (and whitespace) at the end of the text that may be a fence
+    TRAILING_FENCE_RE = re.compile(r'`{1,3}\s*$')
+
+    def __init__(self):
+        self.state = 'pending'   # pending -> raw (no fence) or fenced
+        self.pending_scan = ''   # text seen before the opening fence
+        self.held = []           # fenced text from the last fence line onwards
+        self.tail = ''           # trailing backticks that may start a fence
+        self.line_start = True   # next fenced text begins at a line start
+
+    def feed(self, chunk):
+        if not chunk:
+            return []
+        if self.state == 'raw':
+            return [chunk]
+        if self.state == 'pending':
+            return self._feed_pending(chunk)
+        return self._feed_fenced(chunk)
+
+    def close(self):
+        if self.state == 'pending':
+            return self._close_pending()
+        tail, self.tail = self.tail, ''
+        held, self.held = self.held, []
+        if tail.rstrip().endswith(self.FENCE):
+            # The text ends with the closing fence, so a held fence was an inner one
+            return [piece for piece in held if piece]
+        if held:
+            # Held text is the closing fence plus anything the model added after it
+            return []
+        return [tail] if tail else []
+
+    def _close_pending(self):
+        text, self.pending_scan = self.pending_scan, ''
+        fence = self._find_fence(text, 0, True)
+        if fence == -1:
+            # No fence ever appeared, so the whole response is the code
+            self.state = 'raw'
+            return [text] if text else []
+        # The whole response is on the opening fence line
+        self.state = 'fenced'
+        return self._feed_fenced(self._opening_line_code(text, fence, len(text))) + self.close()
+
+    def _opening_line_code(self, text, fence, newline):
+        """
+        Fenced text after the opening fence: from the next line, or from the
+        end of the language tag if code follows it on the same line
+        """
+        tag = self.LANGUAGE_TAG_RE.match(text, fence + len(self.FENCE))
+        tag_end = tag.end() if tag else fence + len(self.FENCE)
+        if text[tag_end:newline].strip():
+            self.line_start = False
+            return text[tag_end:].lstrip(' \t')
+        return text[newline + 1:]
+
+    def _feed_pending(self, chunk):
+        self.pending_scan += chunk
+        text = self.pending_scan
+        stripped = text.lstrip()
+        if not stripped:
+            return []
+        if stripped[0] == '<':
+            # Output starts with markup, treat it as unfenced HTML
+            self.state = 'raw'
+            self.pending_scan = ''
+            return [text]
+
+        fence = self._find_fence(text, 0, True)
+        if fence == -1:
+            return []
+        newline = text.find('\n', fence)
+        if newline == -1:
+            # Wait for the rest of the language tag line
+            return []
+        self.state = 'fenced'
+        self.pending_scan = ''
+        return self._feed_fenced(self._opening_line_code(text, fence, newline))
+
+    def _find_fence(self, text, start, line_start):
+        position = text.find(self.FENCE, start)
+        while position != -1:
+            if (position == 0 and line_start) or (position > 0 and text[position - 1] == '\n'):
+                return position
+            position = text.find(self.FENCE, position + 1)
+        return -1
+
+    def _feed_fenced(self, chunk):
+        text = self.tail + chunk if self.tail else chunk
+        line_start = self.line_start
+        self.tail = ''
+
+        # Keep back trailing backticks: a partial fence at the start of the
+        # last line, or a closing fence right after the code
+        trailing = self.TRAILING_FENCE_RE.search(text)
+        if trailing:
+            keep = trailing.start()
+            self.tail = text[keep:]
+            self.line_start = (line_start if keep == 0 else text[keep - 1] == '\n')
+            text = text[:keep]
+        else:
+            self.line_start = text.endswith('\n') if text else line_start
+
+        out = []
+        cursor = 0
+        fence = self._find_fence(text, 0, line_start)
+        while fence != -1:
+            if self.held:
+                # A later fence exists, so the held one was an inner fence
+                self.held.append(text[cursor:fence])
+                out.extend(self.held)
+                self.held = []
+            elif fence > cursor:
+                out.append(text[cursor:fence])
+            self.held = ['']
+            cursor = fence
+            fence = self._find_fence(text, fence + len(self.FENCE), line_start)
+
+        rest = text[cursor:]
+        if self.held:
+            self.held.append(rest)
+        elif rest:
+            out.append(rest)
+        return [piece for piece in out if piece]
+
+def strip_markdown_fences(response):
+    """
+    Return the code inside the outermost markdown fence of a model response.
+
+    Accepts the full response text or an iterable of streamed chunks.
+    """
+    if isinstance(response, str):
+        response = (response,)
+    stripper = MarkdownFenceStripper()
+    pieces = []
+    for chunk in response:
+        pieces.extend(stripper.feed(chunk))
+    pieces.extend(stripper.close())
+    if len(pieces) == 1:
+        return pieces[0]
+    return ''.join(pieces)
+
+# Maximum number of follow-up requests used to finish a truncated page
+MAX_CONTINUATIONS = 3
+
+CONTINUATION_PROMPT = """
+Your previous response was cut off before the HTML document was complete.
+Continue EXACTLY where you stopped, starting with the very next character.
+Do not repeat anything you already wrote, do not restart the document and do not add explanations or markdown formatting.
+"""
+
+def get_finish_reason(response):
+    """
+    Return the finish reason name of the first candidate (e.g. 'STOP', 'MAX_TOKENS')
+    """
+    try:
+        reason = response.candidates[0].finish_reason
+    except (AttributeError, IndexError):
+        return None
+    return getattr(reason, 'name', str(reason))
+
+def is_truncated_html(code):
+    """
+    Check whether a generated HTML document is missing its closing tags
+    """
+    lower_code = code.lower()
+    if '<html' in lower_code and '</html>' not in lower_code:
+        return True
+    if '<body' in lower_code and '</body>' not in lower_code:
+        return True
+    return False
+
+def _join_continuation(code, continuation, max_overlap=200, min_overlap=16):
+    """
+    Append a continuation to the partial code, dropping a leading markdown
+    fence and any text the model repeated from the end of the partial code.
+
+    A short overlap is often a coincidence ('#ff' + 'f;'), so only overlaps
+    of at least min_overlap characters, or of whole lines, are dropped.
+    """
+    stripped = continuation.lstrip()
+    if stripped.startswith('```'):
+        newline = stripped.find('\n')
+        continuation = stripped[newline + 1:] if newline != -1 else ''
+        closing = continuation.rfind('\n```')
+        if closing != -1:
+            continuation = continuation[:closing + 1]
+
+    for size in range(min(max_overlap, len(code), len(continuation)), 0, -1):
+        if not code.endswith(continuation[:size]):
+            continue
+        whole_lines = (size == len(code) or code[-size - 1] == '\n') and continuation[size - 1] == '\n'
+        if size >= min_overlap or (whole_lines and continuation[:size].strip()):
+            return code + continuation[size:]
+    return code + continuation
+
+# Per-request deadlines and cancellation of upstream model calls
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', 180))
+UPSTREAM_WORKERS = int(os.environ.get('UPSTREAM_WORKERS', 16))
+CANCELLATION_POLL_SECONDS = 0.25
+
+class RequestCancelled(BaseException):
+    """
+    Raised when a request was cancelled, superseded or ran past its
+    deadline. Like asyncio.CancelledError it derives from BaseException so
+    the `except Exception` fallbacks around model calls don't swallow it.
+    """
+
+class CancellationToken:
+    """
+    Cancellation flag and deadline shared by a request and the worker
+    running its model calls. A token with a parent is also cancelled with
+    it and shares its deadline, so one of several calls made for a request
+    can be cancelled on its own.
+    """
+
+    def __init__(self, deadline_seconds=REQUEST_DEADLINE_SECONDS, parent=None):
+        self.deadline = time.monotonic() + deadline_seconds if deadline_seconds else None
+        self.parent = parent
+        self.event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason):
+        if not self.event.is_set():
+            self.reason = reason
+            self.event.set()
+
+    @property
+    def cancelled(self):
+        if not self.event.is_set():
+            if self.parent is not None and self.parent.cancelled:
+                self.cancel(self.parent.reason)
+            elif self.deadline is not None and time.monotonic() >= self.deadline:
+                self.cancel('deadline exceeded')
+        return self.event.is_set()
+
+    def remaining(self):
+        if self.deadline is None:
+            return self.parent.remaining() if self.parent is not None else None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise RequestCancelled(self.reason)
+
+current_cancellation = contextvars.ContextVar('current_cancellation', default=None)
+
+def check_cancelled():
+    """
+    Stop before the next upstream call if the current request is cancelled
+    """
+    token = current_cancellation.get()
+    if token is not None:
+        token.raise_if_cancelled()
+
+def upstream_request_options():
+    """
+    Request options that bound an upstream call by the remaining deadline
+    """
+    token = current_cancellation.get()
+    remaining = token.remaining() if token is not None else None
+    return {'timeout': max(1.0, remaining)} if remaining is not None else {}
+
+class InFlightRequests:
+    """
+    Tracks the running model request of each session. Starting a new one
+    for the same session cancels the previous one, whose result would be
+    thrown away by the client anyway.
+    """
+
+    def __init__(self):
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def begin(self, session_id, deadline_seconds=REQUEST_DEADLINE_SECONDS):
+        token = CancellationToken(deadline_seconds)
+        if session_id:
+            with self.lock:
+                previous = self.tokens.get(session_id)
+                self.tokens[session_id] = token
+            if previous is not None:
+                previous.cancel('superseded by a newer request')
+        return token
+
+    def end(self, session_id, token):
+        with self.lock:
+            if self.tokens.get(session_id) is token:
+                del self.tokens[session_id]
+
+    def cancel(self, session_id, reason='cancelled by client'):
+        with self.lock:
+            token = self.tokens.pop(session_id, None)
+        if token is None:
+            return False
+        token.cancel(reason)
+        return True
+
+in_flight_requests = InFlightRequests()
+upstream_executor = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix='upstream')
+
+def client_disconnected(connection):
+    """
+    Peek at the request's socket: readable with no data means the client
+    closed the connection
+    """
+    try:
+        readable, _, _ = select.select([connection], [], [], 0)
+        if not readable:
+            return False
+        return connection.recv(1, socket.MSG_PEEK) == b''
+    except ValueError:
+        # TLS sockets don't support MSG_PEEK
+        return False
+    except OSError:
+        return True
+
+def run_cancellable(token, fn, *args, on_done=None, **kwargs):
+    """
+    Run fn in an upstream worker while the request thread watches for
+    cancellation, the deadline and client disconnects. A cancelled request
+    returns at once; the worker closes its model stream at the next chunk
+    (see stream_content) and its result is discarded. on_done is called with
+    the future when the worker has actually stopped, so admission slots
+    released there are not handed out while the upstream call still runs.
+    """
+    context = contextvars.copy_context()
+    context.run(current_cancellation.set, token)
+    future = upstream_executor.submit(context.run, fn, *args, **kwargs)
+    if on_done is not None:
+        future.add_done_callback(on_done)
+    
+    # Only the development server exposes the connection; elsewhere the
+    # client's cancel beacon and superseding requests still apply
+    connection = request.environ.get('werkzeug.socket') if has_request_context() else None
+    while True:
+        done, _ = wait([future], timeout=CANCELLATION_POLL_SECONDS)
+        if done:
+            token.raise_if_cancelled()
+            return future.result()
+        if connection is not None and client_disconnected(connection):
+            token.cancel('client disconnected')
+        if token.cancelled:
+            future.cancel()
+            token.raise_if_cancelled()
+
+# Admission control in front of model calls
+MAX_CONCURRENT_UPSTREAM = int(os.environ.get('MAX_CONCURRENT_UPSTREAM', 8))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 32))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT_SECONDS', 30))
+PRIORITY_REFINE = 0
+PRIORITY_GENERATE = 1
+PRIORITY_SPECULATIVE = 2
+
+# Fair sharing of slots between tenants; weights are keyed by the tenant ids
+# shown in GET /admission, e.g. {"key:1a2b3c4d5e6f": 3}
+TENANT_WEIGHTS = os.environ.get('TENANT_WEIGHTS', '{}')
+DRR_QUANTUM_SECONDS = float(os.environ.get('DRR_QUANTUM_SECONDS', 10))
+MAX_TRACKED_TENANTS = 1000
+
+def load_tenant_weights(weights):
+    """
+    Parse tenant weights (a JSON object or a dict). Weights must be positive
+    numbers: a tenant without credit would never be served, so bad entries
+    are logged and ignored.
+    """
+    if isinstance(weights, str):
+        try:
+            weights = json.loads(weights or '{}')
+        except ValueError as e:
+            app.logger.warning('Ignoring TENANT_WEIGHTS, not valid JSON: %s', e)
+            return {}
+    if not isinstance(weights, dict):
+        app.logger.warning('Ignoring TENANT_WEIGHTS, expected an object of tenant ids to weights')
+        return {}
+    valid = {}
+    for tenant, weight in weights.items():
+        try:
+            weight = float(weight)
+        except (TypeError, ValueError):
+            weight = None
+        if weight is None or not math.isfinite(weight) or weight <= 0:
+            app.logger.warning('Ignoring weight %r for tenant %s: must be a positive number', weights[tenant], tenant)
+            continue
+        valid[str(tenant)] = weight
+    return valid
+
+class Overloaded(Exception):
+    """
+    Raised when a request is shed; retry_after is a hint in seconds
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TenantQueue:
+    """
+    Waiting requests and scheduling state of one tenant (an API key, or a
+    session for requests without one)
+    """
+
+    def __init__(self, tenant_id, weight):
+        self.tenant_id = tenant_id
+        self.weight = weight
+        self.waiting = []
+        self.deficit = 0.0
+        self.served = 0
+        self.shed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_seen = time.monotonic()
+
+    def record_wait(self, seconds):
+        self.served += 1
+        self.total_wait += seconds
+        self.max_wait = max(self.max_wait, seconds)
+
+    def snapshot(self):
+        return {
+            'weight': self.weight,
+            'waiting': len(self.waiting),
+            'served': self.served,
+            'shed': self.shed,
+            'avg_wait_seconds': round(self.total_wait / self.served, 3) if self.served else 0.0,
+            'max_wait_seconds': round(self.max_wait, 3),
+        }
+
+class AdmissionController:
+    """
+    Bounds the number of concurrent model requests and the number of
+    requests waiting for one, and shares the slots fairly between tenants.
+
+    Waiting requests are queued per tenant. Priority applies across
+    tenants: a waiting refinement of any tenant goes before fresh
+    generations, and those before speculative work. Tenants waiting at the
+    same priority are served by weighted deficit round robin: each turn a
+    tenant earns weight * DRR_QUANTUM_SECONDS of credit and spends the
+    expected service time of each request it starts, so a tenant with a
+    batch of generations can't starve other users. Within a tenant,
+    requests of the same priority go in arrival order.
+
+    A request takes one slot per model call it can have in flight at once
+    (a parallel-section generation takes one per section worker) and is
+    charged for all of them. Hedged backup calls only run on spare slots.
+
+    When the queue is full, a request from a tenant with a shorter queue
+    (or of higher priority) sheds the newest request of the tenant with the
+    longest queue; otherwise it is rejected at once. Slots are held until
+    the model work finishes, even if the request was cancelled.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_UPSTREAM, queue_size=ADMISSION_QUEUE_SIZE,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT_SECONDS, weights=None, quantum=DRR_QUANTUM_SECONDS):
+        self.max_concurrent = max_concurrent
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.weights = load_tenant_weights(TENANT_WEIGHTS if weights is None else weights)
+        if not quantum > 0:
+            # Same spin as a zero weight
+            app.logger.warning('DRR_QUANTUM_SECONDS must be positive, using 10')
+            quantum = 10.0
+        self.quantum = quantum
+        self.running = 0
+        self.waiting = 0
+        self.tenants = {}
+        self.active = deque()
+        self.sequence = itertools.count()
+        self.service_seconds = {PRIORITY_REFINE: 10.0, PRIORITY_GENERATE: 20.0, PRIORITY_SPECULATIVE: 10.0}
+        self.stats = {'admitted': 0, 'queued': 0, 'shed': 0, 'timed_out': 0}
+        self.lock = threading.Lock()
+
+    def _tenant(self, tenant_id):
+        # Caller holds the lock
+        tenant = self.tenants.get(tenant_id)
+        if tenant is None:
+            if len(self.tenants) >= MAX_TRACKED_TENANTS:
+                idle = [t for t in self.tenants.values() if not t.waiting]
+                for stale in sorted(idle, key=lambda t: t.last_seen)[:len(idle) // 2 or 1]:
+                    del self.tenants[stale.tenant_id]
+            tenant = TenantQueue(tenant_id, self.weights.get(tenant_id, 1.0))
+            self.tenants[tenant_id] = tenant
+        tenant.last_seen = time.monotonic()
+        return tenant
+
+    def _retry_after(self):
+        # Caller holds the lock
+        average = sum(self.service_seconds.values()) / len(self.service_seconds)
+        backlog = (self.waiting + 1) / max(1, self.max_concurrent)
+        return max(1, math.ceil(average * backlog))
+
+    def _remove(self, tenant, entry):
+        # Caller holds the lock
+        tenant.waiting.remove(entry)
+        heapq.heapify(tenant.waiting)
+        self.waiting -= 1
+        if not tenant.waiting:
+            tenant.deficit = 0.0
+            self.active.remove(tenant)
+
+    def _make_room(self, tenant, priority):
+        """Shed a queued request in favour of a new one, or raise Overloaded"""
+        # Caller holds the lock
+        if not self.active:
+            self.stats['shed'] += 1
+            raise Overloaded('Server is busy', self._retry_after())
+        longest = max(self.active, key=lambda t: len(t.waiting))
+        victim = max(longest.waiting)
+        fairer = longest is not tenant and len(tenant.waiting) + 1 < len(longest.waiting)
+        if not fairer and victim[0] <= priority:
+            tenant.shed += 1
+            self.stats['shed'] += 1
+            raise Overloaded('Server is busy', self._retry_after())
+        self._remove(longest, victim)
+        victim[3]['shed'] = True
+        victim[3]['event'].set()
+        longest.shed += 1
+        self.stats['shed'] += 1
+
+    def _next_waiter(self, free_slots):
+        """
+        Pick the next waiting request of the best waiting priority by deficit
+        round robin, or None if it needs more than free_slots
+        """
+        # Caller holds the lock
+        best = min(tenant.waiting[0][0] for tenant in self.active)
+        while True:
+            tenant = self.active[0]
+            head = tenant.waiting[0]
+            if head[0] != best:
+                # Only waits for lower priority work; keeps its credit
+                self.active.rotate(-1)
+                continue
+            cost = self.service_seconds[head[0]] * head[3]['slots']
+            if tenant.deficit >= cost:
+                if head[3]['slots'] > free_slots:
+                    # Keeps its turn until enough slots are free
+                    return None
+                tenant.deficit -= cost
+                self._remove(tenant, head)
+                return head[3]
+            # Out of credit: earn this turn's quantum and go to the back
+            tenant.deficit += self.quantum * tenant.weight
+            self.active.rotate(-1)
+
+    def acquire(self, priority, tenant_id, token=None, slots=1):
+        """Wait for slots or raise Overloaded; returns the number of slots taken"""
+        slots = max(1, min(slots, self.max_concurrent))
+        queued_at = time.monotonic()
+        with self.lock:
+            tenant = self._tenant(tenant_id)
+            if self.running + slots <= self.max_concurrent and not self.waiting:
+                self.running += slots
+                self.stats['admitted'] += 1
+                tenant.record_wait(0.0)
+                return slots
+            if self.waiting >= self.queue_size:
+                self._make_room(tenant, priority)
+            waiter = {'event': threading.Event(), 'shed': False, 'slots': slots}
+            entry = (priority, next(self.sequence), tenant_id, waiter)
+            if not tenant.waiting:
+                self.active.append(tenant)
+            heapq.heappush(tenant.waiting, entry)
+            self.waiting += 1
+            self.stats['queued'] += 1
+        
+        deadline = queued_at + self.queue_timeout
+        while not waiter['event'].wait(CANCELLATION_POLL_SECONDS):
+            cancelled = token is not None and token.cancelled
+            if not cancelled and time.monotonic() < deadline:
+                continue
+            with self.lock:
+                if waiter['event'].is_set():
+                    # Granted while giving up; keep the slot
+                    break
+                self._remove(tenant, entry)
+                if cancelled:
+                    token.raise_if_cancelled()
+                tenant.shed += 1
+                self.stats['timed_out'] += 1
+                raise Overloaded('Timed out waiting for the server', self._retry_after())
+        
+        with self.lock:
+            if waiter['shed']:
+                raise Overloaded('Server is busy', self._retry_after())
+            self.stats['admitted'] += 1
+            tenant.record_wait(time.monotonic() - queued_at)
+        return slots
+
+    def try_acquire(self, slots=1):
+        """Take spare slots without queueing; returns whether they were free"""
+        with self.lock:
+            if self.waiting or self.running + slots > self.max_concurrent:
+                return False
+            self.running += slots
+            return True
+
+    def release(self, priority, service_seconds, slots=1):
+        """Free the slots and hand them to the next waiters that fit"""
+        with self.lock:
+            if priority is not None:
+                average = self.service_seconds[priority]
+                self.service_seconds[priority] = 0.8 * average + 0.2 * service_seconds
+            self.running -= slots
+            while self.waiting:
+                waiter = self._next_waiter(self.max_concurrent - self.running)
+                if waiter is None:
+                    break
+                self.running += waiter['slots']
+                waiter['event'].set()
+
+    def run(self, priority, tenant_id, token, fn, *args, slots=1, **kwargs):
+        """
+        Wait for slots, then run fn through run_cancellable(). The slots are
+        released when the upstream worker finishes.
+        """
+        slots = self.acquire(priority, tenant_id, token, slots)
+        started = time.monotonic()
+        return run_cancellable(token, fn, *args, on_done=lambda _: self.release(
+            priority, time.monotonic() - started, slots), **kwargs)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, running=self.running, waiting=self.waiting,
+                        max_concurrent=self.max_concurrent, queue_size=self.queue_size,
+                        service_seconds={'refine': round(self.service_seconds[PRIORITY_REFINE], 2),
+                                         'generate': round(self.service_seconds[PRIORITY_GENERATE], 2),
+                                         'speculative': round(self.service_seconds[PRIORITY_SPECULATIVE], 2)},
+                        tenants={t.tenant_id: t.snapshot() for t in self.tenants.values()})
+
+def tenant_id(api_key, session_id=''):
+    """
+    Scheduling identity of a request: a fingerprint of the API key, never
+    the key itself, or the session for requests without one
+    """
+    if api_key:
+        return 'key:' + hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]
+    return f'session:{session_id}'
+
+admission_controller = AdmissionController()
+
+# Hedged model calls: fire a backup request when the first is slower than usual
+HEDGING_ENABLED = os.environ.get('HEDGING_ENABLED', '0') == '1'
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 0.95))
+HEDGE_BUDGET = float(os.environ.get('HEDGE_BUDGET', 0.1))
+HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('HEDGE_MIN_DELAY_SECONDS', 2.0))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+
+class HedgingPolicy:
+    """
+    Tail-latency hedging for model calls.
+
+    Latencies are tracked per operation ("generate", "refine", ...) over a
+    sliding window. When a call is still running after the window's
+    HEDGE_PERCENTILE latency, an identical backup call is started and
+    whichever succeeds first wins. Each call runs under its own child of
+    the request's cancellation token; the loser's token is cancelled, so
+    its stream is closed at the next chunk (see stream_content). At most
+    HEDGE_BUDGET of recent calls may be hedged, and only while admission
+    control has a spare slot for the backup; that slot is released once
+    both calls have stopped.
+    """
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, budget=HEDGE_BUDGET, min_delay=HEDGE_MIN_DELAY_SECONDS,
+                 window=HEDGE_WINDOW, enabled=HEDGING_ENABLED):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.window = window
+        self.enabled = enabled
+        self.latencies = {}
+        self.recent_hedges = deque(maxlen=window)
+        self.hedged = 0
+        self.stats = {'calls': 0, 'hedges': 0, 'hedge_wins': 0, 'budget_denied': 0, 'no_capacity': 0}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS * 2, thread_name_prefix='hedge')
+
+    def threshold(self, operation):
+        """Delay after which a call of this operation gets a backup"""
+        with self.lock:
+            samples = sorted(self.latencies.get(operation, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.min_delay, samples[int(self.percentile * (len(samples) - 1))])
+
+    def _record(self, operation, started, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self.lock:
+            samples = self.latencies.setdefault(operation, deque(maxlen=self.window))
+            samples.append(time.monotonic() - started)
+
+    def _push_call(self, hedged):
+        # Caller holds the lock; keeps a running count over the window
+        if len(self.recent_hedges) == self.recent_hedges.maxlen:
+            self.hedged -= self.recent_hedges[0]
+        self.recent_hedges.append(int(hedged))
+        self.hedged += int(hedged)
+
+    def _take_budget(self):
+        """Count a slow call and return whether it may be hedged"""
+        with self.lock:
+            calls = max(len(self.recent_hedges) + 1, HEDGE_MIN_SAMPLES)
+            allowed = self.hedged + 1 <= self.budget * calls
+            self._push_call(allowed)
+            self.stats['hedges' if allowed else 'budget_denied'] += 1
+            return allowed
+
+    def _skip_budget(self):
+        with self.lock:
+            self._push_call(False)
+
+    def _submit(self, operation, fn, args, kwargs):
+        """Start fn under its own cancellation token; returns (future, token)"""
+        started = time.monotonic()
+        token = CancellationToken(None, parent=current_cancellation.get())
+        context = contextvars.copy_context()
+        context.run(current_cancellation.set, token)
+        future = self.executor.submit(context.run, fn, *args, **kwargs)
+        future.add_done_callback(lambda f: self._record(operation, started, f))
+        return future, token
+
+    @staticmethod
+    def _release_when_stopped(futures):
+        """Release the backup's admission slot once every call has stopped"""
+        running = set(futures)
+        lock = threading.Lock()
+        
+        def stopped(future):
+            with lock:
+                running.discard(future)
+                last = not running
+            if last:
+                admission_controller.release(None, 0)
+        
+        for future in futures:
+            future.add_done_callback(stopped)
+
+    def call(self, operation, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs), hedging it if it runs long"""
+        if not self.enabled:
+            return fn(*args, **kwargs)
+        with self.lock:
+            self.stats['calls'] += 1
+        
+        primary, primary_token = self._submit(operation, fn, args, kwargs)
+        delay = self.threshold(operation)
+        if delay is None:
+            # Not enough samples yet to know what slow means
+            self._skip_budget()
+            return primary.result()
+        
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            self._skip_budget()
+            return primary.result()
+        if not self._take_budget():
+            return primary.result()
+        
+        check_cancelled()
+        if not admission_controller.try_acquire():
+            # The backup is an extra upstream call; only send it on a spare slot
+            with self.lock:
+                self.stats['no_capacity'] += 1
+            return primary.result()
+        backup, backup_token = self._submit(operation, fn, args, kwargs)
+        self._release_when_stopped([primary, backup])
+        tokens = {primary: primary_token, backup: backup_token}
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                        tokens[loser].cancel('hedge lost')
+                    if future is backup:
+                        with self.lock:
+                            self.stats['hedge_wins'] += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            operations = list(self.latencies)
+        stats['enabled'] = self.enabled
+        stats['budget'] = self.budget
+        stats['thresholds'] = {operation: self.threshold(operation) for operation in operations}
+        return stats
+
+hedging_policy = HedgingPolicy()
+
+# Model backend: 'gemini' calls the API, 'record' calls it and appends every
+# call to the cassette, 'replay' answers from the cassette without a network
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'gemini')
+CASSETTE_PATH = os.environ.get('CASSETTE_PATH', 'cassettes/gemini.jsonl.gz')
+# Replay timing: 1 keeps the recorded latency, 10 is ten times faster, 0 answers immediately
+REPLAY_SPEED = float(os.environ.get('REPLAY_SPEED', 1))
+
+class CassetteMiss(Exception):
+    """
+    Raised in replay mode for a call that was never recorded. It goes
+    through the same fallbacks as a failed API call.
+    """
+
+class ReplayedError(Exception):
+    """
+    A recorded API error, raised again on replay with the original message
+    """
+
+class RecordedResponse:
+    """
+    Response rebuilt from a cassette or from streamed chunks, with the
+    fields the app reads from a Gemini response: text and the first
+    candidate's finish reason
+    """
+
+    def __init__(self, text, finish_reason=None):
+        self.text = text
+        self.candidates = []
+        if finish_reason:
+            self.candidates.append(SimpleNamespace(finish_reason=SimpleNamespace(name=finish_reason)))
+
+class Cassette:
+    """
+    Recorded model calls in a gzipped JSON-lines file.
+
+    Every call is one line: the request key and prompt, the response chunks
+    as [seconds since the call started, text] pairs, the finish reason, or
+    the error it raised. Lines are appended as separate gzip members, so a
+    recording can be stopped at any time and extended later. Calls with the
+    same key are replayed in recording order; the last one repeats.
+    """
+
+    def __init__(self, path=CASSETTE_PATH):
+        self.path = path
+        self.entries = {}
+        self.cursors = {}
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(model_name, system_instruction, generation_config, request):
+        payload = json.dumps([model_name, system_instruction, generation_config, request],
+                             sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def load(self):
+        """Read the cassette into memory; returns the number of calls"""
+        entries = {}
+        if os.path.exists(self.path):
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        entries.setdefault(entry['key'], []).append(entry)
+        with self.lock:
+            self.entries = entries
+            self.cursors = {}
+        return sum(len(calls) for calls in entries.values())
+
+    def append(self, entry):
+        line = json.dumps(entry, separators=(',', ':'), default=str) + '\n'
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                f.write(line)
+            self.entries.setdefault(entry['key'], []).append(entry)
+            self.recorded += 1
+
+    def lookup(self, key):
+        with self.lock:
+            calls = self.entries.get(key)
+            if not calls:
+                self.misses += 1
+                return None
+            index = self.cursors.get(key, 0)
+            self.cursors[key] = index + 1
+            self.replayed += 1
+            return calls[min(index, len(calls) - 1)]
+
+    def snapshot(self):
+        with self.lock:
+            return {'path': self.path, 'calls': sum(len(calls) for calls in self.entries.values()),
+                    'recorded': self.recorded, 'replayed': self.replayed, 'misses': self.misses}
+
+class CassetteModel:
+    """
+    Stands in for genai.GenerativeModel in record and replay mode. Chats
+    are keyed by their history plus the new message, so a continuation
+    replays like any other call.
+    """
+
+    def __init__(self, backend, model_name, system_instruction=None, generation_config=None):
+        self.backend = backend
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.generation_config = generation_config
+
+    def _model(self):
+        return GeminiBackend.model(self.backend, self.model_name, self.system_instruction, self.generation_config)
+
+    def _key(self, request):
+        return Cassette.key(self.model_name, self.system_instruction, self.generation_config, request)
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        return self.backend.call(self, contents, stream,
+                                 lambda: self._model().generate_content(contents, stream=stream, **kwargs))
+
+    def start_chat(self, history=None):
+        return CassetteChat(self, history)
+
+class CassetteChat:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = [dict(turn) for turn in history or []]
+
+    def send_message(self, content, stream=False, **kwargs):
+        history = [dict(turn) for turn in self.history]
+
+        def send():
+            return self.model._model().start_chat(history=history).send_message(content, stream=stream, **kwargs)
+
+        response = self.model.backend.call(self.model, {'history': history, 'message': content}, stream, send)
+        if not stream:
+            self.history += [{'role': 'user', 'parts': [content]}, {'role': 'model', 'parts': [response.text]}]
+        return response
+
+# API key of the model calls made in the current context (request, worker
+# or background job); set by model_backend.configure()
+current_api_key = contextvars.ContextVar('current_api_key', default=None)
+MAX_API_CLIENTS = 64
+
+class GeminiBackend:
+    """
+    Calls the Gemini API directly.
+
+    genai.configure() is process-global, so concurrent requests (and the
+    pre-warmer's service key) would run on each other's keys. Instead the
+    key is kept per context and each model gets a client for that key.
+    The SDK has no public per-call key, hence the _client assignment.
+    """
+
+    mode = 'gemini'
+
+    def __init__(self):
+        self.clients = OrderedDict()
+        self.lock = threading.Lock()
+
+    def configure(self, api_key):
+        current_api_key.set(api_key)
+
+    def _client(self, service, api_key):
+        key = (service.__name__, hashlib.sha256(api_key.encode('utf-8')).hexdigest())
+        with self.lock:
+            client = self.clients.get(key)
+            if client is not None:
+                self.clients.move_to_end(key)
+                return client
+        client = service(client_options={'api_key': api_key})
+        with self.lock:
+            self.clients[key] = client
+            while len(self.clients) > MAX_API_CLIENTS:
+                self.clients.popitem(last=False)
+        return client
+
+    def cache_client(self):
+        """Cached-content service client for the current context's key"""
+        api_key = current_api_key.get()
+        return self._client(glm.CacheServiceClient, api_key) if api_key else None
+
+    def model(self, model_name, system_instruction=None, generation_config=None):
+        kwargs = {'system_instruction': system_instruction}
+        if generation_config is not None:
+            kwargs['generation_config'] = generation_config
+        model = genai.GenerativeModel(model_name, **kwargs)
+        api_key = current_api_key.get()
+        if api_key:
+            model._client = self._client(glm.GenerativeServiceClient, api_key)
+        return model
+
+    def snapshot(self):
+        return {'mode': self.mode}
+
+class RecordingBackend(GeminiBackend):
+    """
+    Calls the Gemini API and appends every call, with its chunk timing or
+    error, to the cassette
+    """
+
+    mode = 'record'
+
+    def __init__(self, cassette):
+        super().__init__()
+        self.cassette = cassette
+
+    def model(self, model_name, system_instruction=None, generation_config=None):
+        return CassetteModel(self, model_name, system_instruction, generation_config)
+
+    def call(self, model, request, stream, send):
+        entry = {'key': model._key(request), 'model': model.model_name, 'request': request, 'stream': stream}
+        start = time.monotonic()
+        try:
+            response = send()
+        except Exception as e:
+            entry.update(error=str(e), elapsed=round(time.monotonic() - start, 3))
+            self.cassette.append(entry)
+            raise
+        if stream:
+            return self._record_stream(entry, response, start)
+        entry.update(chunks=[[round(time.monotonic() - start, 3), response.text]],
+                     finish_reason=get_finish_reason(response))
+        self.cassette.append(entry)
+        return response
+
+    def _record_stream(self, entry, response, start):
+        chunks = []
+        last = None
+        try:
+            for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunks without parts (e.g. only a finish reason) have no text
+                    text = ''
+                chunks.append([round(time.monotonic() - start, 3), text])
+                last = chunk
+                yield chunk
+        except GeneratorExit:
+            # Closed by a cancelled request: stop the call being recorded too
+            _close_stream(response)
+            raise
+        entry.update(chunks=chunks, finish_reason=get_finish_reason(last) if last is not None else None)
+        self.cassette.append(entry)
+
+    def snapshot(self):
+        return dict(self.cassette.snapshot(), mode=self.mode)
+
+class ReplayBackend(GeminiBackend):
+    """
+    Answers every call from the cassette, sleeping out the recorded
+    latency (or chunk offsets when streaming) divided by the replay speed
+    """
+
+    mode = 'replay'
+
+    def __init__(self, cassette, speed=REPLAY_SPEED):
+        super().__init__()
+        self.cassette = cassette
+        self.speed = speed
+
+    def configure(self, api_key):
+        pass
+
+    def model(self, model_name, system_instruction=None, generation_config=None):
+        return CassetteModel(self, model_name, system_instruction, generation_config)
+
+    def _wait_until(self, start, offset):
+        if not self.speed:
+            return
+        deadline = start + offset / self.speed
+        while True:
+            # Sleep in short steps so a replayed call can still be cancelled
+            check_cancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, CANCELLATION_POLL_SECONDS))
+
+    def call(self, model, request, stream, send):
+        start = time.monotonic()
+        entry = self.cassette.lookup(model._key(request))
+        if entry is None:
+            raise CassetteMiss(f'No recorded response for this {model.model_name} call in {self.cassette.path}')
+        if 'error' in entry:
+            self._wait_until(start, entry.get('elapsed', 0))
+            raise ReplayedError(entry['error'])
+        if stream:
+            return self._replay_stream(entry, start)
+        self._wait_until(start, entry['chunks'][-1][0] if entry['chunks'] else 0)
+        return RecordedResponse(''.join(text for _, text in entry['chunks']), entry.get('finish_reason'))
+
+    def _replay_stream(self, entry, start):
+        for index, (offset, text) in enumerate(entry['chunks']):
+            self._wait_until(start, offset)
+            last = index == len(entry['chunks']) - 1
+            yield RecordedResponse(text, entry.get('finish_reason') if last else None)
+
+    def snapshot(self):
+        return dict(self.cassette.snapshot(), mode=self.mode, speed=self.speed)
+
+def create_model_backend(mode=MODEL_BACKEND):
+    if mode == 'gemini':
+        return GeminiBackend()
+    cassette = Cassette()
+    if mode == 'record':
+        return RecordingBackend(cassette)
+    if mode == 'replay':
+        cassette.load()
+        return ReplayBackend(cassette)
+    raise ValueError(f'Unknown MODEL_BACKEND: {mode}')
+
+model_backend = create_model_backend()
+
+# Model used for each operation; small refinements go to a lighter model
+MODEL_FOR_OPERATION = {
+    'validate': os.environ.get('VALIDATE_MODEL', 'models/gemini-2.5-flash'),
+    'generate': os.environ.get('GENERATE_MODEL', 'models/gemini-2.5-flash'),
+    'refine': os.environ.get('REFINE_MODEL', 'models/gemini-2.5-flash'),
+    'refine_small': os.environ.get('LIGHT_REFINE_MODEL', 'models/gemini-2.5-flash-lite'),
+}
+FALLBACK_MODEL = os.environ.get('FALLBACK_MODEL', 'models/gemini-2.5-flash-lite')
+LIGHT_REFINE_MAX_TOKENS = int(os.environ.get('LIGHT_REFINE_MAX_TOKENS', 1500))
+
+# Circuit breaker thresholds over each model's recent calls
+CIRCUIT_WINDOW = 50
+CIRCUIT_MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', 10))
+CIRCUIT_ERROR_RATE = float(os.environ.get('CIRCUIT_ERROR_RATE', 0.5))
+CIRCUIT_LATENCY_SECONDS = float(os.environ.get('CIRCUIT_LATENCY_SECONDS', 90))
+CIRCUIT_COOLDOWN_SECONDS = float(os.environ.get('CIRCUIT_COOLDOWN_SECONDS', 30))
+
+class CircuitBreaker:
+    """
+    Rolling error-rate and latency breaker for one model.
+
+    Opens when at least CIRCUIT_ERROR_RATE of the recent calls failed or
+    their median latency is above CIRCUIT_LATENCY_SECONDS. After the
+    cooldown one probe call is let through (half-open); it closes the
+    circuit if it succeeds in time and reopens it otherwise.
+    """
+
+    def __init__(self, window=CIRCUIT_WINDOW, min_calls=CIRCUIT_MIN_CALLS, error_rate=CIRCUIT_ERROR_RATE,
+                 latency_seconds=CIRCUIT_LATENCY_SECONDS, cooldown_seconds=CIRCUIT_COOLDOWN_SECONDS):
+        self.results = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.latency_seconds = latency_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.state = 'closed'
+        self.opened_at = 0
+        self.probing = False
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def _refresh(self):
+        # Caller holds the lock
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown_seconds:
+            self.state = 'half_open'
+            self.probing = False
+
+    def allow(self):
+        """
+        Return whether a call may go to this model now. This only looks at
+        the state; the half-open probe slot is claimed by begin().
+        """
+        with self.lock:
+            self._refresh()
+            return self.state == 'closed' or (self.state == 'half_open' and not self.probing)
+
+    def begin(self):
+        """Claim the half-open probe slot; returns whether this call is the probe"""
+        with self.lock:
+            self._refresh()
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def _open(self):
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self.probing = False
+        self.trips += 1
+
+    def record(self, ok, latency, probe=False):
+        with self.lock:
+            if self.state == 'half_open':
+                # Only the probe decides; other calls still in flight don't count
+                if not probe:
+                    return
+                if ok and latency <= self.latency_seconds:
+                    self.state = 'closed'
+                    self.results.clear()
+                    self.probing = False
+                else:
+                    self._open()
+                return
+            
+            self.results.append((ok, latency))
+            if self.state != 'closed' or len(self.results) < self.min_calls:
+                return
+            failures = sum(1 for ok, _ in self.results if not ok)
+            latencies = sorted(latency for _, latency in self.results)
+            if (failures / len(self.results) >= self.error_rate
+                    or latencies[len(latencies) // 2] > self.latency_seconds):
+                self._open()
+
+    def release(self, probe=True):
+        """Give back a half-open probe that never got an answer"""
+        if not probe:
+            return
+        with self.lock:
+            self.probing = False
+
+    def snapshot(self):
+        with self.lock:
+            failures = sum(1 for ok, _ in self.results if not ok)
+            return {'state': self.state, 'calls': len(self.results), 'failures': failures, 'trips': self.trips}
+
+class ModelRouter:
+    """
+    Picks the model for an operation and routes around a degraded one:
+    while a model's circuit is open, its calls go to FALLBACK_MODEL until
+    a probe shows it has recovered.
+    """
+
+    def __init__(self, models=MODEL_FOR_OPERATION, fallback=FALLBACK_MODEL):
+        self.models = dict(models)
+        self.fallback = fallback
+        self.breakers = {}
+        self.fallbacks = 0
+        self.lock = threading.Lock()
+
+    def breaker(self, model_name):
+        with self.lock:
+            # Cached-content models may report a versioned name like "...-001"
+            for known in self.breakers:
+                if model_name.startswith(known + '-0'):
+                    model_name = known
+                    break
+            if model_name not in self.breakers:
+                self.breakers[model_name] = CircuitBreaker()
+            return self.breakers[model_name]
+
+    def select(self, operation, small=False):
+        """Return the model name to use for an operation"""
+        if small and operation == 'refine':
+            operation = 'refine_small'
+        model_name = self.models[operation]
+        if model_name == self.fallback or self.breaker(model_name).allow():
+            return model_name
+        with self.lock:
+            self.fallbacks += 1
+        app.logger.warning('Circuit open for %s, using %s', model_name, self.fallback)
+        return self.fallback
+
+    def observe(self, model_name, fn, *args, **kwargs):
+        """Call fn and record its outcome and latency against model_name"""
+        breaker = self.breaker(model_name or '')
+        # The probe slot is claimed here, not in select(), so it is always handed back
+        probe = breaker.begin()
+        start = time.monotonic()
+        ok = None
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        except Exception:
+            ok = False
+            raise
+        finally:
+            if ok is None:
+                # Cancelled before an answer
+                breaker.release(probe)
+            else:
+                breaker.record(ok, time.monotonic() - start, probe)
+
+    def snapshot(self):
+        with self.lock:
+            breakers = dict(self.breakers)
+            fallbacks = self.fallbacks
+        return {
+            'models': self.models,
+            'fallback': self.fallback,
+            'fallbacks': fallbacks,
+            'circuits': {name: breaker.snapshot() for name, breaker in breakers.items()},
+        }
+
+model_router = ModelRouter()
+
+def _close_stream(response):
+    """Cancel an unfinished streaming response so the model stops generating"""
+    # Gemini responses wrap the gRPC/REST stream, which has cancel(); replayed
+    # and recorded streams are generators
+    for target in (getattr(response, '_iterator', None), response):
+        for name in ('cancel', 'close'):
+            method = getattr(target, name, None)
+            if callable(method):
+                try:
+                    method()
+                except Exception:
+                    pass
+                return
+
+def stream_content(send, *args, **kwargs):
+    """
+    Make a model call with send (generate_content or send_message) as a
+    stream and collect it. Cancellation is checked between chunks; a
+    cancelled or failed call closes the stream, so the upstream request
+    stops and the worker (and its admission slot) is freed right away
+    instead of waiting for the whole response.
+    """
+    response = send(*args, stream=True, **kwargs)
+    texts = []
+    last = None
+    try:
+        for chunk in response:
+            check_cancelled()
+            try:
+                texts.append(chunk.text)
+            except ValueError:
+                # Chunks without parts (e.g. only a finish reason) have no text
+                pass
+            last = chunk
+    except BaseException:
+        _close_stream(response)
+        raise
+    return RecordedResponse(''.join(texts), get_finish_reason(last) if last is not None else None)
+
+def generate_with_continuation(model, prompt, operation='generate'):
+    """
+    Generate content and, if the output hit the token limit or left the
+    document unclosed, ask the model to continue from where it stopped.
+
+    Only the missing tail is generated on each follow-up, so a long page
+    costs roughly one generation instead of a full regeneration. The first
+    call is hedged per operation when hedging is enabled, and its outcome
+    feeds the model's circuit breaker.
+    """
+    check_cancelled()
+    response = model_router.observe(getattr(model, 'model_name', None), hedging_policy.call, operation,
+                                    stream_content, model.generate_content, prompt,
+                                    request_options=upstream_request_options())
+    code = response.text
+
+    for _ in range(MAX_CONTINUATIONS):
+        if get_finish_reason(response) != 'MAX_TOKENS' and not is_truncated_html(code):
+            break
+        chat = model.start_chat(history=[
+            {'role': 'user', 'parts': prompt if isinstance(prompt, list) else [prompt]},
+            {'role': 'model', 'parts': [code]},
+        ])
+        check_cancelled()
+        response = stream_content(chat.send_message, CONTINUATION_PROMPT, request_options=upstream_request_options())
+        continuation = response.text
+        if not continuation.strip():
+            break
+        code = _join_continuation(code, continuation)
+
+    return code
+
+# Static instructions sent as the model's system instruction. They are the
+# same on every call, so they are also part of the cached context below.
+GENERATION_SYSTEM_INSTRUCTION = """
+You create complete, working HTML pages with embedded CSS and JavaScript from a user's description.
+
+CRITICAL REQUIREMENTS:
+1. Generate a complete HTML document with <!DOCTYPE html>
+2. Include all CSS in a <style> tag in the <head>
+3. Include all JavaScript in <script> tags
+4. Make it a SINGLE PAGE APPLICATION - all navigation must work within the same page
+5. For tabs, menus, or multi-section layouts:
+   - Use JavaScript to show/hide content
+   - Use # anchors for navigation (e.g., href="#dashboard")
+   - Never use external links or page reloads
+   - Implement tab switching with JavaScript
+6. Make it visually appealing with modern, professional design
+7. Use beautiful colors, proper spacing, and modern typography
+8. Include smooth animations and transitions
+9. Make it fully responsive (mobile-friendly)
+10. Use realistic placeholder content/data
+11. Do not include ANY external dependencies - everything must be inline
+12. If charts are requested, create them using Canvas, SVG, or CSS
+13. Ensure all interactive elements work (buttons, forms, tabs, etc.)
+14. Use modern CSS features like flexbox, grid, gradients, shadows
+15. For navigation/tabs: Always use JavaScript to show/hide sections, never load new pages
+
+IMPORTANT: The page will be displayed in an iframe, so:
+- All links must use # anchors or JavaScript
+- No external navigation
+- Forms should not actually submit (use preventDefault)
+- Everything must work within a single HTML document
+
+The output should be production-ready code that looks professional and polished.
+
+Return ONLY the complete HTML code with no explanations, no markdown formatting, no code blocks - just pure HTML.
+"""
+
+REFINEMENT_SYSTEM_INSTRUCTION = """
+You refine existing HTML/CSS/JavaScript pages based on user feedback.
+
+REQUIREMENTS:
+1. Apply ONLY the requested changes while keeping everything else intact
+2. Maintain the single-page application structure
+3. Keep all styles inline in the <style> tag
+4. Keep all JavaScript inline in <script> tags
+5. Ensure all navigation and tabs continue to work within the same page
+6. Do not remove any existing functionality
+7. Fix any issues mentioned by the user
+8. Improve the specific areas requested
+9. Maintain responsive design
+10. Keep the code self-contained with no external dependencies
+
+IMPORTANT:
+- Focus on the specific changes requested
+- Don't completely rewrite the code unless necessary
+- Preserve the overall structure and design
+- Make sure all interactive elements continue to work
+- The page will be displayed in an iframe, so maintain single-page behavior
+
+Return ONLY the complete updated HTML code with no explanations, no markdown formatting, no code blocks - just pure HTML.
+"""
+
+REFINEMENT_DOCUMENT_TEMPLATE = """
+You have the following HTML/CSS/JavaScript code that needs to be refined:
+
+```html
+{code}
+```
+"""
+
+# Title of the page returned by generate_ui_code() when generation fails
+GENERATION_ERROR_TITLE = 'Generation Error'
+
+# 'gemini' uses the Gemini cached-content API, 'local' keeps the cached
+# context in this process (offline stand-in), 'off' disables caching
+CONTEXT_CACHE_BACKEND = os.environ.get('CONTEXT_CACHE_BACKEND', 'gemini')
+
+# Gemini rejects cached contents below a minimum size
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get('CONTEXT_CACHE_MIN_TOKENS', 1024))
+
+class LocalCachedModel:
+    """
+    Offline stand-in for a model created from Gemini cached content.
+
+    Keeps the cached contents in memory and prepends them to every request,
+    so the cached code path can be exercised without the caching API.
+    """
+
+    def __init__(self, model_name, system_instruction, contents):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.contents = list(contents)
+
+    def _model(self):
+        return model_backend.model(self.model_name, system_instruction=self.system_instruction)
+
+    def generate_content(self, request, **kwargs):
+        parts = request if isinstance(request, list) else [request]
+        return self._model().generate_content(self.contents + parts, **kwargs)
+
+    def start_chat(self, history=None):
+        history = [dict(turn) for turn in history or []]
+        if history:
+            history[0]['parts'] = self.contents + list(history[0]['parts'])
+        return self._model().start_chat(history=history)
+
+class ContextCache:
+    """
+    Keeps one cached model context per session: the system instruction plus
+    the current document of the session's latest version.
+
+    Nothing but the system instruction stays the same across versions, and
+    every refinement makes a new version, so a cache only pays off when the
+    same version is sent again (a retry after a failed refinement, or a
+    refinement after speculative ones). The first use of a version is only
+    remembered; the second creates the cache and later ones hit it.
+
+    Entries live as long as the session; the remote cache TTL is the
+    session TTL and is extended while the session is in use, so caches of
+    evicted sessions expire on their own.
+    """
+
+    def __init__(self, backend=CONTEXT_CACHE_BACKEND, ttl_seconds=None, min_tokens=CONTEXT_CACHE_MIN_TOKENS):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds or SESSION_TTL_SECONDS
+        self.min_tokens = min_tokens
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+
+    def get_model(self, model_name, system_instruction, document, session_id=None, version=None):
+        """
+        Return (model, cached). When cached is True the document is already
+        part of the model's context and must not be sent again.
+        """
+        if (self.backend == 'off' or not session_id
+                or estimate_tokens(system_instruction + document) < self.min_tokens):
+            return model_backend.model(model_name, system_instruction=system_instruction), False
+
+        key = (model_name, version, hashlib.sha1(document.encode('utf-8')).hexdigest())
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(session_id)
+            if entry and entry['key'] == key and entry['expires'] > now and entry['handle'] is not None:
+                self.hits += 1
+                self._extend(entry, now)
+                return self._model_for(entry), True
+            self.misses += 1
+            reused = entry is not None and entry['key'] == key
+            if not reused:
+                # First use of this version: remember it, but don't pay for a cache yet
+                self.entries[session_id] = {'key': key, 'handle': None, 'expires': now + self.ttl_seconds}
+            else:
+                self.entries.pop(session_id, None)
+
+        # The session moved to a new version, so its old context is useless
+        if entry and entry['handle'] is not None:
+            self._delete(entry)
+        if not reused:
+            return model_backend.model(model_name, system_instruction=system_instruction), False
+
+        try:
+            handle = self._create(model_name, system_instruction, document, session_id, version)
+        except Exception as e:
+            app.logger.warning('Context cache unavailable, sending full prompt: %s', e)
+            return model_backend.model(model_name, system_instruction=system_instruction), False
+
+        entry = {'key': key, 'handle': handle, 'expires': now + self.ttl_seconds}
+        with self.lock:
+            self.entries[session_id] = entry
+            self.created += 1
+        return self._model_for(entry), True
+
+    def evict(self, session_id):
+        """
+        Forget the cached context of an evicted session. The remote copy is
+        left to expire through its TTL since the user's API key is not kept.
+        """
+        with self.lock:
+            self.entries.pop(session_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {'backend': self.backend, 'entries': len(self.entries),
+                    'hits': self.hits, 'misses': self.misses, 'created': self.created}
 
-def refine_ui_code(current_code, refinement_prompt, api_key):
+    def _create(self, model_name, system_instruction, document, session_id, version):
+        contents = [{'role': 'user', 'parts': [document]}]
+        if self.backend == 'local':
+            return LocalCachedModel(model_name, system_instruction, contents)
+        # Created through the client for the caller's key (see GeminiBackend)
+        client = model_backend.cache_client()
+        if client is None:
+            raise ValueError('No API key for the cached-content API')
+        return client.create_cached_content(request=genai.protos.CreateCachedContentRequest(
+            cached_content=genai.protos.CachedContent(
+                model=model_name,
+                display_name=f'{session_id}-v{version}'[:128],
+                system_instruction=genai.protos.Content(parts=[genai.protos.Part(text=system_instruction)]),
+                contents=[genai.protos.Content(role='user', parts=[genai.protos.Part(text=document)])],
+                ttl=timedelta(seconds=self.ttl_seconds),
+            )))
+
+    def _model_for(self, entry):
+        if self.backend == 'local':
+            return entry['handle']
+        # What GenerativeModel.from_cached_content() does, minus its global client
+        model = model_backend.model(entry['handle'].model)
+        model._cached_content = entry['handle'].name
+        return model
+
+    def _extend(self, entry, now):
+        # Only touch the remote TTL once half of it has been used up
+        if entry['expires'] - now > self.ttl_seconds / 2:
+            return
+        entry['expires'] = now + self.ttl_seconds
+        if self.backend != 'local':
+            try:
+                model_backend.cache_client().update_cached_content(request=genai.protos.UpdateCachedContentRequest(
+                    cached_content=genai.protos.CachedContent(name=entry['handle'].name,
+                                                              ttl=timedelta(seconds=self.ttl_seconds)),
+                    update_mask={'paths': ['ttl']}))
+            except Exception:
+                pass
+
+    def _delete(self, entry):
+        if self.backend == 'local':
+            return
+        try:
+            model_backend.cache_client().delete_cached_content(name=entry['handle'].name)
+        except Exception:
+            pass
+
+# Cached-content handles can't be recorded or replayed, so record and
+# replay keep the cached context in-process
+context_cache = ContextCache(CONTEXT_CACHE_BACKEND if MODEL_BACKEND == 'gemini' or CONTEXT_CACHE_BACKEND == 'off'
+                             else 'local')
+
+def refine_ui_code(current_code, refinement_prompt, api_key, session_id=None, version=None):
     """
-    Refine existing HTML/CSS code based on user feedback using Gemini API
+    Refine existing HTML/CSS code based on user feedback using Gemini API.
+    Raises if the model call fails; current_code may be the minified prompt
+    copy, so callers keep their own version instead of saving it.
     """
     
-    prompt = f"""
-    You have the following HTML/CSS/JavaScript code that needs to be refined:
-    
-    ```html
-    {current_code}
-    ```
-    
+    document = REFINEMENT_DOCUMENT_TEMPLATE.format(code=current_code)
+    request_text = f"""
     The user has requested the following changes/fixes:
     {refinement_prompt}
     
-    REQUIREMENTS:
-    1. Apply ONLY the requested changes while keeping everything else intact
-    2. Maintain the single-page application structure
-    3. Keep all styles inline in the <style> tag
-    4. Keep all JavaScript inline in <script> tags
-    5. Ensure all navigation and tabs continue to work within the same page
-    6. Do not remove any existing functionality
-    7. Fix any issues mentioned by the user
-    8. Improve the specific areas requested
-    9. Maintain responsive design
-    10. Keep the code self-contained with no external dependencies
+    Return ONLY the complete updated HTML code.
+    """
     
-    IMPORTANT:
-    - Focus on the specific changes requested
-    - Don't completely rewrite the code unless necessary
-    - Preserve the overall structure and design
-    - Make sure all interactive elements continue to work
-    - The page will be displayed in an iframe, so maintain single-page behavior
+    # Configure Gemini with the user's API key
+    model_backend.configure(api_key)
     
-    Return ONLY the complete updated HTML code with no explanations, no markdown formatting, no code blocks - just pure HTML.
-    """
+    # Reuse the cached instructions and document for this session version
+    small = estimate_tokens(current_code) <= LIGHT_REFINE_MAX_TOKENS
+    model, cached = context_cache.get_model(
+        model_router.select('refine', small), REFINEMENT_SYSTEM_INSTRUCTION, document, session_id, version)
+    prompt = request_text if cached else [document, request_text]
     
-    try:
-        # Configure Gemini with the user's API key
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('models/gemini-2.5-flash')
-        
-        # Generate refined content
-        response = model.generate_content(prompt)
-        code = response.text
-        
-        # Clean up the response - remove any markdown formatting if present
-        if '```html' in code:
-            code = code.split('```html')[1].split('```')[0]
-        elif '```' in code:
-            code = code.split('```')[1].split('```')[0]
-        
-        # Ensure it starts with DOCTYPE
-        code = code.strip()
-        if not code.lower().startswith('<!doctype'):
-            code = '<!DOCTYPE html>\n' + code
-            
-        return code
+    # Generate refined content
+    code = generate_with_continuation(model, prompt, 'refine')
+    
+    # Clean up the response - remove any markdown formatting if present
+    code = strip_markdown_fences(code).strip()
+    if not code:
+        raise ValueError('The model returned an empty page')
+    
+    # Ensure it starts with DOCTYPE
+    if not code.lower().startswith('<!doctype'):
+        code = '<!DOCTYPE html>\n' + code
         
-    except Exception as e:
-        # Return the original code with an error message
-        return current_code
+    return code
 
-def fix_navigation_issues(html_code):
-    """
-    Fix navigation issues in generated HTML to prevent iframe breakout
-    """
-    # Add base tag to ensure all relative URLs stay in the iframe
-    if '<head>' in html_code and '<base' not in html_code:
-        html_code = html_code.replace('<head>', '<head>\n    <base target="_self">')
-    
-    # Add JavaScript to intercept all link clicks and prevent navigation
-    navigation_fix_script = """
+# JavaScript injected into every generated page to intercept link clicks and
+# prevent navigation out of the preview iframe
+NAVIGATION_FIX_SCRIPT = """
     <script>
     // Prevent all links from navigating away
     document.addEventListener('DOMContentLoaded', function() {
@@ -1592,73 +5892,993 @@ def fix_navigation_issues(html_code):
     });
     </script>
     """
+
+BASE_TARGET_TAG = '<head>\n    <base target="_self">'
+
+def fix_navigation_issues(html_code):
+    """
+    Fix navigation issues in generated HTML to prevent iframe breakout
+    """
+    # Add base tag to ensure all relative URLs stay in the iframe
+    if '<head>' in html_code and '<base' not in html_code:
+        html_code = html_code.replace('<head>', BASE_TARGET_TAG)
+    
+    # Add JavaScript to intercept all link clicks and prevent navigation,
+    # unless the model kept the script from a previous version
+    if NAVIGATION_FIX_SCRIPT.strip() in html_code:
+        return html_code
     
     # Insert the script before closing body tag
     if '</body>' in html_code:
-        html_code = html_code.replace('</body>', navigation_fix_script + '\n</body>')
+        html_code = html_code.replace('</body>', NAVIGATION_FIX_SCRIPT + '\n</body>')
     else:
-        html_code += navigation_fix_script
+        html_code += NAVIGATION_FIX_SCRIPT
     
     return html_code
 
-def generate_ui_code(description, api_key):
+# Rough characters-per-token ratio used to report prompt savings
+CHARS_PER_TOKEN = 4
+
+# Blocks whose content is kept verbatim (or minified separately) when
+# compacting HTML for a prompt
+_PROTECTED_BLOCK_RE = re.compile(r'(<(script|style|pre|textarea)\b[^>]*>)(.*?)(</\2\s*>)', re.S | re.I)
+_HTML_COMMENT_RE = re.compile(r'<!--(?!\[if).*?-->', re.S)
+_CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+# Quoted strings are matched first so comment markers and whitespace inside
+# them are left alone
+_CSS_STRING_OR_COMMENT_RE = re.compile(r'("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')|/\*.*?\*/', re.S)
+_CSS_SPACE_RE = re.compile(r'[ \t\f\r]*([{};,>])[ \t\f\r]*')
+_LINE_EDGE_SPACE_RE = re.compile(r'[ \t\f\r]*\n[ \t\f\r]*')
+_SPACE_RUN_RE = re.compile(r'[ \t\f\r]+')
+
+def estimate_tokens(text):
     """
-    Generate HTML/CSS code based on the description using Gemini API
+    Estimate the number of model tokens in a piece of text
+    """
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def strip_navigation_fix(html_code):
+    """
+    Remove the script and base tag added by fix_navigation_issues().
+
+    This is the inverse of fix_navigation_issues(), which adds them back to
+    whatever the model returns.
+    """
+    html_code = html_code.replace(NAVIGATION_FIX_SCRIPT + '\n</body>', '</body>')
+    html_code = html_code.replace(NAVIGATION_FIX_SCRIPT, '')
+    html_code = html_code.replace(BASE_TARGET_TAG, '<head>')
+    return html_code
+
+def _keep_newlines(text):
+    # Replaces a removed comment so every later line keeps its number
+    return '\n' * text.count('\n')
+
+def _minify_css_text(css):
+    css = _CSS_SPACE_RE.sub(r'\1', css)
+    css = _LINE_EDGE_SPACE_RE.sub('\n', css)
+    return _SPACE_RUN_RE.sub(' ', css)
+
+def _minify_css(css):
+    parts = []
+    cursor = 0
+    for match in _CSS_STRING_OR_COMMENT_RE.finditer(css):
+        parts.append(_minify_css_text(css[cursor:match.start()]))
+        parts.append(match.group(1) or _keep_newlines(match.group(0)))
+        cursor = match.end()
+    parts.append(_minify_css_text(css[cursor:]))
+    return ''.join(parts)
+
+def _minify_markup(markup):
+    markup = _HTML_COMMENT_RE.sub(lambda match: _keep_newlines(match.group(0)), markup)
+    markup = _LINE_EDGE_SPACE_RE.sub('\n', markup)
+    return _SPACE_RUN_RE.sub(' ', markup)
+
+def _compact_lines(code):
+    """
+    Minify code line by line and return (original line number, compact
+    line) pairs for the lines that are not empty afterwards
+    """
+    parts = []
+    verbatim = set()
+    cursor = 0
+    for match in _PROTECTED_BLOCK_RE.finditer(code):
+        parts.append(_minify_markup(code[cursor:match.start()]))
+        open_tag, tag, body, close_tag = match.groups()
+        if tag.lower() == 'style':
+            body = _minify_css(body)
+        else:
+            # Lines starting inside script, pre and textarea bodies are kept
+            # as they are, blank lines and indentation included
+            first_line = code.count('\n', 0, match.start(3)) + 1
+            verbatim.update(range(first_line, first_line + body.count('\n')))
+        parts.append(open_tag + body + close_tag)
+        cursor = match.end()
+    parts.append(_minify_markup(code[cursor:]))
+    # Every step keeps the newlines, so line i is still line i of the input
+    lines = ''.join(parts).split('\n')
+    return [(number, line if number in verbatim else line.strip()) for number, line in enumerate(lines)
+            if number in verbatim or line.strip()]
+
+def minify_code_for_prompt(html_code):
+    """
+    Shrink a page before it is embedded in a refinement prompt.
+
+    Strips the injected navigation fix (it is re-added after refinement),
+    removes HTML and CSS comments, indentation and repeated whitespace
+    outside quoted CSS strings. Script, pre and textarea contents are left
+    untouched, and lines are never joined, so restore_formatting() can map
+    the model's answer back onto the original lines. Returns the compacted
+    code and a dict with the size savings.
+    """
+    code = strip_navigation_fix(html_code)
+    compact_code = '\n'.join(line for _, line in _compact_lines(code))
+
+    original_tokens = estimate_tokens(html_code)
+    compact_tokens = estimate_tokens(compact_code)
+    stats = {
+        'original_chars': len(html_code),
+        'compact_chars': len(compact_code),
+        'original_tokens': original_tokens,
+        'compact_tokens': compact_tokens,
+        'tokens_saved': original_tokens - compact_tokens,
+    }
+    return compact_code, stats
+
+def restore_formatting(original_code, refined_code):
+    """
+    Undo the compaction of minify_code_for_prompt() on a refined page.
+
+    Runs of lines the model returned unchanged are replaced by the same
+    lines of original_code, with their indentation, comments and blank
+    lines; lines it changed or added are kept as the model wrote them. So
+    only the edited lines differ from the previous version.
+    """
+    code = strip_navigation_fix(original_code)
+    original_lines = code.split('\n')
+    compact = _compact_lines(code)
+    refined_lines = refined_code.split('\n')
+    matcher = difflib.SequenceMatcher(None, [line for _, line in compact],
+                                      [line.strip() for line in refined_lines], autojunk=False)
+    restored = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            restored.extend(original_lines[compact[i1][0]:compact[i2 - 1][0] + 1])
+        else:
+            restored.extend(refined_lines[j1:j2])
+    return '\n'.join(restored)
+
+# Elements that never have a closing tag
+VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'source', 'track', 'wbr',
+}
+
+# Selectors kept in the CSS context of every scoped refinement because their
+# values (variables, fonts, colors) are inherited by the selected element
+INHERITED_SELECTORS = {':root', 'html', 'body', '*'}
+
+_NTH_OF_TYPE_RE = re.compile(r'^([a-z0-9-]+)(?::nth-of-type\((\d+)\))?$', re.I)
+_PSEUDO_RE = re.compile(r'::?[\w-]+(\([^)]*\))?')
+_COMBINATOR_RE = re.compile(r'\s*[>+~]\s*|\s+')
+
+class _ElementTreeBuilder(HTMLParser):
+    """
+    Builds a lightweight element tree with source offsets for every element
+    """
+
+    def __init__(self, source):
+        super().__init__(convert_charrefs=False)
+        self.source = source
+        # getpos() only counts '\n'; splitlines() would also break on \r,
+        # \x0c, \u2028 and others and shift every later offset
+        self.line_offsets = [0]
+        for line in source.split('\n'):
+            self.line_offsets.append(self.line_offsets[-1] + len(line) + 1)
+        self.root = {'tag': '#document', 'attrs': {}, 'start': 0, 'end': len(source), 'children': []}
+        self.stack = [self.root]
+
+    def _offset(self):
+        line, column = self.getpos()
+        return self.line_offsets[line - 1] + column
+
+    def _add_element(self, tag, attrs):
+        start = self._offset()
+        end = start + len(self.get_starttag_text() or '')
+        node = {'tag': tag, 'attrs': dict(attrs), 'start': start, 'end': end, 'children': []}
+        self.stack[-1]['children'].append(node)
+        return node
+
+    def handle_starttag(self, tag, attrs):
+        node = self._add_element(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(node)
+
+    def handle_startendtag(self, tag, attrs):
+        self._add_element(tag, attrs)
+
+    def handle_endtag(self, tag):
+        for depth in range(len(self.stack) - 1, 0, -1):
+            if self.stack[depth]['tag'] == tag:
+                position = self._offset()
+                # Elements closed implicitly end where the parent closes
+                for node in self.stack[depth + 1:]:
+                    node['end'] = position
+                self.stack[depth]['end'] = self.source.find('>', position) + 1
+                del self.stack[depth:]
+                return
+
+    def build(self):
+        self.feed(self.source)
+        self.close()
+        for node in self.stack[1:]:
+            node['end'] = len(self.source)
+        return self.root
+
+def parse_element_tree(html_code):
+    """
+    Parse HTML into nested dicts with tag, attrs, start/end offsets and children
+    """
+    return _ElementTreeBuilder(html_code).build()
+
+def _iter_elements(node):
+    for child in node['children']:
+        yield child
+        yield from _iter_elements(child)
+
+def find_element(html_code, target_path):
+    """
+    Locate an element by the path produced by the preview picker, e.g.
+    "#pricing > div:nth-of-type(2) > h3:nth-of-type(1)" or "body > main:nth-of-type(1)".
+
+    Returns the element node (with source offsets) or None if it does not
+    exist in the source, e.g. because a script created it at runtime.
+    """
+    root = parse_element_tree(html_code)
+    steps = [step.strip() for step in target_path.split('>') if step.strip()]
+    if not steps:
+        return None
+
+    first = steps.pop(0)
+    node = None
+    for element in _iter_elements(root):
+        if first.startswith('#') and element['attrs'].get('id') == first[1:]:
+            node = element
+            break
+        if not first.startswith('#') and element['tag'] == first.lower():
+            node = element
+            break
+
+    for step in steps:
+        if node is None:
+            return None
+        match = _NTH_OF_TYPE_RE.match(step)
+        if not match:
+            return None
+        tag, index = match.group(1).lower(), int(match.group(2) or 1)
+        same_tag = [child for child in node['children'] if child['tag'] == tag]
+        if len(same_tag) >= index:
+            node = same_tag[index - 1]
+        elif tag != 'tbody':
+            # Browsers insert <tbody> into tables, so it may be missing in the source
+            return None
+    return node
+
+def _subtree_tokens(node):
+    tags, classes, ids = set(), set(), set()
+    for element in [node] + list(_iter_elements(node)):
+        tags.add(element['tag'])
+        classes.update((element['attrs'].get('class') or '').split())
+        if element['attrs'].get('id'):
+            ids.add(element['attrs']['id'])
+    return tags, classes, ids
+
+def _selector_applies(selector, tags, classes, ids):
+    subject = _COMBINATOR_RE.split(selector.strip())[-1]
+    if subject in INHERITED_SELECTORS:
+        return True
+    subject = _PSEUDO_RE.sub('', subject)
+    subject = re.sub(r'\[[^\]]*\]', '', subject)
+    selector_classes = set(re.findall(r'\.([\w-]+)', subject))
+    selector_ids = set(re.findall(r'#([\w-]+)', subject))
+    tag_match = re.match(r'[a-zA-Z][\w-]*', subject)
+    tag = tag_match.group(0).lower() if tag_match else None
+    if not (selector_classes or selector_ids or tag):
+        return False
+    return (selector_classes <= classes and selector_ids <= ids
+            and (tag is None or tag in tags))
+
+def _split_css_rules(css):
+    """Split a stylesheet into top-level (prelude, body) pairs"""
+    rules = []
+    depth = 0
+    prelude_start = 0
+    body_start = 0
+    for index, ch in enumerate(css):
+        if ch == '{':
+            if depth == 0:
+                body_start = index + 1
+            depth += 1
+        elif ch == '}' and depth:
+            depth -= 1
+            if depth == 0:
+                rules.append((css[prelude_start:body_start - 1].strip(), css[body_start:index]))
+                prelude_start = index + 1
+        elif ch == ';' and depth == 0:
+            prelude_start = index + 1
+    return rules
+
+def _filter_css_rules(css, tags, classes, ids, keyframes):
+    kept = []
+    for prelude, body in _split_css_rules(css):
+        if prelude.startswith(('@media', '@supports')):
+            inner = _filter_css_rules(body, tags, classes, ids, keyframes)
+            if inner:
+                kept.append(prelude + '{' + inner + '}')
+        elif prelude.startswith(('@keyframes', '@-webkit-keyframes')):
+            keyframes.append((prelude.split()[-1], prelude + '{' + body.strip() + '}'))
+        elif not prelude.startswith('@'):
+            if any(_selector_applies(s, tags, classes, ids) for s in prelude.split(',')):
+                kept.append(prelude + '{' + body.strip() + '}')
+    return '\n'.join(kept)
+
+def extract_element_css(html_code, node):
+    """
+    Collect the CSS rules from the page's <style> blocks that can apply to
+    the element subtree, plus inherited :root/body rules and any keyframes
+    the kept rules animate with
+    """
+    tags, classes, ids = _subtree_tokens(node)
+    kept = []
+    keyframes = []
+    for match in _PROTECTED_BLOCK_RE.finditer(html_code):
+        if match.group(2).lower() == 'style':
+            css = _CSS_COMMENT_RE.sub('', match.group(3))
+            rules = _filter_css_rules(css, tags, classes, ids, keyframes)
+            if rules:
+                kept.append(rules)
+    css_context = '\n'.join(kept)
+    for name, rule in keyframes:
+        if re.search(r'\b' + re.escape(name) + r'\b', css_context):
+            css_context += '\n' + rule
+    return css_context
+
+def splice_element(html_code, node, new_fragment, extra_css=''):
+    """
+    Replace the element's source span with new_fragment and add any extra
+    CSS as its own <style> block at the end of <head>
     """
+    html_code = html_code[:node['start']] + new_fragment + html_code[node['end']:]
+    if extra_css.strip():
+        style_block = f'<style data-scoped-refinement>\n{extra_css.strip()}\n</style>\n'
+        head_end = html_code.lower().find('</head>')
+        if head_end != -1:
+            html_code = html_code[:head_end] + style_block + html_code[head_end:]
+        else:
+            html_code = style_block + html_code
+    return html_code
+
+def _split_fragment_response(code):
+    """Split a scoped refinement response into the element HTML and extra CSS"""
+    style_start = code.lower().rfind('<style')
+    if style_start == -1:
+        return code.strip(), ''
+    match = _PROTECTED_BLOCK_RE.match(code, style_start)
+    if not match or match.end() < len(code.rstrip()):
+        return code.strip(), ''
+    return code[:style_start].strip(), match.group(3)
+
+def _normalize_text(text):
+    return ' '.join(html.unescape(text).split())
+
+def element_matches_selection(html_code, node, target_tag='', target_text=''):
+    """
+    Check that an element found by its path is the one picked in the
+    preview. The path is built from the live DOM, so elements inserted by
+    the page's scripts can make it point at a different source element.
+    """
+    if target_tag and node['tag'] != target_tag.lower():
+        return False
+    target_text = _normalize_text(target_text)
+    if not target_text:
+        return True
+    source = html_code[node['start']:node['end']]
+    source = re.sub(r'<(script|style)\b.*?</\1\s*>', ' ', source, flags=re.I | re.S)
+    source_text = _normalize_text(re.sub(r'<[^>]*>', ' ', source))[:len(target_text)]
+    # Scripts may still change some of the text (counters, dates), so allow some drift
+    return difflib.SequenceMatcher(None, source_text, target_text).ratio() >= 0.6
+
+class ElementChanged(Exception):
+    """
+    Raised when the element picked in the preview is not in the page
+    source or no longer matches it, so the user has to pick it again
+    """
+
+def refine_element_code(html_code, target_path, refinement_prompt, api_key, target_tag='', target_text=''):
+    """
+    Refine only the element selected in the preview.
+
+    The element subtree and the CSS rules that apply to it are sent to
+    Gemini instead of the whole page, and the result is spliced back into
+    html_code. Returns the updated page and prompt size stats. Raises
+    ElementChanged if the element can't be found in the source or what was
+    found doesn't match the picked tag and text, and lets model errors
+    through, so nothing is stored for a failed refinement.
+    """
+    node = find_element(html_code, target_path)
+    if node is None or not element_matches_selection(html_code, node, target_tag, target_text):
+        app.logger.info('Picked element %s not found in the source', target_path)
+        raise ElementChanged('The selected element has changed or is created by a script - select it again, '
+                             'or clear the selection to refine the whole page')
+
+    original_fragment = html_code[node['start']:node['end']]
+    fragment, _ = minify_code_for_prompt(original_fragment)
+    css_context = extract_element_css(html_code, node)
+
+    prompt = f"""
+    You are editing ONE element of a larger HTML page. Here is the element:
+    
+    ```html
+    {fragment}
+    ```
+    
+    These CSS rules from the page apply to it (for reference only):
+    
+    ```css
+    {css_context}
+    ```
+    
+    The user has requested the following changes/fixes:
+    {refinement_prompt}
+    
+    REQUIREMENTS:
+    1. Apply ONLY the requested changes to this element
+    2. Return the complete updated element with the same root tag, ids and classes
+    3. Keep any inline scripts and event handlers working
+    4. If CSS changes are needed, add ONE <style> block AFTER the element containing only new or overriding rules
+    5. Scope new CSS rules to this element's ids and classes so the rest of the page is not affected
     
+    Return ONLY the updated element HTML (and the optional <style> block) with no explanations, no markdown formatting, no code blocks.
+    """
+
+    full_tokens = estimate_tokens(html_code)
+    prompt_stats = {
+        'scope': target_path,
+        'original_tokens': full_tokens,
+        'compact_tokens': estimate_tokens(fragment) + estimate_tokens(css_context),
+    }
+    prompt_stats['tokens_saved'] = full_tokens - prompt_stats['compact_tokens']
+
+    model_backend.configure(api_key)
+    model_name = model_router.select('refine', prompt_stats['compact_tokens'] <= LIGHT_REFINE_MAX_TOKENS)
+    model = model_backend.model(model_name)
+    check_cancelled()
+    response = model_router.observe(model_name, stream_content, model.generate_content, prompt,
+                                    request_options=upstream_request_options())
+    code = strip_markdown_fences(response.text).strip()
+
+    new_fragment, extra_css = _split_fragment_response(code)
+    if not new_fragment:
+        raise ValueError('The model returned an empty element')
+    new_fragment = restore_formatting(original_fragment, new_fragment)
+    return splice_element(html_code, node, new_fragment, extra_css), prompt_stats
+
+# Pre-built page skeletons for the common prompt categories. The model only
+# returns the theme, the content of each slot and optional extra CSS/JS as
+# JSON, and the server assembles the page, which cuts the output size (and
+# so the latency) of a generation substantially. A skeleton has a fixed set
+# of sections, so prompts asking for others fall back to full-page generation.
+SKELETON_TEMPLATES_ENABLED = os.environ.get('SKELETON_TEMPLATES_ENABLED', '1') == '1'
+
+# Section names a prompt may ask for; a skeleton is only used when its slots
+# cover every one the prompt mentions
+SKELETON_SECTION_TERMS = (
+    'about', 'blog', 'calendar', 'cart', 'chart', 'chat', 'checkout', 'contact', 'faq', 'feature',
+    'footer', 'form', 'gallery', 'hero', 'login', 'map', 'newsletter', 'portfolio', 'post', 'pricing',
+    'project', 'review', 'search', 'sidebar', 'sign up', 'signup', 'skill', 'table', 'team',
+    'testimonial', 'timeline', 'video',
+)
+
+SKELETON_THEME_DEFAULTS = {
+    '--primary': '#667eea',
+    '--secondary': '#764ba2',
+    '--accent': '#f6ad55',
+    '--bg': '#f7f8fc',
+    '--surface': '#ffffff',
+    '--text': '#1a202c',
+    '--muted': '#718096',
+    '--radius': '12px',
+    '--font': "-apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif",
+}
+
+SKELETON_BASE_CSS = """
+* { margin: 0; padding: 0; box-sizing: border-box; }
+html { scroll-behavior: smooth; }
+body { font-family: var(--font); background: var(--bg); color: var(--text); line-height: 1.6; }
+a { color: var(--primary); text-decoration: none; }
+img { max-width: 100%; display: block; }
+h1, h2, h3, h4 { line-height: 1.2; margin-bottom: 0.5em; }
+h1 { font-size: clamp(2rem, 5vw, 3.5rem); }
+h2 { font-size: clamp(1.5rem, 3vw, 2.25rem); }
+p { color: var(--muted); margin-bottom: 1em; }
+.container { width: min(1200px, 92%); margin: 0 auto; }
+.section { padding: 4rem 0; }
+.section-title { text-align: center; margin-bottom: 2.5rem; }
+.grid { display: grid; gap: 1.5rem; grid-template-columns: repeat(auto-fit, minmax(240px, 1fr)); }
+.flex { display: flex; gap: 1rem; align-items: center; }
+.card { background: var(--surface); border-radius: var(--radius); padding: 1.5rem; box-shadow: 0 4px 20px rgba(0,0,0,0.06); transition: transform 0.3s, box-shadow 0.3s; }
+.card:hover { transform: translateY(-4px); box-shadow: 0 12px 30px rgba(0,0,0,0.1); }
+.btn { display: inline-block; padding: 0.75rem 1.5rem; border-radius: var(--radius); border: none; cursor: pointer; font-weight: 600; background: linear-gradient(135deg, var(--primary), var(--secondary)); color: #fff; transition: transform 0.2s, box-shadow 0.2s; }
+.btn:hover { transform: translateY(-2px); box-shadow: 0 8px 20px rgba(0,0,0,0.15); }
+.btn-outline { background: transparent; color: var(--primary); border: 2px solid var(--primary); }
+.badge { display: inline-block; padding: 0.2rem 0.6rem; border-radius: 999px; background: var(--accent); color: #fff; font-size: 0.8rem; }
+.navbar { position: sticky; top: 0; z-index: 100; background: var(--surface); box-shadow: 0 2px 10px rgba(0,0,0,0.05); }
+.navbar .container { display: flex; justify-content: space-between; align-items: center; padding: 1rem 0; }
+.nav-links { display: flex; gap: 1.5rem; list-style: none; }
+.nav-links a { color: var(--text); font-weight: 500; }
+.nav-links a:hover, .nav-links a.active { color: var(--primary); }
+.nav-toggle { display: none; background: none; border: none; font-size: 1.5rem; cursor: pointer; color: var(--text); }
+.footer { background: var(--text); color: #fff; padding: 3rem 0 1.5rem; }
+.footer p, .footer a { color: rgba(255,255,255,0.75); }
+input, textarea, select { width: 100%; padding: 0.75rem; border: 1px solid #e2e8f0; border-radius: var(--radius); font: inherit; }
+.reveal { opacity: 0; transform: translateY(20px); transition: opacity 0.6s, transform 0.6s; }
+.reveal.visible { opacity: 1; transform: none; }
+@media (max-width: 768px) {
+  .nav-toggle { display: block; }
+  .nav-links { display: none; position: absolute; top: 100%; left: 0; right: 0; flex-direction: column; background: var(--surface); padding: 1rem 4%; }
+  .nav-links.open { display: flex; }
+  .section { padding: 2.5rem 0; }
+}
+"""
+
+SKELETON_BASE_SCRIPT = """
+document.querySelectorAll('.nav-toggle').forEach(function(toggle) {
+  toggle.addEventListener('click', function() {
+    document.querySelectorAll('.nav-links').forEach(function(links) { links.classList.toggle('open'); });
+  });
+});
+if ('IntersectionObserver' in window) {
+  var observer = new IntersectionObserver(function(entries) {
+    entries.forEach(function(entry) { if (entry.isIntersecting) entry.target.classList.add('visible'); });
+  }, { threshold: 0.1 });
+  document.querySelectorAll('.reveal').forEach(function(el) { observer.observe(el); });
+} else {
+  document.querySelectorAll('.reveal').forEach(function(el) { el.classList.add('visible'); });
+}
+"""
+
+# Layout HTML per category; {{slot}} markers are filled with model output
+SKELETON_TEMPLATES = {
+    'dashboard': {
+        'slots': {
+            'sidebar': 'logo and <ul class="side-links"> of # anchor menu items',
+            'header': 'page title, search input and user profile',
+            'main': 'metric cards, charts (Canvas/SVG/CSS) and tables, using .grid and .card',
+        },
+        'css': """
+.app { display: grid; grid-template-columns: 250px 1fr; min-height: 100vh; }
+.sidebar { background: linear-gradient(180deg, var(--primary), var(--secondary)); color: #fff; padding: 1.5rem; }
+.sidebar a { color: rgba(255,255,255,0.85); display: block; padding: 0.6rem 0.8rem; border-radius: 8px; }
+.sidebar a:hover, .sidebar a.active { background: rgba(255,255,255,0.15); color: #fff; }
+.side-links { list-style: none; margin-top: 2rem; }
+.topbar { display: flex; justify-content: space-between; align-items: center; padding: 1rem 2rem; background: var(--surface); box-shadow: 0 2px 10px rgba(0,0,0,0.05); }
+.content { padding: 2rem; display: flex; flex-direction: column; gap: 1.5rem; }
+table { width: 100%; border-collapse: collapse; }
+th, td { padding: 0.75rem; text-align: left; border-bottom: 1px solid #edf2f7; }
+@media (max-width: 768px) { .app { grid-template-columns: 1fr; } .sidebar { padding: 1rem; } }
+""",
+        'html': """
+<div class="app">
+  <aside class="sidebar">{{sidebar}}</aside>
+  <div>
+    <header class="topbar">{{header}}</header>
+    <main class="content">{{main}}</main>
+  </div>
+</div>
+""",
+    },
+    'landing': {
+        'slots': {
+            'nav': 'brand name and <ul class="nav-links"> of # anchor links, plus a .nav-toggle button',
+            'hero': 'headline, subheading and CTA buttons',
+            'features': 'section title and a .grid of feature .card items with icons',
+            'pricing': 'section title and a .grid of pricing tier .card items',
+            'testimonials': 'section title and testimonial quotes',
+            'footer': 'links and newsletter signup form',
+        },
+        'css': """
+.hero { padding: 6rem 0; text-align: center; background: linear-gradient(135deg, var(--primary), var(--secondary)); color: #fff; }
+.hero p { color: rgba(255,255,255,0.85); font-size: 1.2rem; max-width: 640px; margin: 1rem auto 2rem; }
+.hero .btn { background: #fff; color: var(--primary); }
+.pricing .card.featured { border: 2px solid var(--primary); transform: scale(1.03); }
+.testimonials blockquote { font-style: italic; }
+""",
+        'html': """
+<nav class="navbar"><div class="container">{{nav}}</div></nav>
+<header class="hero" id="home"><div class="container">{{hero}}</div></header>
+<section class="section features" id="features"><div class="container">{{features}}</div></section>
+<section class="section pricing" id="pricing"><div class="container">{{pricing}}</div></section>
+<section class="section testimonials" id="testimonials"><div class="container">{{testimonials}}</div></section>
+<footer class="footer" id="contact"><div class="container">{{footer}}</div></footer>
+""",
+    },
+    'blog': {
+        'slots': {
+            'nav': 'blog name and <ul class="nav-links"> of # anchor links, plus a .nav-toggle button',
+            'hero': 'blog title and tagline over a gradient or image background',
+            'posts': 'a .grid of article .card items with image, title, excerpt and read more link',
+            'sidebar': 'categories, popular posts and newsletter widgets as .card items',
+            'footer': 'copyright and links',
+        },
+        'css': """
+.hero { padding: 5rem 0; text-align: center; background: linear-gradient(135deg, var(--primary), var(--secondary)); color: #fff; }
+.hero p { color: rgba(255,255,255,0.85); }
+.blog-layout { display: grid; grid-template-columns: 1fr 300px; gap: 2rem; }
+.blog-sidebar { display: flex; flex-direction: column; gap: 1.5rem; }
+.card img { border-radius: calc(var(--radius) - 4px); margin-bottom: 1rem; height: 180px; width: 100%; object-fit: cover; }
+@media (max-width: 900px) { .blog-layout { grid-template-columns: 1fr; } }
+""",
+        'html': """
+<nav class="navbar"><div class="container">{{nav}}</div></nav>
+<header class="hero" id="home"><div class="container">{{hero}}</div></header>
+<main class="section"><div class="container blog-layout">
+  <section id="articles">{{posts}}</section>
+  <aside class="blog-sidebar">{{sidebar}}</aside>
+</div></main>
+<footer class="footer" id="contact"><div class="container">{{footer}}</div></footer>
+""",
+    },
+    'ecommerce': {
+        'slots': {
+            'nav': 'store name, <ul class="nav-links"> of # anchor links, cart icon and a .nav-toggle button',
+            'gallery': 'main product image (SVG or CSS placeholder) and clickable thumbnails',
+            'details': 'title, price, rating, description, size/color selectors, quantity and add to cart button',
+            'reviews': 'section title and customer review .card items with star ratings',
+            'related': 'section title and a .grid of related product .card items',
+            'footer': 'links and contact information',
+        },
+        'css': """
+.product { display: grid; grid-template-columns: 1fr 1fr; gap: 3rem; align-items: start; }
+.gallery { display: flex; flex-direction: column; gap: 1rem; }
+.price { font-size: 2rem; font-weight: 700; color: var(--primary); }
+.stars { color: var(--accent); letter-spacing: 2px; }
+@media (max-width: 768px) { .product { grid-template-columns: 1fr; } }
+""",
+        'html': """
+<nav class="navbar"><div class="container">{{nav}}</div></nav>
+<main class="section"><div class="container product">
+  <div class="gallery">{{gallery}}</div>
+  <div class="details">{{details}}</div>
+</div></main>
+<section class="section reviews" id="reviews"><div class="container">{{reviews}}</div></section>
+<section class="section related" id="related"><div class="container">{{related}}</div></section>
+<footer class="footer" id="contact"><div class="container">{{footer}}</div></footer>
+""",
+    },
+    'portfolio': {
+        'slots': {
+            'nav': 'name and <ul class="nav-links"> of # anchor links, plus a .nav-toggle button',
+            'hero': 'name, title, short intro and CTA buttons',
+            'about': 'about text and skill .badge items',
+            'projects': 'section title and a .grid of project .card items with hover effects',
+            'contact': 'section title and a contact form',
+            'footer': 'social links and copyright',
+        },
+        'css': """
+.hero { min-height: 80vh; display: flex; align-items: center; background: linear-gradient(135deg, var(--primary), var(--secondary)); color: #fff; }
+.hero p { color: rgba(255,255,255,0.85); font-size: 1.2rem; }
+.skills { display: flex; flex-wrap: wrap; gap: 0.5rem; }
+.contact form { display: grid; gap: 1rem; max-width: 600px; margin: 0 auto; }
+""",
+        'html': """
+<nav class="navbar"><div class="container">{{nav}}</div></nav>
+<header class="hero" id="home"><div class="container">{{hero}}</div></header>
+<section class="section about" id="about"><div class="container">{{about}}</div></section>
+<section class="section projects" id="projects"><div class="container">{{projects}}</div></section>
+<section class="section contact" id="contact"><div class="container">{{contact}}</div></section>
+<footer class="footer"><div class="container">{{footer}}</div></footer>
+""",
+    },
+}
+
+SKELETON_SYSTEM_INSTRUCTION = """
+You fill in pre-built page skeletons. The server already provides the document structure, layout CSS and a base stylesheet with these classes:
+.container .section .section-title .grid .flex .card .btn .btn-outline .badge .navbar .nav-links .nav-toggle .footer .reveal
+and CSS variables --primary --secondary --accent --bg --surface --text --muted --radius --font.
+
+Return ONLY a JSON object with these keys:
+- "title": the page title
+- "theme": an object overriding any of the CSS variables above to match the requested style
+- "slots": an object with the inner HTML for every slot you are given (no <html>, <head>, <body>, <style> or <script> tags)
+- "css": extra CSS for anything the base stylesheet does not cover (keep it short)
+- "script": extra JavaScript for interactions such as tabs, charts or carousels (no <script> tags)
+
+Rules:
+- Reuse the provided classes instead of writing new layout CSS
+- Use # anchors for all links and JavaScript to show/hide content; never navigate to other pages
+- Do not include ANY external dependencies; draw charts with Canvas, SVG or CSS
+- Use realistic placeholder content/data and add the .reveal class to elements that should animate in
+"""
+
+def _compile_skeleton(template):
+    """Split a skeleton's HTML into static pieces and slot names once at startup"""
+    pieces = re.split(r'\{\{(\w+)\}\}', template['html'])
+    return {
+        'static': pieces[0::2],
+        'slot_order': pieces[1::2],
+        'css': SKELETON_BASE_CSS + template['css'],
+    }
+
+COMPILED_SKELETONS = {name: _compile_skeleton(t) for name, t in SKELETON_TEMPLATES.items()}
+
+SKELETON_SECTION_PATTERN = re.compile(r'\b(' + '|'.join(map(re.escape, SKELETON_SECTION_TERMS)) + ')', re.I)
+
+def classify_prompt(description, engine=None):
+    """
+    Return the skeleton category of a description, or None
+    """
+    engine = engine or prompt_rule_engine
+    for rule in engine.matching_rules(description):
+        if rule.get('name') in SKELETON_TEMPLATES:
+            return rule['name']
+    return None
+
+def missing_skeleton_sections(category, description):
+    """
+    Return the section names the description asks for that the category's
+    skeleton has no slot for
+    """
+    slots = SKELETON_TEMPLATES[category]['slots']
+    covered = ' '.join([category] + [f'{slot} {hint}' for slot, hint in slots.items()]).lower()
+    requested = {term.lower() for term in SKELETON_SECTION_PATTERN.findall(description)}
+    return sorted(term for term in requested if term not in covered)
+
+def assemble_skeleton_page(category, content):
+    """
+    Build a complete page from a compiled skeleton and the model's JSON content
+    """
+    skeleton = COMPILED_SKELETONS[category]
+    slots = content.get('slots') or {}
+    theme = dict(SKELETON_THEME_DEFAULTS)
+    theme.update({k: v for k, v in (content.get('theme') or {}).items()
+                  if k in SKELETON_THEME_DEFAULTS and isinstance(v, str)})
+    title = html.escape(str(content.get('title') or category.title()))
+
+    body = [skeleton['static'][0]]
+    for slot, static in zip(skeleton['slot_order'], skeleton['static'][1:]):
+        body.append(str(slots.get(slot, '')))
+        body.append(static)
+
+    theme_css = ':root { ' + ' '.join(f'{k}: {v};' for k, v in theme.items()) + ' }'
+    return ''.join([
+        '<!DOCTYPE html>\n<html lang="en">\n<head>\n',
+        '<meta charset="UTF-8">\n<meta name="viewport" content="width=device-width, initial-scale=1.0">\n',
+        f'<title>{title}</title>\n<style>\n{theme_css}\n', skeleton['css'],
+        str(content.get('css') or ''), '\n</style>\n</head>\n<body>\n',
+    ] + body + [
+        '\n<script>\n', SKELETON_BASE_SCRIPT, str(content.get('script') or ''), '\n</script>\n</body>\n</html>',
+    ])
+
+def generate_skeleton_page(model_name, description, category):
+    """
+    Generate a page by letting the model fill in a category skeleton.
+
+    Returns None if the model output is not usable, so the caller can fall
+    back to full-page generation.
+    """
+    template = SKELETON_TEMPLATES[category]
+    slot_list = '\n'.join(f'- "{slot}": {hint}' for slot, hint in template['slots'].items())
     prompt = f"""
-    Create a complete, working HTML page with embedded CSS and JavaScript based on this description:
+    Fill in the "{category}" skeleton for this description:
+    {description}
+    
+    Slots:
+    {slot_list}
+    """
+    model = model_backend.model(
+        model_name,
+        system_instruction=SKELETON_SYSTEM_INSTRUCTION,
+        generation_config={'response_mime_type': 'application/json'},
+    )
+    raw = generate_with_continuation(model, prompt, 'skeleton')
+    try:
+        content = json.loads(strip_markdown_fences(raw))
+    except ValueError:
+        return None
+    if not isinstance(content, dict) or not isinstance(content.get('slots'), dict):
+        return None
+    return assemble_skeleton_page(category, content)
+
+# Section-parallel generation: plan the page, generate sections concurrently
+PARALLEL_SECTION_WORKERS = int(os.environ.get('PARALLEL_SECTION_WORKERS', 6))
+MAX_PLANNED_SECTIONS = 10
+SECTION_RETRIES = 1
+
+PLANNING_SYSTEM_INSTRUCTION = """
+You plan single-page websites before they are built section by section by several developers working in parallel.
+The developers share a base stylesheet with these classes:
+.container .section .section-title .grid .flex .card .btn .btn-outline .badge .navbar .nav-links .nav-toggle .footer .reveal
+and CSS variables --primary --secondary --accent --bg --surface --text --muted --radius --font.
+
+Return ONLY a JSON object with these keys:
+- "title": the page title
+- "theme": an object overriding any of the CSS variables above to match the requested style
+- "shared_css": short CSS shared by all sections (typography tweaks, shared components)
+- "sections": an ordered list of objects with "id" (used as the HTML id and # anchor), "name" and "description" (what the section contains, in detail)
+
+Plan between 3 and 8 sections, including navigation and footer sections where appropriate.
+"""
+
+SECTION_SYSTEM_INSTRUCTION = """
+You build ONE section of a single-page website that other developers are building in parallel from the same plan.
+Use the shared classes and CSS variables from the plan instead of new global styles.
+
+Return ONLY a JSON object with these keys:
+- "html": the section's HTML, a single root element with the given id (no <html>, <head>, <body>, <style> or <script> tags)
+- "css": CSS for this section only; prefix every selector with the section's id selector
+- "script": JavaScript for this section only (no <script> tags), or an empty string
+
+Rules:
+- Use # anchors for all links and JavaScript to show/hide content; never navigate to other pages
+- Do not include ANY external dependencies; draw charts with Canvas, SVG or CSS
+- Use realistic placeholder content/data and add the .reveal class to elements that should animate in
+"""
+
+def _generate_json(model_name, system_instruction, prompt, operation):
+    model = model_backend.model(
+        model_name,
+        system_instruction=system_instruction,
+        generation_config={'response_mime_type': 'application/json'},
+    )
+    content = json.loads(strip_markdown_fences(generate_with_continuation(model, prompt, operation)))
+    if not isinstance(content, dict):
+        raise ValueError('Model did not return a JSON object')
+    return content
+
+def plan_page(model_name, description):
+    """
+    Ask the model for a section outline and shared design tokens
+    """
+    plan = _generate_json(model_name, PLANNING_SYSTEM_INSTRUCTION, f"""
+    Plan a page for this description:
+    {description}
+    """, 'plan')
+    sections = []
+    for index, section in enumerate(plan.get('sections') or []):
+        if not isinstance(section, dict):
+            continue
+        section_id = re.sub(r'[^a-z0-9-]', '-', str(section.get('id') or f'section-{index + 1}').lower())
+        sections.append({'id': section_id, 'name': str(section.get('name') or section_id),
+                         'description': str(section.get('description') or '')})
+    if not sections:
+        raise ValueError('Plan has no sections')
+    plan['sections'] = sections[:MAX_PLANNED_SECTIONS]
+    return plan
+
+def generate_section(model_name, description, plan, section):
+    """
+    Generate the HTML, CSS and script of one planned section
+    """
+    outline = '\n'.join(f"- #{s['id']}: {s['name']}" for s in plan['sections'])
+    content = _generate_json(model_name, SECTION_SYSTEM_INSTRUCTION, f"""
+    Page description:
     {description}
     
-    CRITICAL REQUIREMENTS:
-    1. Generate a complete HTML document with <!DOCTYPE html>
-    2. Include all CSS in a <style> tag in the <head>
-    3. Include all JavaScript in <script> tags
-    4. Make it a SINGLE PAGE APPLICATION - all navigation must work within the same page
-    5. For tabs, menus, or multi-section layouts:
-       - Use JavaScript to show/hide content
-       - Use # anchors for navigation (e.g., href="#dashboard")
-       - Never use external links or page reloads
-       - Implement tab switching with JavaScript
-    6. Make it visually appealing with modern, professional design
-    7. Use beautiful colors, proper spacing, and modern typography
-    8. Include smooth animations and transitions
-    9. Make it fully responsive (mobile-friendly)
-    10. Use realistic placeholder content/data
-    11. Do not include ANY external dependencies - everything must be inline
-    12. If charts are requested, create them using Canvas, SVG, or CSS
-    13. Ensure all interactive elements work (buttons, forms, tabs, etc.)
-    14. Use modern CSS features like flexbox, grid, gradients, shadows
-    15. For navigation/tabs: Always use JavaScript to show/hide sections, never load new pages
+    Page outline (use these ids for # anchors):
+    {outline}
     
-    IMPORTANT: The page will be displayed in an iframe, so:
-    - All links must use # anchors or JavaScript
-    - No external navigation
-    - Forms should not actually submit (use preventDefault)
-    - Everything must work within a single HTML document
+    Theme variables: {json.dumps(plan.get('theme') or {})}
+    Shared CSS: {plan.get('shared_css') or ''}
     
-    The output should be production-ready code that looks professional and polished.
+    Build ONLY the section "#{section['id']}" ({section['name']}):
+    {section['description']}
+    """, 'section')
+    return {
+        'html': str(content.get('html') or ''),
+        'css': str(content.get('css') or ''),
+        'script': str(content.get('script') or ''),
+    }
+
+def assemble_sectioned_page(plan, sections):
+    """
+    Stitch planned sections into one document sharing the base stylesheet
+    """
+    theme = dict(SKELETON_THEME_DEFAULTS)
+    theme.update({k: v for k, v in (plan.get('theme') or {}).items()
+                  if k in SKELETON_THEME_DEFAULTS and isinstance(v, str)})
+    theme_css = ':root { ' + ' '.join(f'{k}: {v};' for k, v in theme.items()) + ' }'
+    title = html.escape(str(plan.get('title') or 'Generated Page'))
+
+    css = [theme_css, SKELETON_BASE_CSS, str(plan.get('shared_css') or '')]
+    body = []
+    scripts = [SKELETON_BASE_SCRIPT]
+    for section in sections:
+        css.append(section['css'])
+        body.append(section['html'])
+        if section['script'].strip():
+            scripts.append(section['script'])
+
+    # One <script> per section: an error in one does not stop the others, and
+    # top-level functions stay global for inline handlers like onclick="fn()"
+    return (
+        '<!DOCTYPE html>\n<html lang="en">\n<head>\n'
+        '<meta charset="UTF-8">\n<meta name="viewport" content="width=device-width, initial-scale=1.0">\n'
+        f'<title>{title}</title>\n<style>\n' + '\n'.join(css) + '\n</style>\n</head>\n<body>\n'
+        + '\n'.join(body) + '\n' + ''.join(f'<script>\n{script}\n</script>\n' for script in scripts)
+        + '</body>\n</html>'
+    )
+
+def generate_ui_code_parallel(description, api_key):
+    """
+    Two-phase generation: a planning call produces the section outline and
+    shared design tokens, then every section is generated concurrently and
+    the page is assembled on the server. Wall-clock time approaches the
+    slowest section instead of the sum of all sections.
+
+    A failed section is retried once; if planning or a section still
+    fails, the page is generated in one call by generate_ui_code() instead.
+    """
+    model_name = model_router.select('generate')
+    try:
+        model_backend.configure(api_key)
+        plan = plan_page(model_name, description)
+    except Exception as e:
+        app.logger.warning('Page planning failed, generating in one call: %s', e)
+        return generate_ui_code(description, api_key)
+
+    def build(section):
+        for attempt in range(1 + SECTION_RETRIES):
+            try:
+                return generate_section(model_name, description, plan, section)
+            except Exception as e:
+                app.logger.warning('Section %s failed (attempt %d): %s', section['id'], attempt + 1, e)
+        return None
+
+    # Each section runs in a copy of this context so it sees the request's cancellation
+    workers = max(1, min(PARALLEL_SECTION_WORKERS, len(plan['sections'])))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, build, section)
+                   for section in plan['sections']]
+        sections = [future.result() for future in futures]
+
+    # A page with a missing section is not a success
+    if any(section is None for section in sections):
+        app.logger.warning('Sections failed, generating in one call')
+        return generate_ui_code(description, api_key)
+    return assemble_sectioned_page(plan, sections)
+
+def generate_ui_code(description, api_key):
+    """
+    Generate HTML/CSS code based on the description using Gemini API
+    """
     
-    Return ONLY the complete HTML code with no explanations, no markdown formatting, no code blocks - just pure HTML.
+    prompt = f"""
+    Create a complete, working HTML page with embedded CSS and JavaScript based on this description:
+    {description}
     """
     
     try:
         # Configure Gemini with the user's API key
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('models/gemini-2.5-flash')
+        model_backend.configure(api_key)
+        
+        # Common categories only need their skeleton filled in
+        model_name = model_router.select('generate')
+        category = classify_prompt(description) if SKELETON_TEMPLATES_ENABLED else None
+        if category and missing_skeleton_sections(category, description):
+            category = None
+        if category:
+            code = generate_skeleton_page(model_name, description, category)
+            if code:
+                return code
+        
+        model = model_backend.model(model_name, system_instruction=GENERATION_SYSTEM_INSTRUCTION)
         
         # Generate content
-        response = model.generate_content(prompt)
-        code = response.text
+        code = generate_with_continuation(model, prompt)
         
         # Clean up the response - remove any markdown formatting if present
-        if '```html' in code:
-            code = code.split('```html')[1].split('```')[0]
-        elif '```' in code:
-            code = code.split('```')[1].split('```')[0]
+        code = strip_markdown_fences(code).strip()
         
         # Ensure it starts with DOCTYPE
-        code = code.strip()
         if not code.lower().startswith('<!doctype'):
             code = '<!DOCTYPE html>\n' + code
             
@@ -1672,7 +6892,7 @@ def generate_ui_code(description, api_key):
         <head>
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Generation Error</title>
+            <title>{GENERATION_ERROR_TITLE}</title>
             <style>
                 body {{
                     font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
@@ -1723,5 +6943,10 @@ def generate_ui_code(description, api_key):
         """
 
 if __name__ == '__main__':
+    # Start the background jobs now rather than on the first request; under
+    # the reloader only the child process that serves requests runs them
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        background_workers.ensure_started()
+    
     # Run the Flask app
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,71 @@
+"""
+Benchmark: session store read/write latency under concurrent worker processes
+
+Run from the repository root:
+    python benchmarks/bench_session_store.py [workers] [operations]
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_session_store
+
+PAGE = '<!DOCTYPE html><html><body>' + '<div class="card">content</div>' * 1500 + '</body></html>'
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def worker(args):
+    backend, path, worker_id, operations = args
+    store = create_session_store(backend, path)
+    reads, writes = [], []
+    for i in range(operations):
+        session_id = f'w{worker_id}-s{i % 10}'
+        start = time.perf_counter()
+        if store.get_session(session_id) is None:
+            store.create_session(session_id, PAGE, 'benchmark prompt')
+        else:
+            store.add_version(session_id, PAGE, f'refinement {i}')
+        writes.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        store.get_session(f'w{(worker_id + 1) % 4}-s{i % 10}')
+        store.touch(session_id)
+        reads.append(time.perf_counter() - start)
+    return reads, writes
+
+def run(backend, workers, operations):
+    path = os.path.join(tempfile.mkdtemp(), 'sessions.db')
+    jobs = [(backend, path, w, operations) for w in range(workers)]
+    start = time.perf_counter()
+    if backend == 'memory':
+        results = [worker(job) for job in jobs[:1]]
+    else:
+        with Pool(workers) as pool:
+            results = pool.map(worker, jobs)
+    elapsed = time.perf_counter() - start
+
+    reads = [s * 1e3 for r, _ in results for s in r]
+    writes = [s * 1e3 for _, w in results for s in w]
+    procs = 1 if backend == 'memory' else workers
+    print(f"{backend:>6} x{procs}: {len(writes) / elapsed:8.0f} writes/s | "
+          f"read p50 {statistics.median(reads):6.3f} ms p99 {percentile(reads, 99):6.3f} ms | "
+          f"write p50 {statistics.median(writes):6.3f} ms p99 {percentile(writes, 99):6.3f} ms")
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    print(f"page size: {len(PAGE) // 1024} KB, {operations} operations per worker")
+    run('memory', workers, operations)
+    run('sqlite', 1, operations)
+    run('sqlite', workers, operations)
+
+if __name__ == '__main__':
+    main()
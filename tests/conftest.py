@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# app opens its SQLite files at import time; keep them out of the working tree
+_data_dir = tempfile.mkdtemp(prefix='ui-generator-tests-')
+os.environ.setdefault('SESSION_DB_PATH', os.path.join(_data_dir, 'sessions.db'))
+os.environ.setdefault('GALLERY_DB_PATH', os.path.join(_data_dir, 'gallery.db'))
+os.environ.setdefault('MODEL_BACKEND', 'gemini')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,165 @@
+import threading
+import time
+
+import pytest
+
+from app import (PRIORITY_GENERATE, PRIORITY_REFINE, AdmissionController, CancellationToken, Overloaded,
+                 RequestCancelled, load_tenant_weights)
+
+def make_controller(**kwargs):
+    options = dict(max_concurrent=1, queue_size=10, queue_timeout=5, weights={}, quantum=10.0)
+    options.update(kwargs)
+    return AdmissionController(**options)
+
+def queue_waiter(controller, priority, tenant, admitted, label=None, slots=1, token=None):
+    """
+    Start a thread that waits for admission and appends label to admitted
+    once it gets in, and return after it is queued
+    """
+    label = label or tenant
+    waiting = controller.snapshot()['waiting']
+
+    def wait():
+        try:
+            controller.acquire(priority, tenant, token, slots)
+        except RequestCancelled:
+            admitted.append((label, 'cancelled'))
+            return
+        admitted.append(label)
+
+    thread = threading.Thread(target=wait, daemon=True)
+    thread.start()
+    wait_until(lambda: controller.snapshot()['waiting'] > waiting)
+    return thread
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.005)
+
+def test_admits_up_to_max_concurrent():
+    controller = make_controller(max_concurrent=2)
+    assert controller.acquire(PRIORITY_GENERATE, 'a') == 1
+    assert controller.acquire(PRIORITY_GENERATE, 'a') == 1
+    assert not controller.try_acquire()
+    controller.release(PRIORITY_GENERATE, 1.0)
+    assert controller.try_acquire()
+
+def test_slots_are_clipped_to_max_concurrent():
+    controller = make_controller(max_concurrent=3)
+    assert controller.acquire(PRIORITY_GENERATE, 'a', slots=8) == 3
+    assert controller.snapshot()['running'] == 3
+
+def test_refinements_go_before_generations_within_a_tenant():
+    controller = make_controller()
+    controller.acquire(PRIORITY_GENERATE, 'a')
+    admitted = []
+    queue_waiter(controller, PRIORITY_GENERATE, 'a', admitted, 'generate')
+    queue_waiter(controller, PRIORITY_REFINE, 'a', admitted, 'refine')
+
+    controller.release(PRIORITY_GENERATE, 1.0)
+    wait_until(lambda: len(admitted) == 1)
+    controller.release(PRIORITY_REFINE, 1.0)
+    wait_until(lambda: len(admitted) == 2)
+    assert admitted == ['refine', 'generate']
+
+def test_refinements_go_before_generations_of_other_tenants():
+    controller = make_controller()
+    controller.acquire(PRIORITY_GENERATE, 'a')
+    admitted = []
+    queue_waiter(controller, PRIORITY_GENERATE, 'a', admitted, 'a-generate')
+    queue_waiter(controller, PRIORITY_GENERATE, 'b', admitted, 'b-generate')
+    queue_waiter(controller, PRIORITY_REFINE, 'c', admitted, 'c-refine')
+    queue_waiter(controller, PRIORITY_REFINE, 'a', admitted, 'a-refine')
+
+    for count in range(1, 5):
+        controller.release(PRIORITY_GENERATE, 20.0)
+        wait_until(lambda: len(admitted) == count)
+    assert set(admitted[:2]) == {'c-refine', 'a-refine'}
+    assert set(admitted[2:]) == {'a-generate', 'b-generate'}
+
+def test_waiter_needing_more_slots_waits_for_them():
+    controller = make_controller(max_concurrent=2)
+    controller.acquire(PRIORITY_GENERATE, 'a')
+    controller.acquire(PRIORITY_GENERATE, 'b')
+    admitted = []
+    queue_waiter(controller, PRIORITY_GENERATE, 'c', admitted, slots=2)
+
+    controller.release(PRIORITY_GENERATE, 1.0)
+    time.sleep(0.05)
+    assert admitted == []
+    assert controller.snapshot()['running'] == 1
+    controller.release(PRIORITY_GENERATE, 1.0)
+    wait_until(lambda: admitted == ['c'])
+    assert controller.snapshot()['running'] == 2
+
+def test_try_acquire_does_not_jump_the_queue():
+    controller = make_controller(max_concurrent=2)
+    controller.acquire(PRIORITY_GENERATE, 'a', slots=2)
+    admitted = []
+    queue_waiter(controller, PRIORITY_GENERATE, 'b', admitted, slots=2)
+    controller.release(PRIORITY_GENERATE, 1.0, slots=1)
+    # One slot is free, but a queued request is waiting for it
+    assert not controller.try_acquire()
+    controller.release(PRIORITY_GENERATE, 1.0, slots=1)
+    wait_until(lambda: admitted == ['b'])
+
+def test_rejects_when_queue_is_full():
+    controller = make_controller(queue_size=1)
+    controller.acquire(PRIORITY_GENERATE, 'a')
+    admitted = []
+    queue_waiter(controller, PRIORITY_GENERATE, 'a', admitted)
+    with pytest.raises(Overloaded) as excinfo:
+        controller.acquire(PRIORITY_GENERATE, 'a')
+    assert excinfo.value.retry_after >= 1
+    controller.release(PRIORITY_GENERATE, 1.0)
+    wait_until(lambda: admitted == ['a'])
+
+def test_cancelled_waiter_leaves_the_queue():
+    controller = make_controller()
+    controller.acquire(PRIORITY_GENERATE, 'a')
+    token = CancellationToken()
+    admitted = []
+    queue_waiter(controller, PRIORITY_GENERATE, 'b', admitted, token=token)
+    token.cancel('test')
+    wait_until(lambda: admitted == [('b', 'cancelled')])
+    assert controller.snapshot()['waiting'] == 0
+
+def test_tenants_share_slots_round_robin():
+    controller = make_controller()
+    controller.acquire(PRIORITY_GENERATE, 'busy')
+    admitted = []
+    for _ in range(3):
+        queue_waiter(controller, PRIORITY_GENERATE, 'busy', admitted)
+    queue_waiter(controller, PRIORITY_GENERATE, 'light', admitted)
+
+    for count in range(1, 5):
+        controller.release(PRIORITY_GENERATE, 20.0)
+        wait_until(lambda: len(admitted) == count)
+    # The light tenant is not stuck behind the whole batch
+    assert admitted.index('light') <= 1
+
+def test_heavier_tenant_gets_more_turns():
+    controller = make_controller(weights={'heavy': 3})
+    controller.acquire(PRIORITY_GENERATE, 'x')
+    admitted = []
+    for _ in range(4):
+        queue_waiter(controller, PRIORITY_GENERATE, 'light', admitted)
+    for _ in range(4):
+        queue_waiter(controller, PRIORITY_GENERATE, 'heavy', admitted)
+
+    for count in range(1, 5):
+        controller.release(PRIORITY_GENERATE, 20.0)
+        wait_until(lambda: len(admitted) == count)
+    assert admitted.count('heavy') >= 3
+
+def test_invalid_tenant_weights_are_ignored():
+    weights = load_tenant_weights('{"a": 2, "b": 0, "c": -1, "d": "x", "e": "NaN", "f": "1.5"}')
+    assert weights == {'a': 2.0, 'f': 1.5}
+    assert load_tenant_weights('not json') == {}
+    assert load_tenant_weights('[1, 2]') == {}
+
+def test_non_positive_quantum_falls_back():
+    controller = make_controller(quantum=0)
+    assert controller.quantum > 0
@@ -0,0 +1,124 @@
+import contextvars
+import threading
+import time
+from collections import deque
+
+import pytest
+
+from app import (HEDGE_MIN_SAMPLES, CancellationToken, HedgingPolicy, RecordedResponse, RequestCancelled,
+                 admission_controller, current_cancellation, stream_content)
+
+class FakeStream:
+    """
+    Stand-in for the SDK's streaming response: the chunks come from an
+    inner iterator that can be cancelled, like the gRPC/REST stream
+    """
+
+    def __init__(self, texts, on_chunk=None):
+        self.texts = list(texts)
+        self.on_chunk = on_chunk
+        self.sent = 0
+        self.cancelled = False
+        self._iterator = self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.cancelled or self.sent == len(self.texts):
+            raise StopIteration
+        if self.on_chunk is not None:
+            self.on_chunk(self.sent)
+        self.sent += 1
+        last = self.sent == len(self.texts)
+        return RecordedResponse(self.texts[self.sent - 1], 'STOP' if last else None)
+
+    def cancel(self):
+        self.cancelled = True
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.005)
+
+def run_with_token(token, fn, *args, **kwargs):
+    context = contextvars.copy_context()
+    context.run(current_cancellation.set, token)
+    return context.run(fn, *args, **kwargs)
+
+def test_collects_the_streamed_text_and_finish_reason():
+    stream = FakeStream(['<html>', '<body></body>', '</html>'])
+    calls = []
+
+    def send(prompt, **kwargs):
+        calls.append(kwargs)
+        return stream
+
+    response = run_with_token(CancellationToken(None), stream_content, send, 'prompt', request_options={})
+    assert response.text == '<html><body></body></html>'
+    assert response.candidates[0].finish_reason.name == 'STOP'
+    assert calls == [{'stream': True, 'request_options': {}}]
+    assert not stream.cancelled
+
+def test_cancelling_mid_stream_closes_the_stream():
+    token = CancellationToken(None)
+
+    def cancel_at_second_chunk(index):
+        if index == 1:
+            token.cancel('client disconnected')
+
+    stream = FakeStream(['a', 'b', 'c', 'd'], on_chunk=cancel_at_second_chunk)
+    with pytest.raises(RequestCancelled):
+        run_with_token(token, stream_content, lambda prompt, **kwargs: stream, 'prompt')
+    assert stream.cancelled
+    assert stream.sent == 2
+
+def test_failing_stream_is_closed():
+    def fail(index):
+        if index == 1:
+            raise RuntimeError('connection reset')
+
+    stream = FakeStream(['a', 'b'], on_chunk=fail)
+    with pytest.raises(RuntimeError):
+        run_with_token(CancellationToken(None), stream_content, lambda prompt, **kwargs: stream, 'prompt')
+    assert stream.cancelled
+
+def test_child_token_follows_its_parent():
+    parent = CancellationToken(30)
+    child = CancellationToken(None, parent=parent)
+    assert 0 < child.remaining() <= 30
+    child.cancel('hedge lost')
+    assert child.cancelled and not parent.cancelled
+    other = CancellationToken(None, parent=parent)
+    parent.cancel('client disconnected')
+    assert other.cancelled
+    assert other.reason == 'client disconnected'
+
+def test_losing_hedged_call_is_cancelled_and_keeps_its_slot_until_it_stops():
+    policy = HedgingPolicy(budget=1.0, min_delay=0.01, enabled=True)
+    policy.latencies['generate'] = deque([0.01] * HEDGE_MIN_SAMPLES)
+    resume_primary = threading.Event()
+    streams = []
+
+    def send(prompt, **kwargs):
+        if streams:
+            stream = FakeStream(['backup'])
+        else:
+            # The primary stalls after its first chunk until the test resumes it
+            stream = FakeStream(['slow'] * 5, on_chunk=lambda index: index == 1 and resume_primary.wait(5))
+        streams.append(stream)
+        return stream
+
+    running = admission_controller.running
+    response = run_with_token(CancellationToken(None), policy.call, 'generate', stream_content, send, 'prompt')
+    assert response.text == 'backup'
+    assert policy.snapshot()['hedge_wins'] == 1
+    # The primary is still in its upstream call, so the backup's slot is held
+    assert admission_controller.running == running + 1
+
+    resume_primary.set()
+    wait_until(lambda: admission_controller.running == running)
+    primary = streams[0]
+    assert primary.cancelled
+    assert primary.sent == 2
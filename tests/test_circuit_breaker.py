@@ -0,0 +1,84 @@
+import time
+
+from app import CircuitBreaker
+
+def make_breaker(**kwargs):
+    options = dict(window=4, min_calls=4, error_rate=0.5, latency_seconds=1.0, cooldown_seconds=0.05)
+    options.update(kwargs)
+    return CircuitBreaker(**options)
+
+def trip(breaker):
+    for _ in range(4):
+        breaker.record(False, 0.1)
+    assert breaker.state == 'open'
+
+def wait_for_cooldown(breaker):
+    time.sleep(breaker.cooldown_seconds + 0.01)
+
+def test_stays_closed_below_min_calls():
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record(False, 0.1)
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+def test_opens_on_error_rate():
+    breaker = make_breaker()
+    trip(breaker)
+    assert not breaker.allow()
+    assert breaker.snapshot()['trips'] == 1
+
+def test_opens_on_median_latency():
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record(True, 2.0)
+    assert breaker.state == 'open'
+
+def test_allow_does_not_claim_the_probe():
+    breaker = make_breaker()
+    trip(breaker)
+    wait_for_cooldown(breaker)
+    # Routing checks must not use up the single half-open probe
+    assert breaker.allow()
+    assert breaker.allow()
+    assert breaker.begin()
+    assert not breaker.begin()
+    assert not breaker.allow()
+
+def test_successful_probe_closes():
+    breaker = make_breaker()
+    trip(breaker)
+    wait_for_cooldown(breaker)
+    assert breaker.begin()
+    breaker.record(True, 0.1, probe=True)
+    assert breaker.state == 'closed'
+    assert breaker.snapshot()['calls'] == 0
+
+def test_failed_or_slow_probe_reopens():
+    breaker = make_breaker()
+    trip(breaker)
+    wait_for_cooldown(breaker)
+    assert breaker.begin()
+    breaker.record(True, 5.0, probe=True)
+    assert breaker.state == 'open'
+    assert breaker.snapshot()['trips'] == 2
+
+def test_non_probe_results_ignored_while_half_open():
+    breaker = make_breaker()
+    trip(breaker)
+    wait_for_cooldown(breaker)
+    assert breaker.begin()
+    breaker.record(False, 0.1)
+    assert breaker.state == 'half_open'
+    breaker.record(True, 0.1, probe=True)
+    assert breaker.state == 'closed'
+
+def test_released_probe_can_be_claimed_again():
+    breaker = make_breaker()
+    trip(breaker)
+    wait_for_cooldown(breaker)
+    assert breaker.begin()
+    # A cancelled probe call gives the slot back instead of leaking it
+    breaker.release()
+    assert breaker.allow()
+    assert breaker.begin()
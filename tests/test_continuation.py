@@ -0,0 +1,31 @@
+from app import _join_continuation, is_truncated_html
+
+def test_plain_continuation_is_appended():
+    assert _join_continuation('<div>Hello', ' world</div>') == '<div>Hello world</div>'
+
+def test_short_coincidental_overlap_is_kept():
+    assert _join_continuation('color: #ff', 'f;') == 'color: #fff;'
+    assert _join_continuation('<p>aa', 'a</p>') == '<p>aaa</p>'
+    assert _join_continuation('<div>\n', '\n</div>') == '<div>\n\n</div>'
+
+def test_repeated_tail_is_dropped():
+    code = '<section class="pricing">\n  <div class="card">'
+    continuation = '<section class="pricing">\n  <div class="card"><h3>Pro</h3>'
+    assert _join_continuation(code, continuation) == code + '<h3>Pro</h3>'
+    code = '<main>' + '<div class="card-grid'
+    assert _join_continuation(code, '<div class="card-grid">') == '<main><div class="card-grid">'
+
+def test_repeated_whole_line_is_dropped():
+    code = '<ul>\n  <li>One</li>\n'
+    assert _join_continuation(code, '  <li>One</li>\n  <li>Two</li>\n') == code + '  <li>Two</li>\n'
+
+def test_markdown_fence_is_removed():
+    code = '<body>\n<main>'
+    continuation = '```html\n<p>Rest</p></main></body></html>\n```'
+    assert _join_continuation(code, continuation) == code + '<p>Rest</p></main></body></html>\n'
+
+def test_truncation_detection():
+    assert is_truncated_html('<!DOCTYPE html><html><body><p>cut')
+    assert is_truncated_html('<html><body></body>')
+    assert not is_truncated_html('<html><body></body></html>')
+    assert not is_truncated_html('<div>fragment</div>')
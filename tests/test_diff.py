@@ -0,0 +1,26 @@
+from app import compute_diff
+
+def rows_page(count):
+    lines = []
+    for index in range(count):
+        lines += ['<div class="row">', f'  <span>item {index}</span>', '</div>']
+    return lines
+
+def test_single_line_change():
+    old = rows_page(10)
+    new = list(old)
+    new[4] = '  <span>changed</span>'
+    diff = compute_diff('\n'.join(old), '\n'.join(new))
+    assert (diff['added'], diff['removed'], len(diff['hunks'])) == (1, 1, 1)
+    assert ['-', '  <span>item 1</span>'] in diff['hunks'][0]['lines']
+    assert ['+', '  <span>changed</span>'] in diff['hunks'][0]['lines']
+
+def test_repeated_lines_in_large_pages_still_match():
+    # Lines like '</div>' repeat throughout a page; difflib's autojunk
+    # heuristic would treat them as junk and report unchanged lines
+    old = rows_page(800)
+    new = list(old)
+    new[4] = '  <span>first</span>'
+    new[-2] = '  <span>last</span>'
+    diff = compute_diff('\n'.join(old), '\n'.join(new))
+    assert (diff['added'], diff['removed'], len(diff['hunks'])) == (2, 2, 2)
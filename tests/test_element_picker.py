@@ -0,0 +1,80 @@
+import pytest
+
+from app import (ElementChanged, element_matches_selection, find_element, parse_element_tree, refine_element_code,
+                 splice_element)
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head><style>.card { color: red; }</style></head>
+<body>
+<main>
+  <section id="pricing">
+    <div class="card"><h3>Basic</h3><p>$9</p></div>
+    <div class="card"><h3>Pro</h3><p>$29</p></div>
+  </section>
+</main>
+</body>
+</html>
+"""
+
+def source_of(html_code, node):
+    return html_code[node['start']:node['end']]
+
+def test_offsets_cover_the_element_source():
+    node = find_element(PAGE, '#pricing > div:nth-of-type(2) > h3:nth-of-type(1)')
+    assert source_of(PAGE, node) == '<h3>Pro</h3>'
+    node = find_element(PAGE, 'body > main:nth-of-type(1)')
+    assert source_of(PAGE, node).startswith('<main>')
+    assert source_of(PAGE, node).endswith('</main>')
+
+def test_offsets_with_line_breaks_html_parser_does_not_count():
+    # HTMLParser only counts '\n'; these must not shift later offsets
+    for separator in ('\r', '\x0c', '\u2028', '\x1c', '\x85'):
+        html_code = PAGE.replace('<main>', f'<p>a{separator}b{separator}c</p>\n<main>')
+        node = find_element(html_code, '#pricing > div:nth-of-type(1) > p:nth-of-type(1)')
+        assert source_of(html_code, node) == '<p>$9</p>', repr(separator)
+
+def test_offsets_with_crlf_source():
+    html_code = PAGE.replace('\n', '\r\n')
+    node = find_element(html_code, '#pricing > div:nth-of-type(2)')
+    assert source_of(html_code, node) == '<div class="card"><h3>Pro</h3><p>$29</p></div>'
+
+def test_implicitly_closed_elements_end_at_parent():
+    html_code = '<div><p>one<span>two</div><p>after</p>'
+    div = parse_element_tree(html_code)['children'][0]
+    paragraph = div['children'][0]
+    assert source_of(html_code, div) == '<div><p>one<span>two</div>'
+    assert source_of(html_code, paragraph) == '<p>one<span>two'
+    assert source_of(html_code, paragraph['children'][0]) == '<span>two'
+
+def test_missing_element_returns_none():
+    assert find_element(PAGE, '#pricing > div:nth-of-type(3)') is None
+    assert find_element(PAGE, '#missing') is None
+    assert find_element(PAGE, '') is None
+
+def test_tbody_inserted_by_the_browser_is_skipped():
+    html_code = '<table id="t"><tr><td>a</td></tr></table>'
+    node = find_element(html_code, '#t > tbody:nth-of-type(1) > tr:nth-of-type(1) > td:nth-of-type(1)')
+    assert source_of(html_code, node) == '<td>a</td>'
+
+def test_splice_replaces_only_the_element():
+    node = find_element(PAGE, '#pricing > div:nth-of-type(1) > h3:nth-of-type(1)')
+    updated = splice_element(PAGE, node, '<h3>Starter</h3>', '.new { color: blue; }')
+    assert '<h3>Starter</h3><p>$9</p>' in updated
+    assert '<h3>Pro</h3>' in updated
+    assert updated.index('data-scoped-refinement') < updated.index('</head>')
+
+def test_selection_must_match_tag_and_text():
+    node = find_element(PAGE, '#pricing > div:nth-of-type(2)')
+    assert element_matches_selection(PAGE, node, 'div', 'Pro $29')
+    assert element_matches_selection(PAGE, node, 'DIV', '')
+    assert not element_matches_selection(PAGE, node, 'section', 'Pro $29')
+    # A path shifted by script-inserted elements points at different content
+    assert not element_matches_selection(PAGE, node, 'div', 'Enterprise plan, contact sales')
+
+def test_refining_a_changed_element_asks_for_a_new_selection():
+    # Raised before any model call, so the instruction never reaches the whole page
+    with pytest.raises(ElementChanged):
+        refine_element_code(PAGE, '#pricing > div:nth-of-type(2)', 'bigger', 'key', 'div', 'Enterprise, contact sales')
+    with pytest.raises(ElementChanged):
+        refine_element_code(PAGE, '#pricing > div:nth-of-type(5)', 'bigger', 'key', 'div', 'Pro $29')
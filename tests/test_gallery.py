@@ -0,0 +1,25 @@
+from app import SHARED_GALLERY_TENANT, GalleryIndex
+
+PAGE = '<!DOCTYPE html><html><head><title>{0}</title></head><body><h1>{0}</h1></body></html>'
+
+def make_index(tmp_path):
+    index = GalleryIndex(str(tmp_path / 'gallery.db'))
+    index.add('a.html', PAGE.format('Sales dashboard'), 'generate', 'sales dashboard', tenant='key:a')
+    index.add('b.html', PAGE.format('Sales landing page'), 'generate', 'sales landing page', tenant='key:b')
+    index.add('example.html', PAGE.format('Sales example'), 'prewarm', 'sales example', tenant=SHARED_GALLERY_TENANT)
+    index.add('legacy.html', PAGE.format('Sales legacy'), 'generate', 'sales legacy')
+    return index
+
+def test_search_only_lists_own_and_shared_generations(tmp_path):
+    index = make_index(tmp_path)
+    assert {r['filename'] for r in index.search('sales', 'key:a')} == {'a.html', 'example.html'}
+    assert {r['filename'] for r in index.search('', 'key:b')} == {'b.html', 'example.html'}
+    assert index.search('sales', 'key:c')[0]['filename'] == 'example.html'
+
+def test_get_for_checks_the_tenant(tmp_path):
+    index = make_index(tmp_path)
+    assert index.get_for('a.html', 'key:a')['prompt'] == 'sales dashboard'
+    assert index.get_for('a.html', 'key:b') is None
+    assert index.get_for('example.html', 'key:b') is not None
+    # Rows indexed before tenant scoping are not listed to anyone
+    assert index.get_for('legacy.html', 'key:a') is None
@@ -0,0 +1,42 @@
+import pytest
+
+from app import MarkdownFenceStripper, strip_markdown_fences
+
+CASES = [
+    # Fence lines around the page
+    ('```html\n<div>hi</div>\n```', '<div>hi</div>\n'),
+    ('```\n<div>hi</div>\n```\n', '<div>hi</div>\n'),
+    # Single-line form and a closing fence right after the code
+    ('```html <div>hi</div>```', '<div>hi</div>'),
+    ('```<div>hi</div>```', '<div>hi</div>'),
+    ('```html\n<div>hi</div>```', '<div>hi</div>'),
+    ('```html <div>a</div>\n<p>b</p>\n```', '<div>a</div>\n<p>b</p>\n'),
+    # Text before the opening fence and after the closing one
+    ('Here is the page:\n```html\n<p>a</p>\n```\nEnjoy!', '<p>a</p>\n'),
+    # Fenced samples inside the page are kept
+    ('```html\n<pre>\n```js\nx()\n```\n</pre>\n```\n', '<pre>\n```js\nx()\n```\n</pre>\n'),
+    ('```json\n{"a": "`x`"}\n```', '{"a": "`x`"}\n'),
+    ('```\n<b>``</b>\n```', '<b>``</b>\n'),
+    # Unfenced output is returned as is
+    ('<html><body>a</body></html>', '<html><body>a</body></html>'),
+]
+
+@pytest.mark.parametrize('text, expected', CASES)
+def test_strips_full_response(text, expected):
+    assert strip_markdown_fences(text) == expected
+
+@pytest.mark.parametrize('text, expected', CASES)
+def test_chunk_boundaries_do_not_change_the_result(text, expected):
+    for first in range(len(text) + 1):
+        for second in range(first, len(text) + 1):
+            chunks = [text[:first], text[first:second], text[second:]]
+            assert strip_markdown_fences(chunks) == expected, chunks
+
+def test_fence_text_is_not_emitted_while_streaming():
+    stripper = MarkdownFenceStripper()
+    emitted = []
+    for chunk in ['```ht', 'ml\n<p>', 'a</p>\n`', '``\nDone']:
+        emitted.extend(stripper.feed(chunk))
+        assert '`' not in ''.join(emitted)
+    emitted.extend(stripper.close())
+    assert ''.join(emitted) == '<p>a</p>\n'
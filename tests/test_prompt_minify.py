@@ -0,0 +1,70 @@
+from app import fix_navigation_issues, minify_code_for_prompt, restore_formatting
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <!-- page styles -->
+    <style>
+        /* cards */
+        .card > h3 , .note {
+            content: " > , ; ";
+            font-family: 'Open  Sans';   /* inline */
+        }
+        .quote::before { content: "/* not a comment */"; }
+    </style>
+</head>
+<body>
+    <div   class="card">
+        <h3>Pro</h3>
+    </div>
+    <pre>
+  keep
+
+    this</pre>
+    <script>
+        const text = `a
+
+          b`;
+    </script>
+</body>
+</html>"""
+
+def test_comments_and_indentation_are_removed():
+    compact, stats = minify_code_for_prompt(PAGE)
+    assert '<!-- page styles -->' not in compact
+    assert '/* cards */' not in compact
+    assert '/* inline */' not in compact
+    assert '\n<div class="card">\n<h3>Pro</h3>\n' in compact
+    assert '.card>h3,.note{' in compact
+    assert stats['tokens_saved'] > 0
+
+def test_css_strings_are_kept():
+    compact, _ = minify_code_for_prompt(PAGE)
+    assert 'content: " > , ; ";' in compact
+    assert "font-family: 'Open  Sans';" in compact
+    assert 'content: "/* not a comment */";' in compact
+
+def test_script_and_pre_are_kept():
+    compact, _ = minify_code_for_prompt(PAGE)
+    assert '<pre>\n  keep\n\n    this</pre>' in compact
+    assert 'const text = `a\n\n          b`;' in compact
+
+def test_navigation_fix_is_stripped():
+    compact, _ = minify_code_for_prompt(fix_navigation_issues(PAGE))
+    assert compact == minify_code_for_prompt(PAGE)[0]
+
+def test_unchanged_answer_restores_the_original():
+    compact, _ = minify_code_for_prompt(PAGE)
+    assert restore_formatting(PAGE, compact) == PAGE
+    assert restore_formatting(fix_navigation_issues(PAGE), compact) == PAGE
+
+def test_only_edited_lines_change():
+    compact, _ = minify_code_for_prompt(PAGE)
+    refined = compact.replace('<h3>Pro</h3>', '<h3>Pro plan</h3>\n<p>Best value</p>')
+    restored = restore_formatting(PAGE, refined)
+    assert restored == PAGE.replace('        <h3>Pro</h3>', '<h3>Pro plan</h3>\n<p>Best value</p>')
+
+def test_reindented_answer_still_matches():
+    compact, _ = minify_code_for_prompt(PAGE)
+    refined = '\n'.join('  ' + line for line in compact.split('\n'))
+    assert '    <!-- page styles -->' in restore_formatting(PAGE, refined)
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+
+from app import RefinementCoalescer
+
+def test_single_refinement_runs_alone():
+    coalescer = RefinementCoalescer()
+    result, items = coalescer.submit('s1', {'prompt': 'a'}, lambda batch: [item['prompt'] for item in batch])
+    assert result == ['a']
+    assert items == [{'prompt': 'a'}]
+    assert coalescer.sessions == {}
+
+def test_follow_ups_are_merged_into_one_batch():
+    coalescer = RefinementCoalescer()
+    first_started = threading.Event()
+    release_first = threading.Event()
+    batches = []
+    results = {}
+
+    def run_batch(items):
+        batches.append([item['prompt'] for item in items])
+        if items[0]['prompt'] == 'first':
+            first_started.set()
+            release_first.wait(2)
+        return len(batches)
+
+    def submit(prompt):
+        results[prompt] = coalescer.submit('s1', {'prompt': prompt}, run_batch)
+
+    threads = [threading.Thread(target=submit, args=('first',))]
+    threads[0].start()
+    assert first_started.wait(2)
+    for prompt in ('second', 'third'):
+        thread = threading.Thread(target=submit, args=(prompt,))
+        thread.start()
+        threads.append(thread)
+    while len(coalescer.sessions['s1']['pending']) < 1 or len(coalescer.sessions['s1']['pending'][0]['items']) < 2:
+        time.sleep(0.005)
+    release_first.set()
+    for thread in threads:
+        thread.join(2)
+
+    assert batches == [['first'], ['second', 'third']]
+    # Every request of a batch gets the same result and the merged items
+    assert results['second'] == results['third']
+    assert [item['prompt'] for item in results['third'][1]] == ['second', 'third']
+    assert coalescer.sessions == {}
+
+def test_element_refinements_are_not_merged():
+    coalescer = RefinementCoalescer()
+    first_started = threading.Event()
+    release_first = threading.Event()
+    batches = []
+
+    def run_batch(items):
+        batches.append([item['prompt'] for item in items])
+        if items[0]['prompt'] == 'first':
+            first_started.set()
+            release_first.wait(2)
+
+    threads = [threading.Thread(target=coalescer.submit, args=('s1', {'prompt': 'first'}, run_batch))]
+    threads[0].start()
+    assert first_started.wait(2)
+    for prompt in ('a', 'b'):
+        item = {'prompt': prompt, 'target_path': f'#{prompt}'}
+        thread = threading.Thread(target=coalescer.submit, args=('s1', item, run_batch))
+        thread.start()
+        threads.append(thread)
+    while len(coalescer.sessions['s1']['pending']) < 2:
+        time.sleep(0.005)
+    release_first.set()
+    for thread in threads:
+        thread.join(2)
+    assert batches == [['first'], ['a'], ['b']]
+
+def test_errors_reach_every_request_and_the_queue_moves_on():
+    coalescer = RefinementCoalescer()
+
+    def fail(items):
+        raise ValueError('model failed')
+
+    with pytest.raises(ValueError):
+        coalescer.submit('s1', {'prompt': 'a'}, fail)
+    result, _ = coalescer.submit('s1', {'prompt': 'b'}, lambda items: 'ok')
+    assert result == 'ok'
+
+def test_max_batch_starts_a_new_batch():
+    coalescer = RefinementCoalescer(max_batch=2)
+    started = threading.Event()
+    release = threading.Event()
+    batches = []
+
+    def run_batch(items):
+        batches.append(len(items))
+        if not started.is_set():
+            started.set()
+            release.wait(2)
+
+    threads = [threading.Thread(target=coalescer.submit, args=('s1', {'prompt': 'first'}, run_batch))]
+    threads[0].start()
+    assert started.wait(2)
+    for index in range(3):
+        thread = threading.Thread(target=coalescer.submit, args=('s1', {'prompt': str(index)}, run_batch))
+        thread.start()
+        threads.append(thread)
+        while sum(len(b['items']) for b in coalescer.sessions['s1']['pending']) < index + 1:
+            time.sleep(0.005)
+    release.set()
+    for thread in threads:
+        thread.join(2)
+    assert batches == [1, 2, 1]
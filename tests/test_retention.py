@@ -0,0 +1,54 @@
+import os
+import time
+
+import pytest
+
+import app
+from app import GalleryIndex, MemorySessionStore, RetentionManager, SQLiteSessionStore, sharded_ui_file_path
+
+PAGE = '<!DOCTYPE html><html><body><h1>{0}</h1></body></html>'
+
+@pytest.fixture
+def upload_folder(tmp_path, monkeypatch):
+    folder = tmp_path / 'generated_uis'
+    folder.mkdir()
+    monkeypatch.setitem(app.app.config, 'UPLOAD_FOLDER', str(folder))
+    return folder
+
+def save_page(index, filename, session_id=None):
+    path = sharded_ui_file_path(filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(PAGE.format(filename))
+    index.add(filename, PAGE.format(filename), 'generate', session_id=session_id,
+              created_at=time.time() - 30 * 24 * 60 * 60)
+    return path
+
+def test_refuses_to_run_with_the_memory_store(tmp_path, upload_folder, monkeypatch):
+    monkeypatch.setattr(app, 'session_store', MemorySessionStore())
+    index = GalleryIndex(str(tmp_path / 'gallery.db'))
+    path = save_page(index, 'old.html')
+    manager = RetentionManager(index, max_age_days=1)
+
+    assert manager.configured and not manager.enabled
+    with pytest.raises(RuntimeError):
+        manager.run_once()
+    manager.start()
+    assert manager.thread is None
+    assert os.path.exists(path)
+
+def test_keeps_pages_of_sessions_in_the_shared_store(tmp_path, upload_folder, monkeypatch):
+    store = SQLiteSessionStore(str(tmp_path / 'sessions.db'))
+    monkeypatch.setattr(app, 'session_store', store)
+    # Created by another worker: only the shared store knows about it
+    SQLiteSessionStore(store.path).create_session('session_1', PAGE.format('live'), 'prompt',
+                                                  {'filename': 'referenced.html'})
+    index = GalleryIndex(str(tmp_path / 'gallery.db'))
+    live = save_page(index, 'live.html', session_id='session_1')
+    referenced = save_page(index, 'referenced.html')
+    stale = save_page(index, 'stale.html', session_id='session_gone')
+
+    report = RetentionManager(index, max_age_days=1).run_once()
+    assert (report['deleted_files'], report['protected_files']) == (1, 2)
+    assert os.path.exists(live) and os.path.exists(referenced)
+    assert not os.path.exists(stale)
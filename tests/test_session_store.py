@@ -0,0 +1,41 @@
+import pytest
+
+from app import MemorySessionStore, SQLiteSessionStore
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemorySessionStore()
+    return SQLiteSessionStore(str(tmp_path / 'sessions.db'))
+
+def test_create_and_get_session(store):
+    store.create_session('s1', '<p>one</p>', 'original')
+    session = store.get_session('s1')
+    assert session['code'] == '<p>one</p>'
+    assert session['version'] == 1
+    assert session['original_prompt'] == 'original'
+    assert store.get_session('missing') is None
+
+def test_add_version_bumps_the_session(store):
+    store.create_session('s1', '<p>one</p>', 'original')
+    assert store.add_version('s1', '<p>two</p>', 'edit') == 2
+    assert store.get_session('s1')['code'] == '<p>two</p>'
+    assert store.session_ids() == ['s1']
+
+def test_evict_idle(store):
+    store.create_session('s1', '<p>one</p>', 'original')
+    store.touch('s1')
+    assert store.evict_idle(0) == []
+    assert store.get_session('s1') is not None
+    assert store.evict_idle(float('inf')) == ['s1']
+    assert store.get_session('s1') is None
+
+def test_sqlite_store_is_shared_between_instances(tmp_path):
+    # Each worker process opens its own store on the same file
+    path = str(tmp_path / 'sessions.db')
+    first = SQLiteSessionStore(path)
+    second = SQLiteSessionStore(path)
+    first.create_session('s1', '<p>one</p>', 'original')
+    assert second.add_version('s1', '<p>two</p>', 'edit') == 2
+    assert first.get_session('s1')['code'] == '<p>two</p>'
+    assert SQLiteSessionStore(path).get_version('s1', 1) == '<p>one</p>'
@@ -0,0 +1,54 @@
+import pytest
+
+from app import SQLiteSessionStore, apply_delta, compute_delta, decode_version, encode_version
+
+PAGE = '<!DOCTYPE html>\n<html>\n<body>\n' + ''.join(f'<div class="card">item {i}</div>\n' for i in range(200)) + \
+    '</body>\n</html>\n'
+
+@pytest.mark.parametrize('target', [
+    PAGE,
+    PAGE.replace('item 10<', 'changed<'),
+    PAGE.replace('<body>\n', '<body>\n<header>new</header>\n'),
+    PAGE.replace('<div class="card">item 5</div>\n', ''),
+    'no trailing newline',
+    '',
+])
+def test_delta_round_trip(target):
+    assert apply_delta(PAGE, compute_delta(PAGE, target)) == target
+
+def test_delta_keeps_line_endings():
+    base = 'a\r\nb\r\nc'
+    target = 'a\r\nB\r\nc\r\n'
+    assert apply_delta(base, compute_delta(base, target)) == target
+
+def test_small_edit_is_stored_as_delta():
+    edited = PAGE.replace('item 10<', 'changed<')
+    is_snapshot, payload = encode_version(edited, PAGE, 0)
+    assert not is_snapshot
+    assert decode_version(payload, PAGE) == edited
+
+def test_rewrite_is_stored_as_snapshot():
+    rewrite = ''.join(f'<p>{i * 7919 % 10007}</p>\n' for i in range(300))
+    is_snapshot, payload = encode_version(rewrite, PAGE, 0)
+    assert is_snapshot
+    assert decode_version(payload, None) == rewrite
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteSessionStore(str(tmp_path / 'sessions.db'))
+
+def test_versions_round_trip(store):
+    store.create_session('s1', PAGE, 'original')
+    pages = [PAGE]
+    for i in range(30):
+        pages.append(pages[-1].replace(f'item {i}<', f'edited {i}<'))
+        assert store.add_version('s1', pages[-1], f'edit {i}') == i + 2
+    for version, page in enumerate(pages, 1):
+        assert store.get_version('s1', version) == page
+    assert store.get_session('s1')['code'] == pages[-1]
+
+    versions = store.list_versions('s1')
+    assert [v['version'] for v in versions] == list(range(1, 32))
+    # The first version is a snapshot, small edits are deltas
+    assert versions[0]['snapshot']
+    assert not all(v['snapshot'] for v in versions)
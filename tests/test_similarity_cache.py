@@ -0,0 +1,59 @@
+from app import SimilarityCache
+
+PROMPT = 'a dashboard with a sales chart, a customer table and a dark sidebar menu'
+
+def test_near_duplicate_prompt_hits():
+    cache = SimilarityCache(threshold=0.7)
+    cache.add(PROMPT, '<html>dashboard</html>', 'key:a')
+    match = cache.lookup('a dashboard with a sales chart, a customer table and dark sidebar menu', 'key:a')
+    assert match['result'] == '<html>dashboard</html>'
+    assert match['prompt'] == PROMPT
+    assert match['similarity'] >= 0.7
+    assert cache.hits == 1
+
+def test_other_tenants_never_match():
+    cache = SimilarityCache(threshold=0.5)
+    cache.add(PROMPT, '<html>a</html>', 'key:a')
+    assert cache.lookup(PROMPT, 'key:b') is None
+    assert cache.lookup(PROMPT, 'key:a')['result'] == '<html>a</html>'
+    # Each tenant gets its own entry for the same prompt
+    cache.add(PROMPT, '<html>b</html>', 'key:b')
+    assert cache.lookup(PROMPT, 'key:a')['result'] == '<html>a</html>'
+    assert cache.lookup(PROMPT, 'key:b')['result'] == '<html>b</html>'
+
+def test_threshold_rejects_loosely_related_prompts():
+    related = 'a dashboard with a sales chart and a login form'
+    shingles = SimilarityCache.shingles
+    similarity = len(shingles(PROMPT) & shingles(related)) / len(shingles(PROMPT) | shingles(related))
+    assert 0 < similarity < 0.7
+
+    strict = SimilarityCache(threshold=0.7, bands=64)
+    strict.add(PROMPT, '<html>dashboard</html>', 'key:a')
+    assert strict.lookup(related, 'key:a') is None
+    assert strict.misses == 1
+
+    # One row per band makes every shared shingle a candidate, so only the threshold decides
+    loose = SimilarityCache(threshold=similarity, bands=64)
+    loose.add(PROMPT, '<html>dashboard</html>', 'key:a')
+    assert loose.lookup(related, 'key:a')['similarity'] == round(similarity, 3)
+
+def test_unrelated_prompt_misses():
+    cache = SimilarityCache(threshold=0.7)
+    cache.add(PROMPT, '<html>dashboard</html>', 'key:a')
+    assert cache.lookup('a recipe blog with a photo gallery', 'key:a') is None
+    assert cache.lookup('the and of', 'key:a') is None
+
+def test_least_recently_used_entries_are_evicted():
+    cache = SimilarityCache(threshold=0.9, max_entries=2)
+    cache.add('weather forecast widget', 'weather', 'key:a')
+    cache.add('music player controls', 'music', 'key:a')
+    assert cache.lookup('weather forecast widget', 'key:a')['result'] == 'weather'
+    cache.add('kanban board columns', 'kanban', 'key:a')
+
+    assert len(cache.entries) == 2
+    assert cache.lookup('music player controls', 'key:a') is None
+    assert cache.lookup('weather forecast widget', 'key:a')['result'] == 'weather'
+    assert cache.lookup('kanban board columns', 'key:a')['result'] == 'kanban'
+    # Evicted entries leave no bucket behind
+    assert all(cache.buckets.values())
+    assert set().union(*cache.buckets.values()) == set(cache.entries)
@@ -0,0 +1,17 @@
+from app import SKELETON_TEMPLATES_ENABLED, classify_prompt, missing_skeleton_sections
+
+def test_skeletons_are_enabled_by_default():
+    assert SKELETON_TEMPLATES_ENABLED
+
+def test_prompt_covered_by_the_skeleton_uses_it():
+    description = 'a landing page for a SaaS product with pricing and testimonials'
+    assert classify_prompt(description) == 'landing'
+    assert missing_skeleton_sections('landing', description) == []
+
+def test_prompt_naming_other_sections_falls_back_to_full_generation():
+    description = 'a landing page with an FAQ and a contact form'
+    assert classify_prompt(description) == 'landing'
+    assert missing_skeleton_sections('landing', description) == ['contact', 'faq']
+
+def test_prompt_without_a_category_has_no_skeleton():
+    assert classify_prompt('a retro calculator with big buttons') is None